@@ -0,0 +1,65 @@
+# Shared by pongibot/chalicelib and pongibot-async-reply. Both copies
+# must stay identical, create_lambda.sh refuses to deploy otherwise.
+from __future__ import print_function
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Bounded LRU cache with time to live, shared by warm invocations
+
+    Thread safe. Values are returned as stored, callers that mutate them
+    need to store copies.
+    """
+
+    def __init__(self, max_size=256, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """return: cached value, None if missing or expired"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time() + self.ttl, value)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry is not None else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': float(self.hits) / total if total else 0.0,
+        }
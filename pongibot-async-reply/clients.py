@@ -0,0 +1,76 @@
+# Shared by pongibot/chalicelib and pongibot-async-reply. Both copies
+# must stay identical, create_lambda.sh refuses to deploy otherwise.
+from __future__ import print_function
+
+import os
+import threading
+
+import boto3
+
+try:
+    from . import metrics
+except (ImportError, ValueError):
+    # flat module of the reply lambda, not a package
+    import metrics
+
+# region of the tables and the bucket
+REGION = os.environ.get("RESOURCE_REGION", "us-east-1")
+
+# created on first use, shared by all invocations of a warm container
+_lock = threading.Lock()
+_session = None
+_resources = {}
+_clients = {}
+_tables = {}
+
+
+def get_session():
+    global _session
+    with _lock:
+        if _session is None:
+            _session = boto3.session.Session(region_name=REGION)
+        return _session
+
+
+def get_resource(name):
+    """process wide boto3 resource"""
+    if name not in _resources:
+        session = get_session()
+        with _lock:
+            if name not in _resources:
+                _resources[name] = session.resource(name)
+    return _resources[name]
+
+
+def get_client(name):
+    """process wide boto3 client"""
+    if name not in _clients:
+        session = get_session()
+        with _lock:
+            if name not in _clients:
+                _clients[name] = session.client(name)
+    return _clients[name]
+
+
+def get_table(table_name):
+    """DynamoDB Table handle, calls timed as ddb.<method>"""
+    if table_name not in _tables:
+        dynamodb = get_resource('dynamodb')
+        with _lock:
+            if table_name not in _tables:
+                _tables[table_name] = metrics.timed_calls(
+                    dynamodb.Table(table_name), 'ddb')
+    return _tables[table_name]
+
+
+def set_resource(name, resource):
+    """use resource instead of the boto3 one, for local runs"""
+    with _lock:
+        _resources[name] = resource
+        _tables.clear()
+
+
+def set_client(name, client):
+    """use client instead of the boto3 one, for local runs"""
+    with _lock:
+        _clients[name] = client
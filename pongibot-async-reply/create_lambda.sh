@@ -33,6 +33,18 @@ MEMORY=128
 S3_FOLDER="lambda_upload"
 S3_KEY="${S3_FOLDER}/${ZIP_FILE_NAME}"
 
+# copies of the webhook modules, deployed with both lambdas
+SHARED_FOLDER="../pongibot/chalicelib"
+SHARED_MODULES="cache.py clients.py metrics.py"
+
+
+echo "check modules shared with ${SHARED_FOLDER}"
+for MODULE in ${SHARED_MODULES}; do
+    if ! cmp -s "${MODULE}" "${SHARED_FOLDER}/${MODULE}"; then
+        echo "${MODULE} differs from ${SHARED_FOLDER}/${MODULE}"
+        return 1 2>/dev/null || exit 1
+    fi
+done
 
 if [ ! -d "$VENV_PATH" ]; then
     echo "create venv ${VENV_NAME}"
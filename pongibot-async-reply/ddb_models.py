@@ -1,12 +1,44 @@
 from __future__ import print_function
 
 import os
+import copy
 import json
-import boto3
-from datetime import datetime
+import time
+import base64
+from decimal import Decimal
+from collections import OrderedDict
+from datetime import datetime, timedelta
 from boto3.dynamodb.conditions import Key
+from boto3.dynamodb.types import TypeSerializer
+from botocore.exceptions import ClientError
 
-boto3.setup_default_session(region_name='us-east-1')
+import metrics
+import clients
+from cache import LRUCache
+from timestamps import EPOCH_SEQ_SIZE, key_to_epoch, format_local_time
+from preference import TagIndex
+
+
+def cache_from_env(prefix):
+    """LRUCache sized by <prefix>_SIZE and <prefix>_TTL, which default to
+    USER_CACHE_SIZE and USER_CACHE_TTL
+    """
+    return LRUCache(
+        max_size=int(os.environ.get(
+            prefix + "_SIZE", os.environ.get("USER_CACHE_SIZE", 256))),
+        ttl=int(os.environ.get(
+            prefix + "_TTL", os.environ.get("USER_CACHE_TTL", 300))))
+
+
+# User items of recent senders, kept by the warm container
+USER_CACHE = cache_from_env("USER_CACHE")
+
+# rendered "Recent Reports" payload per user, as
+# ((last_report, timezone), payload)
+RECENT_REPORTS_CACHE = cache_from_env("RECENT_REPORTS_CACHE")
+
+# tag prefix index per user, as (preference clock, TagIndex)
+TAG_INDEX_CACHE = cache_from_env("TAG_INDEX_CACHE")
 
 
 class BaseDDBTable(object):
@@ -14,7 +46,7 @@ class BaseDDBTable(object):
     """
 
     def __init__(self):
-        self.dynamodb = boto3.resource('dynamodb')
+        self.dynamodb = clients.get_resource('dynamodb')
 
     def _get_item(self, p_val, consistent=True):
         """Wrapper for get_item function
@@ -31,11 +63,12 @@ class BaseDDBTable(object):
         else:
             return resp.get('Item', None)
 
-    def _put_item(self, item):
+    def _put_item(self, item, **kwargs):
         """Wrapper for put_item function
         """
         resp = self.table.put_item(
             Item=item,
+            **kwargs
         )
         status = resp['ResponseMetadata']['HTTPStatusCode']
         if status == 200:
@@ -44,14 +77,139 @@ class BaseDDBTable(object):
             print(resp)
             return None
 
+    def new_item_condition(self):
+        """put_item arguments rejecting a put over an existing item"""
+        return {
+            'ConditionExpression': 'attribute_not_exists(#pk)',
+            'ExpressionAttributeNames': {'#pk': self.primary_key},
+        }
+
 
 class TimestampBasedDDBTable(BaseDDBTable):
+    """Table with a timestamp range key
 
-    def _put_item_with_timestamp(self, p_val, data):
+    TIMESTAMP_KEY_FORMAT selects the range key encoding:
+
+    - "iso": datetime.now().isoformat() string
+    - "epoch_ms": number, epoch milliseconds * EPOCH_SEQ_SIZE + sequence
+      of the writes within that millisecond, see timestamps.py
+
+    Both webhook and reply lambda must use the same format, and tables of
+    the two formats are not compatible (tools/backfill_timestamp_keys.py
+    copies rows from one to the other).
+    """
+
+    KEY_FORMATS = ('iso', 'epoch_ms')
+
+    # range keys tried by one put when other writers took them
+    MAX_KEY_RETRIES = 3
+
+    def __init__(self):
+        super(TimestampBasedDDBTable, self).__init__()
+        self.key_format = os.environ.get("TIMESTAMP_KEY_FORMAT", "iso")
+        if self.key_format not in self.KEY_FORMATS:
+            raise ValueError("Invalid timestamp key format: ", self.key_format)
+
+    def _new_timestamp(self, p_val):
+        """current time, unique per primary key for this table object
+
+        Other containers can take the same key in the same millisecond,
+        puts of new keys are conditional, see _put_item_with_timestamp.
+        """
+        if not hasattr(self, '_last_timestamps'):
+            self._last_timestamps = {}
+        last = self._last_timestamps.get(p_val)
+        if self.key_format == 'epoch_ms':
+            ts = int(time.time() * 1000) * EPOCH_SEQ_SIZE
+            if last is not None and ts <= last:
+                ts = last + 1
+            self._last_timestamps[p_val] = ts
+            return ts
+
+        ts = datetime.now()
+        if last is not None and ts <= last:
+            ts = last + timedelta(microseconds=1)
+        self._last_timestamps[p_val] = ts
+        return ts.isoformat()
+
+    def _item_with_timestamp(self, p_val, data):
         data[self.primary_key] = p_val
-        data[self.range_key] = datetime.now().isoformat()
-        ret = self._put_item(data)
-        return ret != None
+        data[self.range_key] = self._new_timestamp(p_val)
+        return data
+
+    def _put_item_with_timestamp(self, p_val, data):
+        """put data under a new range key, a later one if it is taken"""
+        for _ in range(self.MAX_KEY_RETRIES):
+            item = self._item_with_timestamp(p_val, data)
+            try:
+                ret = self._put_item(item, **self.new_item_condition())
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                print("range key {} is taken".format(item[self.range_key]))
+                continue
+            if ret is not None:
+                self.after_put(ret)
+            return ret != None
+        return False
+
+    def after_put(self, item):
+        """called after item is written, by put or by a transaction
+        """
+        pass
+
+    def _query_page(self, p_val, limit, cursor=None, **query_data):
+        """one page of items of p_val, newest first
+
+        cursor: opaque string returned by the previous page
+
+        return: (items, cursor of next page or None)
+        """
+        query_data.update({
+            'KeyConditionExpression': Key(self.primary_key).eq(p_val),
+            'ScanIndexForward': False,
+            'Limit': limit,
+        })
+        start = self.decode_cursor(cursor) if cursor else None
+        if start is not None and \
+                isinstance(start, basestring) != (self.key_format == 'iso'):
+            # cursor shown before the key format changed
+            start = None
+        if start is not None:
+            query_data['ExclusiveStartKey'] = {
+                self.primary_key: p_val,
+                self.range_key: start,
+            }
+        resp = self.table.query(**query_data)
+        if resp['ResponseMetadata']['HTTPStatusCode'] != 200:
+            return [], None
+
+        next_cursor = None
+        last_key = resp.get('LastEvaluatedKey')
+        if last_key:
+            next_cursor = self.encode_cursor(last_key[self.range_key])
+        return resp['Items'], next_cursor
+
+    @classmethod
+    def encode_cursor(cls, range_value):
+        if isinstance(range_value, Decimal):
+            range_value = int(range_value)
+        return base64.urlsafe_b64encode(json.dumps(range_value)).rstrip('=')
+
+    @classmethod
+    def decode_cursor(cls, cursor):
+        """return: range key value, None if cursor is invalid"""
+        cursor = str(cursor)
+        padded = cursor + '=' * (-len(cursor) % 4)
+        try:
+            return json.loads(base64.urlsafe_b64decode(padded))
+        except (TypeError, ValueError):
+            print("invalid report cursor: {}".format(cursor))
+            return None
+
+
+class ConcurrentUpdateError(Exception):
+    """User record was updated by another writer since it was loaded"""
 
 
 class User(BaseDDBTable):
@@ -59,27 +217,56 @@ class User(BaseDDBTable):
 
     primary key: user_id
     """
+
+    # bumped on every UserSession commit, for optimistic concurrency
+    VERSION_ATTR = 'version'
+
+    # conversation context, draft report and preference, as one native
+    # map: {'v': STATE_SCHEMA_VERSION, 'context': {..}, 'report': {..},
+    # 'preference': {..}}. Records written before keep them as the json
+    # string attributes in LEGACY_STATE_ATTRS, until their next commit.
+    STATE_ATTR = 'state'
+    STATE_SCHEMA_VERSION = 1
+    LEGACY_STATE_ATTRS = ('context', 'report', 'preference')
+
     def __init__(self, user_id):
         super(User, self).__init__()
         self.primary_key = 'user_id'
         self.table_name = os.environ["USER_TABLE"]
-        self.table = self.dynamodb.Table(self.table_name)
+        self.table = clients.get_table(self.table_name)
         self.user_id = user_id
         self.current_data = {}
 
-    def get_data(self, user_id):
+    def get_data(self, user_id, refresh=False):
         """get ddb data
 
+        Served from USER_CACHE when possible. A stale entry is caught by
+        the version condition of UserSession.commit, which then reloads
+        with refresh=True. USER_CONSISTENT_READ=0 switches DDB reads to
+        eventually consistent ones at half the read cost.
+
         return: dict
         """
-        return self._get_item(user_id, consistent=True)
-
-    def get_or_create(self):
+        if not refresh:
+            cached = USER_CACHE.get(user_id)
+            if cached is not None:
+                # state maps are changed in place by UserSession
+                return copy.deepcopy(cached)
+
+        consistent = refresh or os.environ.get("USER_CONSISTENT_READ", "1") != "0"
+        ret = self._get_item(user_id, consistent=consistent)
+        if ret:
+            USER_CACHE.set(user_id, copy.deepcopy(ret))
+        return ret
+
+    def get_or_create(self, refresh=False):
         """get or create DDB record
 
+        refresh: skip the cache and read consistently
+
         return: self
         """
-        ret = self.get_data(self.user_id)
+        ret = self.get_data(self.user_id, refresh=refresh)
         if not ret:
             item = {
                 'user_id': self.user_id,
@@ -90,34 +277,83 @@ class User(BaseDDBTable):
             self.current_data = ret
         return self
 
+    def get_version(self):
+        return int(self.current_data.get(self.VERSION_ATTR, 0))
+
     def get_state_context(self):
-        if 'context' in self.current_data:
-            return json.loads(self.current_data['context'])
-        else:
-            return {}
+        return self._get_state_field('context', {})
 
     def get_report_data(self):
-        if 'report' in self.current_data:
-            return json.loads(self.current_data['report'])
-        else:
-            return {'user_id': self.user_id}
+        return self._get_state_field('report', {'user_id': self.user_id})
+
+    def get_timezone(self):
+        """timezone of the user, None for the default LOCAL_TIMEZONE
+
+        The 'timezone' attribute is not written by the bot. It is set on
+        the user record, as a zone name or as the UTC offset in hours of
+        the Graph API user profile, see timestamps.get_timezone.
+        """
+        return self.current_data.get('timezone')
 
     def get_preference(self):
-        if 'preference' in self.current_data:
-            return json.loads(self.current_data['preference'])
-        else:
-            return {'tags': [], 'targets': []}
+        return self._get_state_field('preference', {'tags': [], 'targets': []})
+
+    def get_tag_index(self):
+        """prefix index of the preferred tags, rebuilt when they change
+
+        return: TagIndex
+        """
+        # the clock moves with every completed report, no need to copy
+        state = self.current_data.get(self.STATE_ATTR) or {}
+        clock = (state.get('preference') or {}).get('clock', 0)
+        cached = TAG_INDEX_CACHE.get(self.user_id)
+        if cached is not None and cached[0] == clock:
+            return cached[1]
+        index = TagIndex.from_preference(self.get_preference())
+        TAG_INDEX_CACHE.set(self.user_id, (clock, index))
+        return index
 
     def update_preference(self, preference):
-        attrs = {
-            'preference': json.dumps(preference)
-        }
-        return self.update_attributes(attrs)
+        session = UserSession(self)
+        session.set_state({'preference': preference})
+        return session.commit()
+
+    def has_state_map(self):
+        return self.STATE_ATTR in self.current_data
+
+    def get_state_map(self):
+        """loaded state map, converted from the legacy attributes if needed
 
+        Changes to the returned map are local, UserSession writes them.
 
-    def update_attributes(self, attrs):
+        return: dict
+        """
+        state = self.current_data.get(self.STATE_ATTR)
+        if state is None:
+            state = {'v': self.STATE_SCHEMA_VERSION}
+            for k in self.LEGACY_STATE_ATTRS:
+                if k in self.current_data:
+                    state[k] = json.loads(self.current_data[k])
+            self.current_data[self.STATE_ATTR] = state
+        return state
+
+    def _get_state_field(self, key, default):
+        """return: copy of one state field, safe to change"""
+        state = self.current_data.get(self.STATE_ATTR)
+        if state is not None:
+            value = state.get(key)
+            return copy.deepcopy(value) if value is not None else default
+        # not migrated yet
+        if key in self.current_data:
+            return json.loads(self.current_data[key])
+        return default
+
+    def update_attributes(self, attrs, removes=None):
         """update DDB attributes
 
+        attrs: attributes to put
+        removes: attribute names to delete in the same request
+
         return: boolean (success or not)
         """
         new_attrs = {}
@@ -126,6 +362,10 @@ class User(BaseDDBTable):
                 'Value': v,
                 'Action': 'PUT',
             }
+        for k in removes or []:
+            new_attrs[k] = {
+                'Action': "DELETE",
+            }
         new_attrs['last_modified'] = {
             'Value': datetime.now().isoformat(),
             'Action': 'PUT'
@@ -136,29 +376,254 @@ class User(BaseDDBTable):
             },
             AttributeUpdates=new_attrs
         )
-        return resp['ResponseMetadata']['HTTPStatusCode'] == 200
+        is_success = resp['ResponseMetadata']['HTTPStatusCode'] == 200
+        cached = USER_CACHE.get(self.user_id)
+        if is_success and cached is not None:
+            cached = dict(cached)
+            cached.update(attrs)
+            cached['last_modified'] = new_attrs['last_modified']['Value']
+            for k in removes or []:
+                cached.pop(k, None)
+            USER_CACHE.set(self.user_id, cached)
+        return is_success
 
     def remove_attributes(self, attrs):
         """remove DDB attributes
 
         return: boolean (success or not)
         """
-        new_attrs = {}
-        for k in attrs:
-            new_attrs[k] = {
-                'Action': "DELETE",
-            }
-        new_attrs['last_modified'] = {
-            'Value': datetime.now().isoformat(),
-            'Action': 'PUT'
+        return self.update_attributes({}, removes=attrs)
+
+    def set_local_attributes(self, attrs, removes=None):
+        """update loaded data without writing to DDB
+        """
+        self.current_data.update(attrs)
+        for k in removes or []:
+            self.current_data.pop(k, None)
+
+
+class UserSession(object):
+    """Unit of work for one User record
+
+    Attribute changes are applied to the loaded data right away and
+    tracked as dirty. commit writes them with one UpdateExpression,
+    conditioned on the version the user was loaded with. Items added
+    with add_put and counters added with add_counts are committed in the
+    same transaction.
+
+    Fields of the user state map are written one by one with document
+    paths, except when the map is not stored yet: it is then written
+    whole, replacing the legacy json attributes.
+    """
+
+    # DynamoDB transactions accept at most 25 items
+    MAX_TRANSACT_ITEMS = 25
+
+    def __init__(self, user):
+        self.user = user
+        self._puts = {}
+        self._removes = set()
+        self._state_puts = {}
+        self._state_removes = set()
+        self._state_stored = user.has_state_map()
+        self._items = []
+        self._counts = OrderedDict()
+
+    def set(self, attrs):
+        for k, v in attrs.iteritems():
+            self._puts[k] = v
+            self._removes.discard(k)
+        self.user.set_local_attributes(attrs)
+
+    def remove(self, keys):
+        for k in keys:
+            self._puts.pop(k, None)
+            self._removes.add(k)
+        self.user.set_local_attributes({}, keys)
+
+    def set_state(self, fields):
+        """set fields of the user state map"""
+        state = self.user.get_state_map()
+        state.update(fields)
+        if not self._state_stored:
+            self._put_whole_state(state)
+            return
+        for k, v in fields.iteritems():
+            self._state_puts[k] = v
+            self._state_removes.discard(k)
+
+    def remove_state(self, keys):
+        """remove fields of the user state map"""
+        state = self.user.get_state_map()
+        for k in keys:
+            state.pop(k, None)
+        if not self._state_stored:
+            self._put_whole_state(state)
+            return
+        for k in keys:
+            self._state_puts.pop(k, None)
+            self._state_removes.add(k)
+
+    def _put_whole_state(self, state):
+        self.set({User.STATE_ATTR: state})
+        legacy = [k for k in User.LEGACY_STATE_ATTRS if k in self.user.current_data]
+        if legacy:
+            self.remove(legacy)
+
+    def add_put(self, table, item):
+        """put a new item together with the user update
+
+        The put is rejected if the key is taken, the whole commit then
+        raises ConcurrentUpdateError and is replayed with new keys.
+        """
+        self._items.append((table, 'Put', item))
+
+    def add_counts(self, table, p_val, counts):
+        """add to counters of an item together with the user update
+
+        A transaction cannot hold two operations on one item, counts of
+        the same item are summed into one update.
+
+        counts: {attribute name: number to add}
+        """
+        key = (table.table_name, p_val)
+        if key not in self._counts:
+            self._counts[key] = (table, p_val, {})
+        merged = self._counts[key][2]
+        for name, n in counts.iteritems():
+            merged[name] = merged.get(name, 0) + n
+
+    def has_items(self):
+        """return: True if items or counters are written with the user"""
+        return bool(self._items or self._counts)
+
+    def is_dirty(self):
+        return bool(self._puts or self._removes or self._state_puts or
+                    self._state_removes or self._items or self._counts)
+
+    def _update_expression(self):
+        version = self.user.get_version()
+        names = {'#ver': User.VERSION_ATTR, '#lm': 'last_modified'}
+        values = {
+            ':next_ver': version + 1,
+            ':lm': datetime.now().isoformat(),
         }
-        resp = self.table.update_item(
-            Key={
-                self.primary_key: self.user_id
-            },
-            AttributeUpdates=new_attrs
-        )
-        return resp['ResponseMetadata']['HTTPStatusCode'] == 200
+        sets = ['#ver = :next_ver', '#lm = :lm']
+        for i, (k, v) in enumerate(sorted(self._puts.items())):
+            names['#a{}'.format(i)] = k
+            values[':a{}'.format(i)] = v
+            sets.append('#a{0} = :a{0}'.format(i))
+        if self._state_puts or self._state_removes:
+            names['#st'] = User.STATE_ATTR
+        for i, (k, v) in enumerate(sorted(self._state_puts.items())):
+            names['#s{}'.format(i)] = k
+            values[':s{}'.format(i)] = v
+            sets.append('#st.#s{0} = :s{0}'.format(i))
+        expression = 'SET ' + ', '.join(sets)
+
+        removes = []
+        for i, k in enumerate(sorted(self._removes)):
+            names['#r{}'.format(i)] = k
+            removes.append('#r{}'.format(i))
+        for i, k in enumerate(sorted(self._state_removes)):
+            names['#t{}'.format(i)] = k
+            removes.append('#st.#t{}'.format(i))
+        if removes:
+            expression += ' REMOVE ' + ', '.join(removes)
+
+        if version == 0:
+            condition = 'attribute_not_exists(#ver)'
+        else:
+            condition = '#ver = :ver'
+            values[':ver'] = version
+
+        return {
+            'Key': {self.user.primary_key: self.user.user_id},
+            'UpdateExpression': expression,
+            'ConditionExpression': condition,
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': values,
+        }
+
+    def commit(self):
+        """write all changes
+
+        raise: ConcurrentUpdateError if the user was changed by another
+               writer, nothing is written in that case
+               ValueError if the items exceed MAX_TRANSACT_ITEMS, nothing
+               is written either
+        """
+        if not self.is_dirty():
+            return True
+
+        update = self._update_expression()
+        if self._items or self._counts:
+            self._transact_write(update)
+        else:
+            try:
+                self.user.table.update_item(**update)
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                    USER_CACHE.pop(self.user.user_id)
+                    raise ConcurrentUpdateError(self.user.user_id)
+                raise
+
+        for table, kind, body in self._items:
+            table.after_put(body)
+        data = self.user.current_data
+        data[User.VERSION_ATTR] = update['ExpressionAttributeValues'][':next_ver']
+        data['last_modified'] = update['ExpressionAttributeValues'][':lm']
+        USER_CACHE.set(self.user.user_id, copy.deepcopy(data))
+        self._puts = {}
+        self._removes = set()
+        self._state_puts = {}
+        self._state_removes = set()
+        self._state_stored = self.user.has_state_map()
+        self._items = []
+        self._counts = OrderedDict()
+        return True
+
+    def _transact_write(self, update):
+        serializer = TypeSerializer()
+
+        def serialize(data):
+            return dict((k, serializer.serialize(v)) for k, v in data.iteritems())
+
+        update = dict(update)
+        update['TableName'] = self.user.table_name
+        update['Key'] = serialize(update['Key'])
+        update['ExpressionAttributeValues'] = serialize(
+            update['ExpressionAttributeValues'])
+        transact_items = [{'Update': update}]
+        for table, kind, body in self._items:
+            op = table.new_item_condition()
+            op['Item'] = serialize(body)
+            op['TableName'] = table.table_name
+            transact_items.append({kind: op})
+        for table, p_val, counts in self._counts.values():
+            op = table.build_update(p_val, counts)
+            op['Key'] = serialize(op['Key'])
+            op['ExpressionAttributeValues'] = serialize(
+                op['ExpressionAttributeValues'])
+            op['TableName'] = table.table_name
+            transact_items.append({'Update': op})
+
+        if len(transact_items) > self.MAX_TRANSACT_ITEMS:
+            raise ValueError("{} items do not fit in one transaction".format(
+                len(transact_items)))
+
+        client = metrics.timed_calls(self.user.dynamodb.meta.client, 'ddb')
+        try:
+            client.transact_write_items(TransactItems=transact_items)
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            reasons = e.response.get('CancellationReasons', [])
+            if any(r.get('Code') == 'ConditionalCheckFailed' for r in reasons):
+                # the user version, or the key of a new item, was taken
+                USER_CACHE.pop(self.user.user_id)
+                raise ConcurrentUpdateError(self.user.user_id)
+            raise
 
 
 class MsgTable(TimestampBasedDDBTable):
@@ -174,7 +639,7 @@ class MsgTable(TimestampBasedDDBTable):
         self.range_key = 'timestamp'
         self.mid_index = 'mid-index'
         self.table_name = os.environ["MSG_TABLE"]
-        self.table = self.dynamodb.Table(self.table_name)
+        self.table = clients.get_table(self.table_name)
 
     def put(self, user_id, msg):
         return self._put_item_with_timestamp(user_id, msg)
@@ -192,14 +657,14 @@ class MsgTable(TimestampBasedDDBTable):
             return resp['Items'][0]
 
 
-    def mark_processed(self, mid, saved_attachments=None):
-        item = self.get_item(mid)
-        if not item:
-            print("cannot find mid {}".format(mid))
-            return False
+    def mark_processed(self, mid, saved_attachments=None, key=None):
+        """mark message as processed
 
-        pk = self.primary_key
-        rk = self.range_key
+        key: primary key of the message given by the webhook. mid-index
+             is queried only without it, or when it does not match mid.
+
+        return: boolean (success or not)
+        """
         attrs = {
             'processed_timestmap': {
                 'Value': datetime.now().isoformat(),
@@ -213,12 +678,36 @@ class MsgTable(TimestampBasedDDBTable):
                 'Action': 'PUT'
             }
 
+        if key is not None:
+            try:
+                return self._update_msg(key, mid, attrs)
+            except ClientError as e:
+                if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                    raise
+                print("key does not match mid {}, query {}".format(
+                    mid, self.mid_index))
+
+        item = self.get_item(mid)
+        if not item:
+            print("cannot find mid {}".format(mid))
+            return False
+        return self._update_msg(item, mid, attrs)
+
+    def _update_msg(self, key, mid, attrs):
+        pk = self.primary_key
+        rk = self.range_key
         resp = self.table.update_item(
             Key={
-                pk: item[pk],
-                rk: item[rk],
+                pk: key[pk],
+                rk: key[rk],
             },
-            AttributeUpdates=attrs
+            AttributeUpdates=attrs,
+            # never create an item from a wrong key
+            Expected={
+                'mid': {
+                    'Value': mid,
+                }
+            }
         )
         return resp['ResponseMetadata']['HTTPStatusCode'] == 200
 
@@ -234,7 +723,7 @@ class ReplyTable(TimestampBasedDDBTable):
         self.primary_key = 'user_id'
         self.range_key = 'timestamp'
         self.table_name = os.environ["REPLY_TABLE"]
-        self.table = self.dynamodb.Table(self.table_name)
+        self.table = clients.get_table(self.table_name)
 
     def put(self, user_id, attributes):
         return self._put_item_with_timestamp(user_id, attributes)
@@ -248,10 +737,32 @@ class ReportTable(TimestampBasedDDBTable):
         self.primary_key = 'user_id'
         self.range_key = 'timestamp'
         self.table_name = os.environ["REPORT_TABLE"]
-        self.table = self.dynamodb.Table(self.table_name)
+        self.table = clients.get_table(self.table_name)
+        # tag and target lookups, written with every report when set
+        self.index = ReportIndexTable() \
+            if os.environ.get("REPORT_INDEX_TABLE") else None
+        # report counters, added with every report when set
+        self.stats = ReportStatsTable() \
+            if os.environ.get("REPORT_STATS_TABLE") else None
 
     def put(self, user_id, attributes):
-        return self._put_item_with_timestamp(user_id, attributes)
+        ret = self._put_item_with_timestamp(user_id, attributes)
+        if ret and self.index is not None:
+            for item in self.index.build_items(attributes):
+                self.index._put_item(item)
+        if ret and self.stats is not None:
+            self.stats.add_report(attributes)
+        return ret
+
+    def build_item(self, user_id, attributes):
+        """report item with keys, for writes outside of put
+
+        return: dict
+        """
+        return self._item_with_timestamp(user_id, attributes)
+
+    def after_put(self, item):
+        RECENT_REPORTS_CACHE.pop(item[self.primary_key])
 
     def load(self, user_id, limit):
         query_data = {
@@ -264,3 +775,182 @@ class ReportTable(TimestampBasedDDBTable):
             return resp['Items']
         else:
             return []
+
+    def load_page(self, user_id, limit, cursor=None):
+        """one page of reports, newest first
+
+        Only the attributes used by the list template are fetched.
+
+        cursor: opaque string returned by the previous page
+
+        return: (reports, cursor of next page or None)
+        """
+        return self._query_page(
+            user_id, limit, cursor,
+            ProjectionExpression='#pk, #rk, #tags, #target, #images[0], #thumbs',
+            ExpressionAttributeNames={
+                '#pk': self.primary_key,
+                '#rk': self.range_key,
+                '#tags': 'tags',
+                '#target': 'target',
+                '#images': 'images',
+                '#thumbs': 'thumbnails',
+            })
+
+    def iter_pages(self, user_id, page_size, cursor=None):
+        """yield (reports, next cursor) page by page, newest first
+        """
+        while True:
+            reports, cursor = self.load_page(user_id, page_size, cursor)
+            if reports:
+                yield reports, cursor
+            if not cursor:
+                break
+
+
+class ReportIndexTable(TimestampBasedDDBTable):
+    """Inverted index of the reports by tag and by target
+
+    primary key: key, "<user_id>#tag#<tag>" or "<user_id>#target#<target>",
+                 names case-folded
+    range key: timestamp of the report
+
+    Items hold the attributes shown in report lists, so listing the
+    reports of a tag takes one query whatever the size of the history.
+    They are written in the transaction storing the report.
+    """
+
+    KINDS = ('tag', 'target')
+    LIST_ATTRS = ('user_id', 'tags', 'target')
+
+    def __init__(self):
+        super(ReportIndexTable, self).__init__()
+        self.primary_key = 'key'
+        self.range_key = 'timestamp'
+        self.table_name = os.environ["REPORT_INDEX_TABLE"]
+        self.table = clients.get_table(self.table_name)
+
+    @classmethod
+    def index_key(cls, user_id, kind, name):
+        return u'{}#{}#{}'.format(user_id, kind, name.lower())
+
+    def build_items(self, report):
+        """index items of a report item with keys
+
+        return: list of dict, one per distinct tag and target
+        """
+        user_id = report['user_id']
+        keys = [self.index_key(user_id, 'tag', t) for t in report.get('tags', [])]
+        if report.get('target'):
+            keys.append(self.index_key(user_id, 'target', report['target']))
+
+        items = []
+        seen = set()
+        for key in keys:
+            # one transaction cannot write the same item twice
+            if key in seen:
+                continue
+            seen.add(key)
+            item = dict((k, report[k]) for k in self.LIST_ATTRS if k in report)
+            if report.get('images'):
+                image = report['images'][0]
+                item['images'] = [image]
+                thumbnail = report.get('thumbnails', {}).get(image)
+                if thumbnail:
+                    item['thumbnails'] = {image: thumbnail}
+            item[self.primary_key] = key
+            item[self.range_key] = report['timestamp']
+            items.append(item)
+        return items
+
+    def query(self, user_id, kind, name, limit, cursor=None):
+        """one page of the reports of a tag or target, newest first
+
+        kind: 'tag' or 'target'
+
+        return: (reports, cursor of next page or None)
+        """
+        if kind not in self.KINDS:
+            raise ValueError("Invalid index kind: ", kind)
+        return self._query_page(
+            self.index_key(user_id, kind, name), limit, cursor)
+
+
+class ReportStatsTable(BaseDDBTable):
+    """Report counts of every user, by tag, target and day
+
+    primary key: user_id
+
+    One item per user, with a number attribute per counter: 'total',
+    'tag#<tag>', 'target#<target>' and 'day#<YYYY-mm-dd>' in the timezone
+    of the user, names case-folded. Counters are added in the transaction
+    storing the report, so a summary is one get_item.
+    """
+
+    KINDS = ('tag', 'target', 'day')
+    TOTAL = 'total'
+
+    def __init__(self):
+        super(ReportStatsTable, self).__init__()
+        self.primary_key = 'user_id'
+        self.table_name = os.environ["REPORT_STATS_TABLE"]
+        self.table = clients.get_table(self.table_name)
+
+    @classmethod
+    def counter_names(cls, report, timezone=None):
+        """return: names of the counters of a report item with keys"""
+        names = [cls.TOTAL]
+        for tag in report.get('tags', []):
+            name = u'tag#{}'.format(tag.lower())
+            if name not in names:
+                names.append(name)
+        if report.get('target'):
+            names.append(u'target#{}'.format(report['target'].lower()))
+        local_time = format_local_time(key_to_epoch(report['timestamp']), timezone)
+        names.append('day#' + local_time[:10])
+        return names
+
+    @classmethod
+    def report_counts(cls, report, timezone=None, n=1):
+        """counts adding a report item with keys
+
+        timezone: timezone name of the day, LOCAL_TIMEZONE by default
+
+        return: {counter name: n}
+        """
+        return dict((name, n) for name in cls.counter_names(report, timezone))
+
+    def build_update(self, user_id, counts):
+        """update_item arguments adding counts to the counters of a user"""
+        names = {}
+        values = {}
+        adds = []
+        for i, (name, n) in enumerate(sorted(counts.items())):
+            names['#c{}'.format(i)] = name
+            values[':c{}'.format(i)] = n
+            adds.append('#c{0} :c{0}'.format(i))
+        return {
+            'Key': {self.primary_key: user_id},
+            'UpdateExpression': 'ADD ' + ', '.join(adds),
+            'ExpressionAttributeNames': names,
+            'ExpressionAttributeValues': values,
+        }
+
+    def add_report(self, report, timezone=None):
+        """add a report to the counters, outside of a transaction"""
+        self.table.update_item(**self.build_update(
+            report['user_id'], self.report_counts(report, timezone)))
+
+    def get_summary(self, user_id):
+        """counters of a user
+
+        return: {'total': n, 'tag': {tag: n}, 'target': {..}, 'day': {..}}
+        """
+        item = self._get_item(user_id, consistent=False) or {}
+        summary = dict((kind, {}) for kind in self.KINDS)
+        summary[self.TOTAL] = int(item.get(self.TOTAL, 0))
+        for k, v in item.iteritems():
+            kind, sep, name = k.partition('#')
+            if sep and kind in self.KINDS:
+                summary[kind][name] = int(v)
+        return summary
@@ -1,38 +1,296 @@
 from __future__ import print_function
 
 import os
-import boto3
-import tempfile
+import time
+import uuid
+import hashlib
 import urllib2
+import threading
+from collections import namedtuple, OrderedDict
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor, wait
 
-boto3.setup_default_session(region_name="us-east-1")
+import metrics
+import clients
+import thumbnails
+
+# bounded pool shared by warm invocations, each worker holds at most one
+# part in memory
+S3_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("S3_WORKERS", 4)))
+
+SaveResult = namedtuple('SaveResult',
+                        ['url', 's3_key', 'thumbnail_key', 'error'])
+
+
+class DeadlineExceeded(Exception):
+    """a save was stopped at the deadline of batch_s3_save"""
+    pass
+
+
+def check_deadline(deadline):
+    if deadline is not None and time.time() >= deadline:
+        raise DeadlineExceeded("deadline exceeded")
+
+
+def read_chunk(f, size):
+    """read up to size bytes, stop early only at end of stream
+    """
+    parts = []
+    left = size
+    while left > 0:
+        data = f.read(left)
+        if not data:
+            break
+        parts.append(data)
+        left -= len(data)
+    return b''.join(parts)
+
+
+class ContentIndex(object):
+    """Bounded set of content keys known to exist in S3
+
+    Kept by the warm container, S3 is checked on a miss.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            if key in self._keys:
+                self._keys.pop(key)
+                self._keys[key] = True
+                return True
+        return False
+
+    def add(self, key):
+        with self._lock:
+            self._keys.pop(key, None)
+            self._keys[key] = True
+            while len(self._keys) > self.max_size:
+                self._keys.popitem(last=False)
+
+
+CONTENT_INDEX = ContentIndex()
 
 
 class FileSaver(object):
 
     S3_FOLDER = 'saved_attachments'
+    CONTENT_FOLDER = 'sha256'
+    INCOMING_FOLDER = 'incoming'
+
+    # "path": saved_attachments/<sender_id>/<file name>
+    # "content": saved_attachments/sha256/<hash prefix>/<hash>.<suffix>,
+    #            identical files are stored once
+    STORAGE_MODES = ('path', 'content')
+
+    # S3 multipart parts must be at least 5 MB (except the last one)
+    MIN_PART_SIZE = 5 * 1024 * 1024
+    URL_TIMEOUT = 20
 
-    def __init__(self):
+    def __init__(self, part_size=None, storage_mode=None):
         self.bucket_name = os.environ["S3_BUCKET"]
-        self.bucket = boto3.resource("s3").Bucket(self.bucket_name)
-
-    def save_s3(self, url, file_name):
-        s3_key = os.path.join(self.S3_FOLDER, file_name)
-        suffix = file_name.split('.')[-1]
-        meta = {}
-        if suffix in ("jpg", "jpeg"):
-            meta["Content-Type"] = "image/jpeg"
-
-        with tempfile.TemporaryFile() as tmp:
-            f = urllib2.urlopen(url)
-            tmp.write(f.read())
-            tmp.seek(0)
-            self.bucket.put_object(Key=s3_key, Body=tmp, Metadata=meta)
-        return s3_key
-
-    def batch_s3_save(self, urls, file_names):
+        self.client = clients.get_client("s3")
+        part_size = part_size or int(
+            os.environ.get("S3_PART_SIZE", self.MIN_PART_SIZE))
+        self.part_size = max(part_size, self.MIN_PART_SIZE)
+        self.storage_mode = storage_mode or os.environ.get(
+            "S3_STORAGE_MODE", "path")
+        if self.storage_mode not in self.STORAGE_MODES:
+            raise ValueError("Invalid storage mode: ", self.storage_mode)
+
+    @metrics.timed('s3.save')
+    def save_s3(self, url, file_name, deadline=None):
+        """stream url content to S3
+
+        Peak memory is bounded by part_size: small files are uploaded
+        with a single put_object, larger ones part by part with a
+        multipart upload. Content-Type comes from the response headers.
+
+        In content storage mode the file is hashed while streaming and
+        the upload is skipped if the same content is already saved.
+
+        Images uploaded with a single put_object also get a thumbnail,
+        see save_thumbnail. Larger ones are never held whole in memory
+        and are shown as they are.
+
+        deadline: absolute time (time.time()), checked before the
+                  download and between parts
+
+        return: (s3 key, thumbnail s3 key or None)
+        raise: DeadlineExceeded, a multipart upload is aborted then
+        """
+        check_deadline(deadline)
+        content_mode = self.storage_mode == 'content'
+        digest = hashlib.sha256() if content_mode else None
+        f = urllib2.urlopen(url, timeout=self.URL_TIMEOUT)
+        try:
+            headers = f.info()
+            extra = {}
+            content_type = headers.getheader('Content-Type')
+            if content_type:
+                extra['ContentType'] = content_type
+
+            thumb_key = None
+            chunk = read_chunk(f, self.part_size)
+            if len(chunk) < self.part_size:
+                size = len(chunk)
+                if content_mode:
+                    digest.update(chunk)
+                    s3_key = self.content_key(digest.hexdigest(), file_name)
+                    if self.content_exists(s3_key):
+                        return s3_key, self.save_thumbnail(
+                            s3_key, chunk, content_type)
+                else:
+                    s3_key = os.path.join(self.S3_FOLDER, file_name)
+                self.client.put_object(
+                    Bucket=self.bucket_name, Key=s3_key, Body=chunk,
+                    ContentLength=size, **extra)
+                thumb_key = self.save_thumbnail(s3_key, chunk, content_type)
+            elif content_mode:
+                # hash is known only after the last part
+                incoming_key = os.path.join(
+                    self.S3_FOLDER, self.INCOMING_FOLDER, uuid.uuid4().hex)
+                size = self._multipart_upload(
+                    incoming_key, f, chunk, extra, digest, deadline)
+                s3_key = self.content_key(digest.hexdigest(), file_name)
+                self._move_incoming(incoming_key, s3_key)
+            else:
+                s3_key = os.path.join(self.S3_FOLDER, file_name)
+                size = self._multipart_upload(
+                    s3_key, f, chunk, extra, deadline=deadline)
+        finally:
+            f.close()
+
+        if content_mode:
+            CONTENT_INDEX.add(s3_key)
+        content_length = headers.getheader('Content-Length')
+        if content_length and int(content_length) != size:
+            print("size mismatch for {}: {} != {}".format(
+                s3_key, content_length, size))
+        return s3_key, thumb_key
+
+    def save_thumbnail(self, s3_key, data, content_type=None):
+        """store a re-encoded thumbnail of image data next to s3_key
+
+        In content storage mode a thumbnail already saved is reused.
+
+        return: thumbnail s3 key, None if data got no thumbnail
+        """
+        if not thumbnails.enabled():
+            return None
+        if content_type and not content_type.startswith('image/'):
+            return None
+        thumb_key = thumbnails.thumbnail_key(s3_key)
+        if self.storage_mode == 'content' and self.content_exists(thumb_key):
+            return thumb_key
+
+        with metrics.timer('thumbnail'):
+            thumb = thumbnails.make_thumbnail(data)
+        if thumb is None:
+            return None
+        try:
+            self.client.put_object(
+                Bucket=self.bucket_name, Key=thumb_key, Body=thumb,
+                ContentLength=len(thumb), ContentType='image/jpeg')
+        except ClientError as e:
+            print("cannot save thumbnail {}: {}".format(thumb_key, e))
+            return None
+        if self.storage_mode == 'content':
+            CONTENT_INDEX.add(thumb_key)
+        return thumb_key
+
+    def content_key(self, hex_digest, file_name):
+        suffix = ''
+        if '.' in file_name:
+            suffix = '.' + file_name.split('.')[-1].lower()
+        return os.path.join(self.S3_FOLDER, self.CONTENT_FOLDER,
+                            hex_digest[:2], hex_digest + suffix)
+
+    def content_exists(self, s3_key):
+        """check content index, then S3
+        """
+        if s3_key in CONTENT_INDEX:
+            return True
+        try:
+            self.client.head_object(Bucket=self.bucket_name, Key=s3_key)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+        CONTENT_INDEX.add(s3_key)
+        return True
+
+    def _move_incoming(self, incoming_key, s3_key):
+        if not self.content_exists(s3_key):
+            self.client.copy_object(
+                Bucket=self.bucket_name, Key=s3_key,
+                CopySource={'Bucket': self.bucket_name, 'Key': incoming_key})
+        self.client.delete_object(Bucket=self.bucket_name, Key=incoming_key)
+
+    def _multipart_upload(self, s3_key, f, chunk, extra, digest=None,
+                          deadline=None):
+        """upload chunk and the rest of f part by part
+
+        The upload is aborted on any error, and at the deadline.
+
+        return: uploaded size
+        """
+        upload = self.client.create_multipart_upload(
+            Bucket=self.bucket_name, Key=s3_key, **extra)
+        upload_id = upload['UploadId']
+        parts = []
+        size = 0
+        try:
+            while chunk:
+                check_deadline(deadline)
+                if digest is not None:
+                    digest.update(chunk)
+                part_number = len(parts) + 1
+                resp = self.client.upload_part(
+                    Bucket=self.bucket_name, Key=s3_key,
+                    UploadId=upload_id, PartNumber=part_number,
+                    Body=chunk, ContentLength=len(chunk))
+                parts.append({'ETag': resp['ETag'], 'PartNumber': part_number})
+                size += len(chunk)
+                # release the uploaded part before reading the next one
+                chunk = None
+                chunk = read_chunk(f, self.part_size)
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=s3_key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts})
+        except Exception:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket_name, Key=s3_key, UploadId=upload_id)
+            raise
+        return size
+
+    def batch_s3_save(self, urls, file_names, deadline=None):
+        """save files concurrently
+
+        deadline: absolute time (time.time()) to give up waiting. Saves
+                  still running stop at their next part.
+
+        return: list of SaveResult, in the same order as urls
+        """
+        futures = [S3_EXECUTOR.submit(self.save_s3, url, file_name, deadline)
+                   for url, file_name in zip(urls, file_names)]
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline - time.time(), 0)
+        wait(futures, timeout=timeout)
+
         ret = []
-        for url, file_name in zip(urls, file_names):
-            s3_key = self.save_s3(url, file_name)
-            ret.append(s3_key)
+        for url, f in zip(urls, futures):
+            if not f.done():
+                f.cancel()
+                ret.append(SaveResult(url, None, None, "deadline exceeded"))
+            elif f.exception() is not None:
+                ret.append(SaveResult(url, None, None, str(f.exception())))
+            else:
+                s3_key, thumb_key = f.result()
+                ret.append(SaveResult(url, s3_key, thumb_key, None))
         return ret
@@ -2,8 +2,10 @@ from __future__ import print_function
 
 from abc import ABCMeta, abstractmethod
 
-from reply_utils import QuickReplyGenerator, TemplateGenerator
-from ddb_models import ReportTable
+import metrics
+from reply_utils import QuickReplyGenerator, QuickReplyParser, \
+    TemplateGenerator
+from ddb_models import ReportTable, RECENT_REPORTS_CACHE
 
 class BaseState(object):
     __metaclass__ = ABCMeta
@@ -25,40 +27,183 @@ class InitState(BaseState):
     def update_by_context(self, context):
         context_data = context.get_context()
         signal = context_data.pop('signal', '')
+        search = QuickReplyParser.parse_search_command(
+            context_data.pop('text', ''))
 
         if signal == "INSERT_NEW":
             context.set_state(InitInsertState())
         elif signal == "RECENT_REPORT":
+            context_data.pop('cursor', None)
             context.set_state(RecentReportState())
+        elif signal == "MORE_REPORTS":
+            # "More" of an earlier list, keep browsing from its cursor
+            context.set_state(RecentReportState())
+        elif signal == "STATS":
+            context.set_state(StatsState())
+        elif search:
+            context_data.pop('cursor', None)
+            context_data['search'] = search
+            context.set_state(SearchReportState())
 
     def generate_reply(self, context):
         preference = context.get_preference()
         qr = QuickReplyGenerator(preference)
 
         ret = {
-            'text': "please select action",
+            'text': "please select action, or send #tag or @name to find reports",
             'quick_replies': qr.generate_initial_menu()
         }
         return ret
 
 
 class RecentReportState(BaseState):
-    """Initial state state"""
+    """Browse reports, newest first, one page per reply
+
+    The first page is cached, later pages are loaded with the cursor of
+    the "More" quick reply.
+    """
     STATE_CODE = 'RECENT_REPORT'
     REPLY_COUNT = 4
 
     def update_by_context(self, context):
-        context.set_state(InitState())
+        context_data = context.get_context()
+        signal = context_data.pop('signal', '')
+        cursor = context_data.pop('cursor', None)
+        search = QuickReplyParser.parse_search_command(
+            context_data.pop('text', ''))
+        # a "More" of an older list is followed on the table it pages
+        if signal == "MORE_REPORTS" and cursor:
+            context_data['cursor'] = cursor
+            context.set_state(RecentReportState())
+        elif signal == "MORE_SEARCH" and cursor and context_data.get('search'):
+            context_data['cursor'] = cursor
+            context.set_state(SearchReportState())
+        elif search:
+            context_data['search'] = search
+            context.set_state(SearchReportState())
+        else:
+            context.set_state(InitState())
 
     def generate_reply(self, context):
-        user_id = context.user.user_id
-        rpt = ReportTable()
-        reports = rpt.load(user_id, self.REPLY_COUNT)
+        user = context.user
+        cursor = context.get_context().get('cursor')
+        if cursor:
+            reports, next_cursor = ReportTable().load_page(
+                user.user_id, self.REPLY_COUNT, cursor)
+            return self._reports_reply(context, reports, next_cursor)
+
+        # changes whenever a report of the user is stored
+        version = (user.current_data.get('last_report'), user.get_timezone())
+        cached = RECENT_REPORTS_CACHE.get(user.user_id)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+
+        reports, next_cursor = ReportTable().load_page(
+            user.user_id, self.REPLY_COUNT)
+        ret = self._reports_reply(context, reports, next_cursor)
+        RECENT_REPORTS_CACHE.set(user.user_id, (version, ret))
+        return ret
+
+    def _reports_reply(self, context, reports, next_cursor):
+        if not reports:
+            # a full last page still returns a cursor
+            text = "No more reports." if context.get_context().get('cursor') \
+                else "No reports found."
+            return {
+                'text': text,
+            }
         ret = {
-            'template': TemplateGenerator.generate_reports(reports),
+            'template': TemplateGenerator.generate_reports(
+                reports, context.user.get_timezone()),
         }
+        if next_cursor:
+            qr = QuickReplyGenerator(context.get_preference())
+            ret['quick_replies'] = [self._more_reply(qr, next_cursor)]
         return ret
 
+    def _more_reply(self, qr, cursor):
+        return qr.generate_more_reports_reply(cursor)
+
+
+class SearchReportState(RecentReportState):
+    """Browse the reports of one tag or target, newest first
+
+    Entered with a '#tag' or '@name' text, pages are queried from
+    ReportIndexTable.
+    """
+    STATE_CODE = 'SEARCH_REPORT'
+
+    def update_by_context(self, context):
+        super(SearchReportState, self).update_by_context(context)
+        if not isinstance(context.state, SearchReportState):
+            context.get_context().pop('search', None)
+
+    def generate_reply(self, context):
+        context_data = context.get_context()
+        search = context_data.get('search')
+        index = ReportTable().index
+        if index is None or not search:
+            return {
+                'text': "Search is not available.",
+            }
+        reports, next_cursor = index.query(
+            context.user.user_id, search['kind'], search['name'],
+            self.REPLY_COUNT, context_data.get('cursor'))
+        if not reports and not context_data.get('cursor'):
+            prefix = '#' if search['kind'] == 'tag' else '@'
+            return {
+                'text': "No reports found for {}{}.".format(
+                    prefix, search['name']),
+            }
+        return self._reports_reply(context, reports, next_cursor)
+
+    def _more_reply(self, qr, cursor):
+        return qr.generate_more_search_reply(cursor)
+
+
+class StatsState(BaseState):
+    """Report counts of the user, from ReportStatsTable"""
+    STATE_CODE = 'STATS'
+    TOP_TAGS = 5
+    TOP_TARGETS = 3
+    LAST_DAYS = 7
+
+    def update_by_context(self, context):
+        context.set_state(InitState())
+
+    def generate_reply(self, context):
+        stats = ReportTable().stats
+        if stats is None:
+            return {
+                'text': "Stats are not available.",
+            }
+        summary = stats.get_summary(context.user.user_id)
+        if not summary['total']:
+            return {
+                'text': "No reports yet.",
+            }
+
+        def top(counts, size):
+            ranked = sorted(counts.items(), key=lambda c: (-c[1], c[0]))
+            return ranked[:size]
+
+        lines = ["{} reports".format(summary['total'])]
+        if summary['tag']:
+            lines.append("Tags: " + ", ".join(
+                "#{} {}".format(name, n)
+                for name, n in top(summary['tag'], self.TOP_TAGS)))
+        if summary['target']:
+            lines.append("Targets: " + ", ".join(
+                "{} {}".format(name, n)
+                for name, n in top(summary['target'], self.TOP_TARGETS)))
+        days = sorted(summary['day'].items(), reverse=True)[:self.LAST_DAYS]
+        if days:
+            lines.append("Recent days: " + ", ".join(
+                "{} {}".format(day, n) for day, n in days))
+        return {
+            'text': "\n".join(lines),
+        }
+
 
 class InitInsertState(BaseState):
     """Initial Insert state"""
@@ -68,7 +213,7 @@ class InitInsertState(BaseState):
         context_data = context.get_context()
         report = context.get_report()
         images = context_data.pop('images', [])
-        report.add_images(images)
+        report.add_images(images, context_data.pop('thumbnails', None))
         if len(images) > 0:
             context.set_state(ImgUploadedState())
 
@@ -79,6 +224,43 @@ class InitInsertState(BaseState):
         return ret
 
 
+def resolve_tag(context, text):
+    """tag to add for a typed text
+
+    A known tag in another case is taken with its stored spelling. When
+    the text only starts known tags, they are put in the context as
+    'suggestions' for the reply, and nothing is added.
+
+    return: tag, None if suggestions are offered
+    """
+    context_data = context.get_context()
+    if context_data.pop('picked', False):
+        return text
+    index = context.get_tag_index()
+    known = index.lookup(text)
+    if known is not None:
+        return known
+    names = index.complete(text, excludes=context.get_report().get_tags())
+    if names:
+        context_data['suggestions'] = {'text': text, 'names': names}
+        return None
+    return text
+
+
+def suggestion_reply(context):
+    """return: reply offering the suggested tags, None if there are none"""
+    suggestions = context.get_context().pop('suggestions', None)
+    if not suggestions:
+        return None
+    qr = QuickReplyGenerator(context.get_preference())
+    ret = {
+        'text': "Did you mean?",
+        'quick_replies': qr.generate_tag_suggestions(
+            suggestions['names'], suggestions['text'])
+    }
+    return ret
+
+
 class ImgUploadedState(BaseState):
     """Img Uploaded state"""
     STATE_CODE = 'IMG_UPLOADED'
@@ -87,11 +269,15 @@ class ImgUploadedState(BaseState):
         context_data = context.get_context()
         report = context.get_report()
         text = context_data.pop('text', '')
-        if len(text) > 0:
-            report.add_tag(text)
+        tag = resolve_tag(context, text) if len(text) > 0 else None
+        if tag:
+            report.add_tag(tag)
             context.set_state(TagAddedState())
 
     def generate_reply(self, context):
+        ret = suggestion_reply(context)
+        if ret:
+            return ret
         preference = context.get_preference()
         qr = QuickReplyGenerator(preference)
 
@@ -117,9 +303,16 @@ class TagAddedState(BaseState):
         if signal == 'SKIP':
             context.set_state(ReportUserState())
         elif len(text) > 0:
-            report.add_tag(text)
+            tag = resolve_tag(context, text)
+            if tag:
+                report.add_tag(tag)
+                if report.is_tags_full():
+                    context.set_state(ReportUserState())
 
     def generate_reply(self, context):
+        ret = suggestion_reply(context)
+        if ret:
+            return ret
         preference = context.get_preference()
         qr = QuickReplyGenerator(preference)
         report = context.get_report()
@@ -191,6 +384,8 @@ class InsertStateFactory(object):
     STATE_CODE_MAPPING = {
         'INIT': InitState,
         'RECENT_REPORT': RecentReportState,
+        'SEARCH_REPORT': SearchReportState,
+        'STATS': StatsState,
         'INIT_INSERT': InitInsertState,
         'IMG_UPLOADED': ImgUploadedState,
         'TAG_ADDED': TagAddedState,
@@ -236,21 +431,33 @@ class InsertStateContext(object):
     def get_preference(self):
         return self._preference
 
+    def get_tag_index(self):
+        return self.user.get_tag_index()
+
     def receive_context(self, update_dict):
         self._context_data.update(update_dict)
-        self.state.update_by_context(self)
+        with metrics.timer('state.' + self.state.STATE_CODE):
+            self.state.update_by_context(self)
+        # only holds for the text of this message
+        self._context_data.pop('picked', None)
 
     def set_state(self, state):
         self._context_data['STATE_CODE'] = state.STATE_CODE
         self.state = state
 
     def generate_reply(self):
-        return self.state.generate_reply(self)
+        with metrics.timer('reply.' + self.state.STATE_CODE):
+            return self.state.generate_reply(self)
 
 
 class ReportData(object):
     """A dict wrapper for Report record"""
 
+    # a report is written with one index item per tag, the target index
+    # item, its stats and the user in one transaction, which holds at
+    # most UserSession.MAX_TRANSACT_ITEMS items
+    MAX_TAGS = 20
+
     def __init__(self):
         self._data = {
             'tags': [],
@@ -263,8 +470,11 @@ class ReportData(object):
     def add_target(self, target):
         self._data['target'] = target
 
-    def add_images(self, images):
+    def add_images(self, images, thumbnails=None):
+        """thumbnails: {image s3 key: thumbnail s3 key}"""
         self._data['images'] += images
+        if thumbnails:
+            self._data.setdefault('thumbnails', {}).update(thumbnails)
 
     def add_tag(self, tag):
         if tag not in self._data['tags']:
@@ -278,3 +488,6 @@ class ReportData(object):
 
     def get_tags(self):
         return self._data['tags']
+
+    def is_tags_full(self):
+        return len(self._data['tags']) >= self.MAX_TAGS
@@ -2,13 +2,31 @@ from __future__ import print_function
 
 import os
 import json
+import time
 from urlparse import urlparse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 
 from msg_sender import FacebookMsgSender
 from file_utils import FileSaver
-from ddb_models import User, MsgTable, ReportTable
+from ddb_models import User, UserSession, MsgTable, ReportTable, \
+    ConcurrentUpdateError
 from insert_states import InsertStateContext
+import metrics
 from reply_utils import QuickReplyParser
+from preference import Preference
+
+# shared by warm invocations, most of the work is network wait
+EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("HANDLER_WORKERS", 4)))
+
+# seconds kept for saving state and replying after attachment uploads
+DEADLINE_RESERVE = 5
+
+# MsgTable primary key added to the event by the webhook
+MSG_KEY_FIELD = '_msg_key'
+
+# replays of the user state update when another writer won the race
+MAX_CONFLICT_RETRIES = 2
 
 
 def get_msg_type(msg):
@@ -24,107 +42,350 @@ def get_url_file_name(url):
     return urlparse(url).path.split('/')[-1]
 
 
-def save_attachments(sender_id, message):
-    attachments = []
-    fs = FileSaver()
+def save_attachments(sender_id, message, file_saver=None, deadline=None):
+    """save image & video attachments concurrently
+
+    return: (saved s3 keys in attachment order, {s3 key: thumbnail s3 key}
+             of the images with a thumbnail, number of failed saves)
+    """
+    fs = file_saver or FileSaver()
+    urls = []
+    file_paths = []
     for att in message['attachments']:
         if att['type'] in ('image', 'video'):
             url = att['payload']['url']
             file_name = get_url_file_name(att['payload']['url'])
-            file_path = os.path.join(sender_id, file_name)
-            s3_key = fs.save_s3(url, file_path)
-            attachments.append(s3_key)
-    return attachments
+            urls.append(url)
+            file_paths.append(os.path.join(sender_id, file_name))
+
+    attachments = []
+    thumbnails = {}
+    failed = 0
+    for ret in fs.batch_s3_save(urls, file_paths, deadline=deadline):
+        if ret.error is None:
+            attachments.append(ret.s3_key)
+            if ret.thumbnail_key:
+                thumbnails[ret.s3_key] = ret.thumbnail_key
+        else:
+            print("cannot save {}: {}".format(ret.url, ret.error))
+            failed += 1
+    return attachments, thumbnails, failed
 
 
 def update_user_preference(user_preference, report_data):
-    old_tags = user_preference['tags']
-    new_tags = report_data['tags']
-    for tag in set(old_tags) & set(new_tags):
-        user_preference['tags'].remove(tag)
-    user_preference['tags'] = new_tags + user_preference['tags']
+    """return: stored preference counting the completed report"""
+    return Preference(user_preference).add_report(report_data).to_dict()
 
-    target = report_data['target']
-    if target in user_preference['targets']:
-        user_preference['targets'].remove(target)
-    user_preference['targets'].insert(0, target)
-    return user_preference
 
+class ReplyClients(object):
+    """Clients shared by all messages in one invocation"""
 
-def handler(event, context):
-    sender_id = event['sender']['id']
-    message = event['message']
-    mid = message['mid']
+    def __init__(self, deadline=None):
+        self.sender = FacebookMsgSender()
+        self.msg_table = MsgTable()
+        self.report_table = ReportTable()
+        self.file_saver = FileSaver()
+        # absolute time to stop waiting for attachment uploads
+        self.deadline = deadline
 
-    # user records
-    user = User(sender_id).get_or_create()
-    context_data = user.get_state_context()
-    report_data = user.get_report_data()
-    user_preference = user.get_preference()
-    state_context = InsertStateContext(
-        user, context_data, report_data, user_preference)
 
-    # msg record
-    msg_table = MsgTable()
+class OrderedSends(object):
+    """Run sends to one recipient in background, keeping their order"""
 
-    # msg sender
-    sender = FacebookMsgSender()
-    sender.send_action(sender_id, "mark_seen")
-    sender.send_action(sender_id, "typing_on")
+    def __init__(self, sender, recipient_id):
+        self.sender = sender
+        self.recipient_id = recipient_id
+        self._last = None
+        self._futures = []
 
-    # update data
-    user_update_data = {'last_mid': mid}
-    attachments = []
+    def _submit(self, func, *args):
+        prev = self._last
+
+        def run():
+            if prev is not None:
+                # wait for the previous send, whatever its result is
+                wait([prev])
+            return func(self.recipient_id, *args)
+
+        self._last = EXECUTOR.submit(run)
+        self._futures.append(self._last)
+        return self._last
+
+    def send_action(self, action):
+        return self._submit(self.sender.send_action, action)
+
+    def send_text(self, text):
+        return self._submit(self.sender.send_text, text)
+
+    def send_reply(self, reply_msg):
+        return self._submit(self.sender.send_reply, reply_msg)
+
+    def send_batch(self, actions=None, replies=None):
+        """send actions and replies in one batch request"""
+        def post_batch(recipient_id):
+            batch = self.sender.batch()
+            for action in actions or []:
+                batch.send_action(recipient_id, action)
+            for reply_msg in replies or []:
+                batch.send_reply(recipient_id, reply_msg)
+            return batch.execute()
+        return self._submit(post_batch)
+
+    def wait(self):
+        wait(self._futures)
+        for f in self._futures:
+            if f.exception() is not None:
+                print("failed to send to {}: {}".format(
+                    self.recipient_id, f.exception()))
+        self._futures = []
+
+
+class MessageResult(object):
+    """Result of one processed message"""
+
+    def __init__(self, mid, msg_key=None):
+        self.mid = mid
+        self.msg_key = msg_key
+        self.action_data = {}
+        self.attachments = []
+        self.reply_msg = None
+        self.error = None
+
+
+def prepare_message(clients, event, sends):
+    """parse action data of one message and save its attachments
+
+    Side effects happen here, so they are not repeated when the user
+    state update is retried.
+
+    return: MessageResult
+    """
+    sender_id = event['sender']['id']
+    message = event['message']
+    result = MessageResult(message['mid'], event.get(MSG_KEY_FIELD))
 
     # parse action data
     msg_type = get_msg_type(message)
     if msg_type == 'quick_reply':
-        action_data = QuickReplyParser.parse_quick_reply_payload(
+        result.action_data = QuickReplyParser.parse_quick_reply_payload(
             message['quick_reply']['payload'])
 
     elif msg_type == 'text':
-        action_data = {
+        result.action_data = {
             'text': message['text']
         }
     elif msg_type == 'attachments':
-        attachments = save_attachments(sender_id, message)
-        saved = len(attachments)
+        result.attachments, thumbnails, failed = save_attachments(
+            sender_id, message, clients.file_saver, clients.deadline)
+        saved = len(result.attachments)
         info_text = "{} file saved.".format(saved)
-        if saved != len(message['attachments']):
+        if failed:
+            info_text += " ({} failed)".format(failed)
+        if saved + failed != len(message['attachments']):
             info_text += " (Only support image & video now)"
-        sender.send_text(sender_id, info_text)
-        action_data = {
-            'images': attachments
+        sends.send_text(info_text)
+        result.action_data = {
+            'images': result.attachments,
+            'thumbnails': thumbnails,
         }
-    else:
-        action_data = {}
+    return result
+
+
+def update_user_state(clients, session, result):
+    """apply one message to the user state tracked by session
+    """
+    user = session.user
+    context_data = user.get_state_context()
+    report_data = user.get_report_data()
+    user_preference = user.get_preference()
+    state_context = InsertStateContext(
+        user, context_data, report_data, user_preference)
 
     # update state
-    state_context.receive_context(action_data)
+    state_context.receive_context(dict(result.action_data))
     reply_msg = state_context.generate_reply()
 
+    user_update_data = {'last_mid': result.mid}
     if state_context.is_completed():
-        # store
-        rpt = ReportTable()
+        # store with the user update
         report_data = state_context.get_report().to_dict()
-        rpt.put(sender_id, report_data)
-        # update user preference
+        report_item = clients.report_table.build_item(
+            user.user_id, report_data)
+        session.add_put(clients.report_table, report_item)
+        stats = clients.report_table.stats
+        if stats is not None:
+            session.add_counts(stats, user.user_id, stats.report_counts(
+                report_item, user.get_timezone()))
+        index = clients.report_table.index
+        if index is not None:
+            for item in index.build_items(report_item):
+                session.add_put(index, item)
+        user_update_data['last_report'] = report_item['timestamp']
+        session.set(user_update_data)
+        # update user preference, clean up
         new_preference = update_user_preference(user_preference, report_data)
-        user.update_preference(new_preference)
-        # clean up
-        user.remove_attributes(['report', 'context'])
+        session.set_state({'preference': new_preference})
+        session.remove_state(['report', 'context'])
     elif state_context.is_cancelled():
+        session.set(user_update_data)
         # clean up
-        user.remove_attributes(['report', 'context'])        
+        session.remove_state(['report', 'context'])
     else:
-        # store data
-        user_update_data['context'] = json.dumps(state_context.get_context())
-        user_update_data['report'] = json.dumps(state_context.get_report().to_dict())
-        user.update_attributes(user_update_data)
+        # store data, preference is left as it is
+        session.set(user_update_data)
+        session.set_state({
+            'context': state_context.get_context(),
+            'report': state_context.get_report().to_dict(),
+        })
+
+    result.reply_msg = reply_msg
+
+
+def commit_segment(clients, user, messages):
+    """apply messages up to the first completed report and commit them
+
+    Every report is written in a transaction of its own, so one commit
+    stays within UserSession.MAX_TRANSACT_ITEMS. If another writer
+    updated the user in the meantime, the segment is replayed on the
+    fresh record.
+
+    return: (list of applied messages, commit error or None)
+    """
+    commit_error = None
+    for attempt in range(MAX_CONFLICT_RETRIES + 1):
+        session = UserSession(user)
+        segment = []
+        for ret in messages:
+            segment.append(ret)
+            try:
+                update_user_state(clients, session, ret)
+                ret.error = None
+            except Exception as e:
+                print("failed to process mid {}: {}".format(ret.mid, e))
+                ret.error = str(e)
+            if session.has_items():
+                break
+        try:
+            session.commit()
+            return segment, None
+        except ConcurrentUpdateError:
+            print("user {} updated concurrently, retry".format(user.user_id))
+            commit_error = "concurrent update"
+            user.get_or_create(refresh=True)
+        except Exception as e:
+            print("failed to save user {}: {}".format(user.user_id, e))
+            return segment, str(e)
+    return segment, commit_error
+
+
+def process_sender_messages(clients, sender_id, events):
+    """process messages of one sender in order
+
+    The user record is loaded once and the changes are committed with
+    one conditional write per completed report, see commit_segment. Sender
+    actions overlap with the user load, and msg updates overlap with the
+    reply messages.
+
+    return: list of per message result
+    """
+    sends = OrderedSends(clients.sender, sender_id)
+    sends.send_batch(actions=["mark_seen", "typing_on"])
+
+    user = User(sender_id).get_or_create()
+    messages = []
+    for event in events:
+        try:
+            messages.append(prepare_message(clients, event, sends))
+        except Exception as e:
+            mid = event['message']['mid']
+            print("failed to process mid {}: {}".format(mid, e))
+            ret = MessageResult(mid)
+            ret.error = str(e)
+            messages.append(ret)
+
+    pending = [r for r in messages if r.error is None]
+    while pending:
+        segment, commit_error = commit_segment(clients, user, pending)
+        if commit_error is not None:
+            for ret in pending:
+                if ret.error is None:
+                    ret.error = commit_error
+            break
+        pending = pending[len(segment):]
+    processed = [r for r in messages if r.error is None]
 
     # update msg attributes
-    msg_table.mark_processed(mid, saved_attachments=attachments)
+    futures = [EXECUTOR.submit(clients.msg_table.mark_processed,
+                               ret.mid, saved_attachments=ret.attachments,
+                               key=ret.msg_key)
+               for ret in processed]
 
     # send reply message
-    sender.send_action(sender_id, "typing_off")
-    sender.send_reply(sender_id, reply_msg)
+    sends.send_batch(actions=["typing_off"],
+                     replies=[ret.reply_msg for ret in processed])
+
+    wait(futures)
+    sends.wait()
+
+    results = []
+    for ret in messages:
+        if ret.error is None:
+            results.append({'mid': ret.mid, 'success': True})
+        else:
+            results.append({'mid': ret.mid, 'success': False, 'error': ret.error})
+    return results
+
+
+def batch_handler(event, context):
+    """handle messages grouped by sender
+
+    event: {"senders": [{"sender_id": ..., "messages": [...]}, ...]}
+    """
+    deadline = None
+    if context is not None:
+        remaining = context.get_remaining_time_in_millis() / 1000.0
+        deadline = time.time() + remaining - DEADLINE_RESERVE
+    clients = ReplyClients(deadline)
+    results = []
+    for group in event['senders']:
+        results += process_sender_messages(
+            clients, group['sender_id'], group['messages'])
+
+    failed = [ret for ret in results if not ret['success']]
+    metrics.count('messages', len(results))
+    if failed:
+        metrics.count('messages.failed', len(failed))
+        print("failed messages: {}".format(json.dumps(failed)))
+    return results
+
+
+def sqs_event_to_batch(event):
+    """batch_handler event of the records of a FIFO queue event
+
+    Records of one message group (sender) come in queue order.
+    """
+    groups = OrderedDict()
+    for record in event['Records']:
+        msg = json.loads(record['body'])
+        groups.setdefault(msg['sender']['id'], []).append(msg)
+    return {
+        'senders': [{'sender_id': sender_id, 'messages': messages}
+                    for sender_id, messages in groups.items()]
+    }
+
+
+@metrics.entrypoint('handler')
+def handler(event, context):
+    metrics.log_payload('event', event)
+    if 'Records' in event:
+        # REPLY_DISPATCHER=sqs on the webhook
+        event = sqs_event_to_batch(event)
+    elif 'senders' not in event:
+        # single message event
+        event = {
+            'senders': [{
+                'sender_id': event['sender']['id'],
+                'messages': [event],
+            }]
+        }
+    return batch_handler(event, context)
@@ -2,13 +2,57 @@ from __future__ import print_function
 
 import os
 import json
+import time
+import urllib
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+import metrics
+
+# session shared by warm lambda invocations
+_SESSIONS = {}
+
+
+def get_session(pool_size, retries, backoff_factor):
+    """get or create a keep-alive session with connection pool
+    """
+    key = (pool_size, retries, backoff_factor)
+    if key not in _SESSIONS:
+        # only retry requests that never reached the server, so a
+        # message cannot be sent twice
+        retry = Retry(total=retries,
+                      connect=retries,
+                      read=0,
+                      backoff_factor=backoff_factor,
+                      method_whitelist=frozenset(['GET', 'POST']))
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _SESSIONS[key] = session
+    return _SESSIONS[key]
+
 
 class FacebookMsgSender(object):
     """Send Facebook Messeage through its API
     """
 
-    FB_POST_URL = "https://graph.facebook.com/v2.8/me/messages"
+    FB_GRAPH_URL = "https://graph.facebook.com"
+    FB_API_VERSION = "v2.8"
+    FB_MSG_PATH = "me/messages"
+
+    POOL_SIZE = 4
+    # (connect, read) timeout in seconds
+    TIMEOUT = (3.05, 10)
+    RETRIES = 2
+    BACKOFF_FACTOR = 0.1
+
+    # Graph API accepts at most 50 requests in one batch
+    BATCH_SIZE = 50
+    BATCH_RETRIES = 2
 
     VALID_SENDER_ACTIONS = [
         "mark_seen",
@@ -16,10 +60,81 @@ class FacebookMsgSender(object):
         "typing_off"
     ]
 
-    def __init__(self):
+    def __init__(self, pool_size=None, timeout=None, retries=None,
+                 graph_url=None):
         self.token = os.environ["PAGE_ACCESS_TOKEN"]
+        self.pool_size = pool_size or self.POOL_SIZE
+        self.timeout = timeout or self.TIMEOUT
+        self.retries = self.RETRIES if retries is None else retries
+        self.session = get_session(
+            self.pool_size, self.retries, self.BACKOFF_FACTOR)
+
+        # FB_GRAPH_URL can point to a local stub server
+        self.graph_url = (graph_url or
+                          os.environ.get("FB_GRAPH_URL", self.FB_GRAPH_URL))
+        self.post_url = "{}/{}/{}".format(
+            self.graph_url, self.FB_API_VERSION, self.FB_MSG_PATH)
 
     def send_text(self, recipient_id, message_text, quick_replies=None):
+        data = self.text_data(recipient_id, message_text, quick_replies)
+        ret = self._post_requests(json.dumps(data))
+        return ret
+
+    def send_template(self, recipient_id, payload, quick_replies=None):
+        data = self.template_data(recipient_id, payload, quick_replies)
+        ret = self._post_requests(json.dumps(data))
+        return ret
+
+    def _post_requests(self, data):
+        headers = {
+            "Content-Type": "application/json"
+        }
+
+        params = {
+            "access_token": self.token
+        }
+        try:
+            with metrics.timer('graph.send'):
+                r = self.session.post(self.post_url,
+                                      params=params,
+                                      headers=headers,
+                                      data=data,
+                                      timeout=self.timeout)
+        except requests.RequestException as e:
+            print(e)
+            metrics.count('graph.errors')
+            return False
+        is_success = (r.status_code == 200)
+        if not is_success:
+            print(r.content)
+            metrics.count('graph.errors')
+        return is_success
+
+    def get_connection_stats(self):
+        """connection reuse counters of graph API pool
+
+        return: dict
+        """
+        adapter = self.session.get_adapter(self.post_url)
+        pool = adapter.poolmanager.connection_from_url(self.post_url)
+        return {
+            'requests': pool.num_requests,
+            'new_connections': pool.num_connections,
+            'reused_connections': max(pool.num_requests - pool.num_connections, 0),
+        }
+
+    def send_reply(self, recipient_id, data):
+        data = self.reply_data(recipient_id, data)
+        if data is None:
+            return None
+        return self._post_requests(json.dumps(data))
+
+    def send_action(self, recipient_id, action):
+        data = self.action_data(recipient_id, action)
+        ret = self._post_requests(json.dumps(data))
+        return ret
+
+    def text_data(self, recipient_id, message_text, quick_replies=None):
         if quick_replies is None:
             quick_replies = []
 
@@ -33,10 +148,9 @@ class FacebookMsgSender(object):
         }
         if len(quick_replies) > 0:
             data['message']['quick_replies'] = quick_replies
-        ret = self._post_requests(json.dumps(data))
-        return ret
+        return data
 
-    def send_template(self, recipient_id, payload):
+    def template_data(self, recipient_id, payload, quick_replies=None):
         data = {
             "recipient": {
                 "id": recipient_id
@@ -48,46 +162,200 @@ class FacebookMsgSender(object):
                 }
             }
         }
-        ret = self._post_requests(json.dumps(data))
-        return ret
-
-    def _post_requests(self, data):
-        headers = {
-            "Content-Type": "application/json"
-        }
-
-        params = {
-            "access_token": self.token
-        }
-        r = requests.post(self.FB_POST_URL,
-                          params=params,
-                          headers=headers,
-                          data=data)
-        is_success = (r.status_code == 200)
-        if not is_success:
-            print(r.content)
-        return is_success
+        if quick_replies:
+            data["message"]["quick_replies"] = quick_replies
+        return data
 
-    def send_reply(self, recipient_id, data):
+    def reply_data(self, recipient_id, data):
         if 'text' in data:
             text = data['text']
             qr = data.get('quick_replies', [])
-            return self.send_text(recipient_id, text, qr)
+            return self.text_data(recipient_id, text, qr)
         elif 'template' in data:
             payload = data['template']
-            return self.send_template(recipient_id, payload)
+            qr = data.get('quick_replies', [])
+            return self.template_data(recipient_id, payload, qr)
         else:
             return None
 
-    def send_action(self, recipient_id, action):
+    def action_data(self, recipient_id, action):
         if action not in self.VALID_SENDER_ACTIONS:
             raise ValueError("Invalid action: ", action)
 
-        data = json.dumps({
+        data = {
             "recipient": {
                 "id": recipient_id
             },
             "sender_action": action
-        })
-        ret = self._post_requests(data)
-        return ret
+        }
+        return data
+
+    def batch(self):
+        return MsgBatch(self)
+
+    def post_batch(self, data_list):
+        """post messages with Graph API batch requests
+
+        Sub requests to the same recipient depend on the previous one, so
+        they are delivered in order. Sub requests that failed on server
+        side or were not executed are retried.
+
+        data_list: list of message data dict
+
+        return: list of boolean (success or not), one per message
+        """
+        results = [False] * len(data_list)
+        pending = range(len(data_list))
+        for attempt in range(self.BATCH_RETRIES + 1):
+            if attempt > 0:
+                time.sleep(self.BACKOFF_FACTOR * (2 ** (attempt - 1)))
+            retry = []
+            # recipients with a failed send, their later sends wait for
+            # the next attempt to keep the order
+            blocked = set()
+            while pending:
+                chunk = []
+                rest = []
+                for i in pending:
+                    recipient_id = data_list[i]['recipient']['id']
+                    if recipient_id in blocked:
+                        retry.append(i)
+                    elif len(chunk) < self.BATCH_SIZE:
+                        chunk.append(i)
+                    else:
+                        rest.append(i)
+                pending = rest
+                if not chunk:
+                    break
+
+                codes = self._post_batch_chunk([data_list[i] for i in chunk])
+                for i, code in zip(chunk, codes):
+                    if code == 200:
+                        results[i] = True
+                        continue
+                    blocked.add(data_list[i]['recipient']['id'])
+                    if code is None or code >= 500 or code == 429:
+                        retry.append(i)
+            pending = sorted(retry)
+            if not pending:
+                break
+        return results
+
+    @staticmethod
+    def _form_value(value):
+        """form field of a sub request body, objects as JSON
+
+        Graph reads "sender_action=typing_on", a JSON string would keep
+        its quotes.
+        """
+        if isinstance(value, (dict, list)):
+            return json.dumps(value)
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    def _post_batch_chunk(self, data_list):
+        """post up to BATCH_SIZE messages in one request
+
+        return: list of response code, None if not executed
+        """
+        batch = []
+        last_request = {}
+        for i, data in enumerate(data_list):
+            recipient_id = data['recipient']['id']
+            body = dict((k, self._form_value(v)) for k, v in data.iteritems())
+            request = {
+                "method": "POST",
+                "name": "msg{}".format(i),
+                "relative_url": "{}/{}".format(
+                    self.FB_API_VERSION, self.FB_MSG_PATH),
+                "body": urllib.urlencode(body),
+                # named requests omit their response by default
+                "omit_response_on_success": False,
+            }
+            if recipient_id in last_request:
+                request["depends_on"] = last_request[recipient_id]
+            last_request[recipient_id] = request["name"]
+            batch.append(request)
+
+        params = {
+            "access_token": self.token,
+            "batch": json.dumps(batch),
+            "include_headers": "false",
+        }
+        try:
+            with metrics.timer('graph.batch'):
+                r = self.session.post(self.graph_url,
+                                      data=params,
+                                      timeout=self.timeout)
+        except requests.RequestException as e:
+            print(e)
+            metrics.count('graph.errors')
+            return [None] * len(data_list)
+
+        if r.status_code != 200:
+            print(r.content)
+            metrics.count('graph.errors')
+            return [None] * len(data_list)
+
+        codes = []
+        for resp in r.json():
+            if resp is None:
+                codes.append(None)
+            else:
+                if resp.get('code') != 200:
+                    print(resp.get('body'))
+                codes.append(resp.get('code'))
+        # missing responses were not executed
+        codes += [None] * (len(data_list) - len(codes))
+        return codes
+
+
+class MsgBatch(object):
+    """Collect sends and post them in Graph API batch requests
+
+    Usage:
+
+        batch = sender.batch()
+        batch.send_action(user_id, "typing_off")
+        batch.send_reply(user_id, reply_msg)
+        results = batch.execute()
+    """
+
+    def __init__(self, sender):
+        self.sender = sender
+        self._data = []
+
+    def __len__(self):
+        return len(self._data)
+
+    def _add(self, data):
+        if data is None:
+            return None
+        self._data.append(data)
+        return len(self._data) - 1
+
+    def send_text(self, recipient_id, message_text, quick_replies=None):
+        return self._add(self.sender.text_data(
+            recipient_id, message_text, quick_replies))
+
+    def send_template(self, recipient_id, payload, quick_replies=None):
+        return self._add(self.sender.template_data(
+            recipient_id, payload, quick_replies))
+
+    def send_reply(self, recipient_id, data):
+        return self._add(self.sender.reply_data(recipient_id, data))
+
+    def send_action(self, recipient_id, action):
+        return self._add(self.sender.action_data(recipient_id, action))
+
+    def execute(self):
+        """post all collected sends
+
+        return: list of boolean (success or not), indexed by the return
+                value of send_* methods
+        """
+        data, self._data = self._data, []
+        if not data:
+            return []
+        return self.sender.post_batch(data)
@@ -0,0 +1,213 @@
+from __future__ import print_function
+
+import os
+import math
+from bisect import bisect_left, insort
+from heapq import nsmallest
+
+
+class RankedNames(object):
+    """Capped list of names ranked by frequency and recency
+
+    Entries are [name, score, last], last being the clock when the name
+    was last used; the owner advances the clock once per report. Names
+    are matched case-insensitively and keep their latest spelling.
+
+    Every use weighs 2 ** (clock / HALF_LIFE), so older uses count for
+    less. The score is SCALE * log2 of the sum of these weights, an
+    integer. Future uses weigh the same for every name, so two names
+    only change order when one of them is used. The rank order is kept
+    in a sorted list, updated with a bisect per use, and the lowest name
+    is evicted from its end.
+
+    Serialized as the entries in rank order, so readers take the top-N
+    from the head without ranking again.
+    """
+
+    HALF_LIFE = 10
+    # score units per half-life
+    SCALE = 1000
+
+    def __init__(self, entries=None, clock=0, max_size=20, legacy=False):
+        """legacy: entries are [name, hits, last] of the former ranking"""
+        self.max_size = max_size
+        self.clock = int(clock)
+        self._entries = {}
+        for entry in entries or []:
+            if isinstance(entry, basestring):
+                # legacy list of names, most recent first
+                last = self.clock - len(self._entries)
+                entry = [entry, self._weight(last), last]
+            elif legacy:
+                # all hits taken as uses at last
+                hits, last = max(int(entry[1]), 1), int(entry[2])
+                score = self._weight(last) + \
+                    int(round(self.SCALE * math.log(hits, 2)))
+                entry = [entry[0], score, last]
+            name, score, last = entry[0], int(entry[1]), int(entry[2])
+            self._entries.setdefault(name.lower(), [name, score, last])
+        # (-score, -last, key), best first
+        self._order = sorted(self._sort_key(k) for k in self._entries)
+        while len(self._order) > self.max_size:
+            del self._entries[self._order.pop()[2]]
+
+    def _weight(self, clock):
+        """return: score of one use at clock"""
+        return self.SCALE * clock // self.HALF_LIFE
+
+    def _add(self, score, weight):
+        """return: score with one more use of weight"""
+        high, low = max(score, weight), min(score, weight)
+        ratio = 2 ** (float(low - high) / self.SCALE)
+        return high + int(round(self.SCALE * math.log(1 + ratio, 2)))
+
+    def _sort_key(self, key):
+        entry = self._entries[key]
+        return (-entry[1], -entry[2], key)
+
+    def tick(self):
+        self.clock += 1
+
+    def use(self, name):
+        """count one use of name, now"""
+        key = name.lower()
+        weight = self._weight(self.clock)
+        entry = self._entries.get(key)
+        if entry is None:
+            if len(self._entries) >= self.max_size:
+                # the new name is kept, whatever its rank
+                del self._entries[self._order.pop()[2]]
+            self._entries[key] = [name, weight, self.clock]
+        else:
+            sort_key = self._sort_key(key)
+            del self._order[bisect_left(self._order, sort_key)]
+            entry[:] = [name, self._add(entry[1], weight), self.clock]
+        insort(self._order, self._sort_key(key))
+
+    def to_list(self):
+        """return: entries in rank order, most recent first on ties"""
+        return [self._entries[k] for _, _, k in self._order]
+
+
+class Preference(object):
+    """Tags and targets of the reports of a user, ranked
+
+    The clock counts the completed reports. Stored in the user state
+    map as {'v': 2, 'clock': n, 'tags': [[name, score, last], ..],
+    'targets': [..]}. Records without 'v' hold [name, hits, last]
+    entries, or plain lists of names, most recent first, which are read
+    as single uses in that order.
+    """
+
+    KINDS = ('tags', 'targets')
+    VERSION = 2
+
+    def __init__(self, data=None):
+        data = data or {}
+        clock = int(data.get('clock', 0))
+        legacy = int(data.get('v', 1)) < self.VERSION
+        max_size = {
+            'tags': int(os.environ.get("PREFERENCE_MAX_TAGS", 200)),
+            'targets': int(os.environ.get("PREFERENCE_MAX_TARGETS", 20)),
+        }
+        self.ranked = dict(
+            (kind, RankedNames(data.get(kind), clock, max_size[kind], legacy))
+            for kind in self.KINDS)
+
+    def add_report(self, report_data):
+        """count the tags and target of a completed report
+
+        return: self
+        """
+        for ranked in self.ranked.values():
+            ranked.tick()
+        for tag in report_data.get('tags', []):
+            self.ranked['tags'].use(tag)
+        target = report_data.get('target')
+        if target:
+            self.ranked['targets'].use(target)
+        return self
+
+    def to_dict(self):
+        ret = dict((kind, self.ranked[kind].to_list()) for kind in self.KINDS)
+        ret['clock'] = self.ranked['tags'].clock
+        ret['v'] = self.VERSION
+        return ret
+
+
+def top_names(preference, kind, size, excludes=None):
+    """first names of a stored preference, in rank order
+
+    preference: dict of Preference.to_dict or the legacy format
+    excludes: names to skip, case-insensitive
+
+    return: list of at most size names
+    """
+    excludes = set(e.lower() for e in excludes or [])
+    names = []
+    for entry in preference.get(kind, []):
+        name = entry if isinstance(entry, basestring) else entry[0]
+        if name.lower() in excludes:
+            continue
+        names.append(name)
+        if len(names) >= size:
+            break
+    return names
+
+
+class TagIndex(object):
+    """Case-folded prefix index over the ranked tags of a user
+
+    A sorted array of folded names, bisected for the range of names
+    starting with a prefix, then the best ranked of that range. Short
+    prefixes match a large part of the array, there walking the names in
+    rank order finds the best ones sooner.
+    """
+
+    def __init__(self, entries):
+        """entries: [name, score, last] lists in rank order"""
+        folded = sorted((e[0].lower(), i, e[0]) for i, e in enumerate(entries))
+        self.keys = [f[0] for f in folded]
+        # position in the rank order, lower is better
+        self.positions = [f[1] for f in folded]
+        self.names = [f[2] for f in folded]
+        self.ranked = [(e[0].lower(), e[0]) for e in entries]
+
+    @classmethod
+    def from_preference(cls, preference):
+        """preference: dict of Preference.to_dict or the legacy format"""
+        entries = [[e, 1, 0] if isinstance(e, basestring) else e
+                   for e in preference.get('tags', [])]
+        return cls(entries)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, text):
+        """return: stored spelling of text, None if unknown"""
+        key = text.lower()
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return self.names[i]
+        return None
+
+    def complete(self, prefix, size=3, excludes=None):
+        """return: at most size names starting with prefix, best first"""
+        key = prefix.lower()
+        start = bisect_left(self.keys, key)
+        # u'\uffff' sorts after any character a tag can continue with
+        end = bisect_left(self.keys, key + u'\uffff', start)
+        excludes = set(e.lower() for e in excludes or [])
+        if (end - start) ** 2 > size * len(self.keys):
+            # about len / (end - start) names per match in rank order
+            names = []
+            for folded, name in self.ranked:
+                if folded.startswith(key) and folded not in excludes:
+                    names.append(name)
+                    if len(names) >= size:
+                        break
+            return names
+        candidates = (i for i in xrange(start, end)
+                      if self.keys[i] not in excludes)
+        best = nsmallest(size, candidates, key=self.positions.__getitem__)
+        return [self.names[i] for i in best]
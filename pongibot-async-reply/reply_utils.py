@@ -1,9 +1,7 @@
 from __future__ import print_function
 
-import pytz
-import dateutil.parser as dp
-
-LOCAL_TIMEZONE = "America/New_York"
+from timestamps import key_to_epoch, format_local_time
+from preference import top_names
 
 
 class QuickReplyGenerator(object):
@@ -14,58 +12,45 @@ class QuickReplyGenerator(object):
     SKIP_PAYLOAD = "QR_SKIP"
     INSERT_NEW_PAYLOAD = "QR_INSERT_NEW"
     RECENT_REPORT_PAYLOAD = "QR_RECENT_REPORT"
+    STATS_PAYLOAD = "QR_STATS"
+    MORE_REPORTS_PREFIX = "QR_MORE_REPORTS__"
+    MORE_SEARCH_PREFIX = "QR_MORE_SEARCH__"
 
     def __init__(self, preference):
         self.preference = preference
 
     def generate_quick_reply_tags(self, excludes=None, size=3, with_skip=False):
-        if excludes:
-            excludes = [e.lower() for e in excludes]
-        else:
-            excludes = []
-
-        quick_replies = []
-        user_tags = self.preference.get('tags', [])
-        for tag in user_tags:
-            if tag.lower() in excludes:
-                continue
-            quick_replies.append({
-                "content_type":"text",
-                "title": tag,
-                "payload": self.TAG_PREFIX + tag
-            })
-            if len(quick_replies) >= size:
-                break
-
-        if with_skip:
-            quick_replies.append(self.generate_skip_reply())
-
-        return quick_replies
+        return self._generate_quick_replies(
+            'tags', self.TAG_PREFIX, excludes, size, with_skip)
 
     def generate_quick_reply_targets(self, excludes=None, size=3, with_skip=False):
-        if excludes:
-            excludes = [e.lower() for e in excludes]
-        else:
-            excludes = []
+        return self._generate_quick_replies(
+            'targets', self.TARGET_PREFIX, excludes, size, with_skip)
+
+    def generate_tag_suggestions(self, names, typed):
+        """quick replies of the suggested tags, then the typed text"""
+        return [self._name_reply(self.TAG_PREFIX, name)
+                for name in names + [typed]]
 
+    def _generate_quick_replies(self, kind, prefix, excludes, size, with_skip):
         quick_replies = []
-        target_tags = self.preference.get('targets', [])
-        for tag in target_tags:
-            if tag.lower() in excludes:
-                continue
-            quick_replies.append({
-                "content_type":"text",
-                "title": tag,
-                "payload": self.TARGET_PREFIX + tag
-            })
-            if len(quick_replies) >= size:
-                break
+        # stored in rank order, see preference.Preference
+        for name in top_names(self.preference, kind, size, excludes):
+            quick_replies.append(self._name_reply(prefix, name))
 
         if with_skip:
             quick_replies.append(self.generate_skip_reply())
 
         return quick_replies
 
+    def _name_reply(self, prefix, name):
+        ret = {
+            "content_type":"text",
+            "title": name,
+            "payload": prefix + name
+        }
+        return ret
+
     def generate_cancel_reply(self):
         ret = {
             "content_type":"text",
@@ -82,6 +67,23 @@ class QuickReplyGenerator(object):
         }
         return ret
 
+    def generate_more_reports_reply(self, cursor):
+        ret = {
+            "content_type":"text",
+            "title": "More",
+            "payload": self.MORE_REPORTS_PREFIX + cursor
+        }
+        return ret
+
+    def generate_more_search_reply(self, cursor):
+        """"More" of a search, its cursor is one of ReportIndexTable"""
+        ret = {
+            "content_type":"text",
+            "title": "More",
+            "payload": self.MORE_SEARCH_PREFIX + cursor
+        }
+        return ret
+
     def generate_initial_menu(self):
         quick_replies = [
             {
@@ -93,6 +95,11 @@ class QuickReplyGenerator(object):
                 "content_type":"text",
                 "title": "Add report",
                 "payload": self.INSERT_NEW_PAYLOAD,
+            },
+            {
+                "content_type":"text",
+                "title": "Stats",
+                "payload": self.STATS_PAYLOAD,
             }
         ]
         return quick_replies
@@ -102,12 +109,20 @@ class QuickReplyParser(object):
 
     TAG_PREFIX = "QR_TAG__"
     TARGET_PREFIX = "QR_TARGET__"
+    MORE_REPORTS_PREFIX = "QR_MORE_REPORTS__"
+    MORE_SEARCH_PREFIX = "QR_MORE_SEARCH__"
 
     PAYLOAD_MAPPING = {
         "QR_CANCEL": "CANCEL",
         "QR_SKIP": "SKIP",
         "QR_INSERT_NEW": "INSERT_NEW",
         "QR_RECENT_REPORT": "RECENT_REPORT",
+        "QR_STATS": "STATS",
+    }
+
+    SEARCH_PREFIXES = {
+        '#': 'tag',
+        '@': 'target',
     }
 
     @classmethod
@@ -116,18 +131,38 @@ class QuickReplyParser(object):
         if payload in cls.PAYLOAD_MAPPING:
             parsed['signal'] = cls.PAYLOAD_MAPPING[payload]
         elif payload.startswith(cls.TAG_PREFIX):
-            parsed['text'] = payload.lstrip(cls.TAG_PREFIX)
+            parsed['text'] = payload[len(cls.TAG_PREFIX):]
+            # picked from the offered tags, taken as it is
+            parsed['picked'] = True
         elif payload.startswith(cls.TARGET_PREFIX):
-            parsed['text'] = payload.lstrip(cls.TARGET_PREFIX)
+            parsed['text'] = payload[len(cls.TARGET_PREFIX):]
+        elif payload.startswith(cls.MORE_REPORTS_PREFIX):
+            parsed['signal'] = "MORE_REPORTS"
+            parsed['cursor'] = payload[len(cls.MORE_REPORTS_PREFIX):]
+        elif payload.startswith(cls.MORE_SEARCH_PREFIX):
+            parsed['signal'] = "MORE_SEARCH"
+            parsed['cursor'] = payload[len(cls.MORE_SEARCH_PREFIX):]
         return parsed
 
+    @classmethod
+    def parse_search_command(cls, text):
+        """'#tag' and '@target' texts
+
+        return: {'kind': 'tag' or 'target', 'name': ..}, None otherwise
+        """
+        text = text.strip()
+        if len(text) < 2 or text[0] not in cls.SEARCH_PREFIXES:
+            return None
+        return {
+            'kind': cls.SEARCH_PREFIXES[text[0]],
+            'name': text[1:].strip(),
+        }
+
 
-def convert_to_local_time(iso_time):
-    timestamp = dp.parse(iso_time)
-    timestamp = timestamp.replace(tzinfo=pytz.UTC)
-    local = pytz.timezone(LOCAL_TIMEZONE)
-    timestamp = timestamp.astimezone(local)
-    return timestamp.strftime('%Y-%m-%d %H:%M')
+def convert_to_local_time(timestamp, timezone=None):
+    """format a range key of either TimestampBasedDDBTable format
+    """
+    return format_local_time(key_to_epoch(timestamp), timezone)
 
 
 class TemplateGenerator(object):
@@ -135,36 +170,56 @@ class TemplateGenerator(object):
     BASE_S3_URL = 'https://s3.amazonaws.com/pongibot/'
 
     @classmethod
-    def generate_reports(cls, reports):
-        elements = []
-        for report in reports:
-            tags = ['#{}'.format(t) for t in report['tags']]
-            img_url = cls.BASE_S3_URL + report['images'][0]
-            target = report.get('target')
-            local_time = convert_to_local_time(report['timestamp'])
-
-            if target:
-                title = "{} ({})".format(target, local_time)
-            else:
-                title = local_time
-
-            element = {
-                "title": title,
-                "image_url": img_url,
-                "subtitle": " ".join(tags),
-                #"default_action": {
-                #    "type": "web_url",
-                #    "url": img_url,
-                #    "messenger_extensions": True,
-                #    "webview_height_ratio": "tall"
-                #},
-            }
-            elements.append(element)
+    def generate_report_element(cls, report, timezone=None):
+        """list element of one report
 
-        payload = {
-            "template_type": "list",
-            "top_element_style": "compact",
-            "elements": elements
+        Formatted when shown, so later timezone and bucket changes apply
+        to stored reports too.
+
+        timezone: timezone of the user, LOCAL_TIMEZONE by default
+        """
+        tags = ['#{}'.format(t) for t in report['tags']]
+        target = report.get('target')
+        local_time = convert_to_local_time(report['timestamp'], timezone)
+
+        if target:
+            title = "{} ({})".format(target, local_time)
+        else:
+            title = local_time
+
+        element = {
+            "title": title,
+            "subtitle": " ".join(tags),
+            #"default_action": {
+            #    "type": "web_url",
+            #    "url": img_url,
+            #    "messenger_extensions": True,
+            #    "webview_height_ratio": "tall"
+            #},
         }
+        if report.get('images'):
+            image = report['images'][0]
+            # lists are shown on phones, the original is kept for later use
+            image = report.get('thumbnails', {}).get(image, image)
+            element["image_url"] = cls.BASE_S3_URL + image
+        return element
+
+    @classmethod
+    def generate_reports(cls, reports, timezone=None):
+        elements = [cls.generate_report_element(report, timezone)
+                    for report in reports]
+
+        if len(elements) < 2:
+            # list template needs at least two elements
+            payload = {
+                "template_type": "generic",
+                "elements": elements
+            }
+        else:
+            payload = {
+                "template_type": "list",
+                "top_element_style": "compact",
+                "elements": elements
+            }
         #print(payload)
         return payload
@@ -0,0 +1,42 @@
+"""Fixtures of the reply lambda tests
+
+The models run on the in-memory DynamoDB of tools/fakes.py.
+"""
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'tools'))
+
+TABLES = ('USER_TABLE', 'MSG_TABLE', 'REPLY_TABLE', 'REPORT_TABLE',
+          'REPORT_INDEX_TABLE', 'REPORT_STATS_TABLE')
+for name in TABLES:
+    os.environ.setdefault(name, name)
+os.environ.setdefault('S3_BUCKET', 'S3_BUCKET')
+os.environ.setdefault('PAGE_ACCESS_TOKEN', 'PAGE_ACCESS_TOKEN')
+os.environ['METRICS_ENABLED'] = '0'
+
+import fakes
+import clients
+import ddb_models
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setenv('TIMESTAMP_KEY_FORMAT', 'iso')
+    db = fakes.FakeDynamoDB(fakes.CallStats())
+    db.create_table('USER_TABLE', 'user_id')
+    db.create_table('MSG_TABLE', 'user_id', 'timestamp',
+                    indexes={'mid-index': ('mid', None)})
+    db.create_table('REPLY_TABLE', 'user_id', 'timestamp')
+    db.create_table('REPORT_TABLE', 'user_id', 'timestamp')
+    db.create_table('REPORT_INDEX_TABLE', 'key', 'timestamp')
+    db.create_table('REPORT_STATS_TABLE', 'user_id')
+    clients.set_resource('dynamodb', db)
+    for cache in (ddb_models.USER_CACHE, ddb_models.RECENT_REPORTS_CACHE,
+                  ddb_models.TAG_INDEX_CACHE):
+        cache.clear()
+    return db
@@ -0,0 +1,214 @@
+import time
+import hashlib
+
+import pytest
+
+import clients
+import file_utils
+from fakes import FakeS3Client
+from file_utils import FileSaver, ContentIndex, DeadlineExceeded
+
+PART_SIZE = 1024
+
+
+class FakeUrl(object):
+    """urlopen response reading data, delay seconds per read"""
+
+    def __init__(self, data, content_type, delay=0.0, fail_at=None):
+        self.data = data
+        self.content_type = content_type
+        self.delay = delay
+        self.fail_at = fail_at
+        self.pos = 0
+        self.closed = False
+
+    def read(self, n):
+        if self.delay:
+            time.sleep(self.delay)
+        if self.fail_at is not None and self.pos >= self.fail_at:
+            raise IOError("connection reset")
+        ret = self.data[self.pos:self.pos + n]
+        self.pos += len(ret)
+        return ret
+
+    def info(self):
+        headers = {'Content-Type': self.content_type,
+                   'Content-Length': str(len(self.data))}
+
+        class Headers(object):
+            def getheader(self, name):
+                return headers.get(name)
+        return Headers()
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    s3 = FakeS3Client()
+    clients.set_client('s3', s3)
+    monkeypatch.setattr(FileSaver, 'MIN_PART_SIZE', PART_SIZE)
+    monkeypatch.setattr(file_utils, 'CONTENT_INDEX', ContentIndex())
+    monkeypatch.setenv('THUMBNAILS', '0')
+    return s3
+
+
+class Sources(dict):
+    """{url: FakeUrl} served by urllib2.urlopen, opened urls in order"""
+
+    def __init__(self):
+        super(Sources, self).__init__()
+        self.opened = []
+
+    def urlopen(self, url, timeout=None):
+        self.opened.append(url)
+        return self[url]
+
+
+@pytest.fixture
+def sources(monkeypatch):
+    sources = Sources()
+    monkeypatch.setattr(file_utils.urllib2, 'urlopen', sources.urlopen)
+    return sources
+
+
+def body(n, seed=0):
+    return bytes(bytearray((i * 7 + seed) % 251 for i in range(n)))
+
+
+def test_batch_keeps_order_and_reports_failures(s3, sources):
+    sources['http://x/a.jpg'] = FakeUrl(body(10), 'image/jpeg', delay=0.02)
+    sources['http://x/b.mp4'] = FakeUrl(body(3000), 'video/mp4', fail_at=1024)
+    sources['http://x/c.jpg'] = FakeUrl(body(20), 'image/jpeg')
+    urls = ['http://x/a.jpg', 'http://x/b.mp4', 'http://x/c.jpg']
+    results = FileSaver().batch_s3_save(urls, ['U/a.jpg', 'U/b.mp4', 'U/c.jpg'])
+
+    assert [r.url for r in results] == urls
+    assert [r.s3_key for r in results] == \
+        ['saved_attachments/U/a.jpg', None, 'saved_attachments/U/c.jpg']
+    assert results[1].error == 'connection reset'
+    assert s3.objects['saved_attachments/U/c.jpg'][0] == body(20)
+
+
+def test_save_after_deadline_does_not_start(s3, sources):
+    sources['http://x/a.jpg'] = FakeUrl(body(10), 'image/jpeg')
+    with pytest.raises(DeadlineExceeded):
+        FileSaver().save_s3('http://x/a.jpg', 'U/a.jpg', deadline=time.time())
+    assert sources.opened == []
+
+
+def test_deadline_aborts_running_upload(s3, sources):
+    # 20 parts, a read every 50 ms
+    sources['http://x/v.mp4'] = FakeUrl(body(20 * PART_SIZE), 'video/mp4',
+                                        delay=0.05)
+    start = time.time()
+    results = FileSaver().batch_s3_save(
+        ['http://x/v.mp4'], ['U/v.mp4'], deadline=start + 0.2)
+    assert results[0].error == "deadline exceeded"
+    assert time.time() - start < 0.5
+
+    # the worker stops at its next part
+    for _ in range(100):
+        if s3.aborted:
+            break
+        time.sleep(0.01)
+    assert s3.aborted == ['upload1']
+    assert s3.uploads == {} and s3.objects == {}
+    assert sources['http://x/v.mp4'].pos < 20 * PART_SIZE
+
+
+def test_small_file_single_put(s3, sources):
+    sources['http://x/a.jpg'] = FakeUrl(body(PART_SIZE - 1), 'image/jpeg')
+    key, thumb = FileSaver().save_s3('http://x/a.jpg', 'U/a.jpg')
+    assert (key, thumb) == ('saved_attachments/U/a.jpg', None)
+    data, extra = s3.objects[key]
+    assert data == body(PART_SIZE - 1)
+    assert extra == {'ContentType': 'image/jpeg', 'ContentLength': PART_SIZE - 1}
+    assert ('s3', 'create_multipart_upload') not in s3.stats.counts
+    assert sources['http://x/a.jpg'].closed
+
+
+@pytest.mark.parametrize('size, parts', [
+    (PART_SIZE, 1), (PART_SIZE * 2, 2), (PART_SIZE * 5 // 2, 3)])
+def test_large_file_multipart(s3, sources, size, parts):
+    sources['http://x/v.mp4'] = FakeUrl(body(size), 'video/mp4')
+    key, thumb = FileSaver().save_s3('http://x/v.mp4', 'U/v.mp4')
+    assert thumb is None
+    data, extra = s3.objects[key]
+    assert data == body(size)
+    assert extra == {'ContentType': 'video/mp4'}
+    assert s3.stats.counts[('s3', 'upload_part')] == parts
+    assert ('s3', 'put_object') not in s3.stats.counts
+
+
+def test_part_size_has_s3_minimum(s3):
+    assert FileSaver(part_size=10).part_size == PART_SIZE
+    assert FileSaver(part_size=3 * PART_SIZE).part_size == 3 * PART_SIZE
+
+
+def test_failed_download_aborts_upload(s3, sources):
+    sources['http://x/v.mp4'] = FakeUrl(body(3 * PART_SIZE), 'video/mp4',
+                                        fail_at=2 * PART_SIZE)
+    with pytest.raises(IOError):
+        FileSaver().save_s3('http://x/v.mp4', 'U/v.mp4')
+    assert s3.aborted == ['upload1']
+    assert s3.objects == {}
+    assert sources['http://x/v.mp4'].closed
+
+
+def content_key(data, suffix):
+    digest = hashlib.sha256(data).hexdigest()
+    return 'saved_attachments/sha256/{}/{}{}'.format(digest[:2], digest, suffix)
+
+
+def test_content_mode_stores_once(s3, sources):
+    data = body(100)
+    sources['http://x/a.JPG'] = FakeUrl(data, 'image/jpeg')
+    sources['http://x/b.jpg'] = FakeUrl(data, 'image/jpeg')
+    saver = FileSaver(storage_mode='content')
+    key_a, _ = saver.save_s3('http://x/a.JPG', 'U/a.JPG')
+    key_b, _ = saver.save_s3('http://x/b.jpg', 'V/b.jpg')
+
+    assert key_a == key_b == content_key(data, '.jpg')
+    assert list(s3.objects) == [key_a]
+    assert s3.stats.counts[('s3', 'put_object')] == 1
+    # the second one is found in the content index
+    assert s3.stats.counts[('s3', 'head_object')] == 1
+
+
+def test_content_mode_checks_s3_on_index_miss(s3, sources):
+    data = body(100)
+    sources['http://x/a.jpg'] = FakeUrl(data, 'image/jpeg')
+    s3.objects[content_key(data, '.jpg')] = (data, {})
+    key, _ = FileSaver(storage_mode='content').save_s3('http://x/a.jpg', 'U/a.jpg')
+    assert key == content_key(data, '.jpg')
+    assert ('s3', 'put_object') not in s3.stats.counts
+    assert key in file_utils.CONTENT_INDEX
+
+
+def test_content_mode_large_file_is_copied_once(s3, sources):
+    data = body(3 * PART_SIZE)
+    sources['http://x/v.mp4'] = FakeUrl(data, 'video/mp4')
+    sources['http://x/w.mp4'] = FakeUrl(data, 'video/mp4')
+    saver = FileSaver(storage_mode='content')
+    key_v, _ = saver.save_s3('http://x/v.mp4', 'U/v.mp4')
+    key_w, _ = saver.save_s3('http://x/w.mp4', 'U/w.mp4')
+
+    # uploaded under an incoming key, then copied to the content key
+    assert key_v == key_w == content_key(data, '.mp4')
+    assert list(s3.objects) == [key_v]
+    assert s3.objects[key_v][0] == data
+    assert s3.stats.counts[('s3', 'copy_object')] == 1
+    assert s3.stats.counts[('s3', 'delete_object')] == 2
+
+
+def test_content_index_is_bounded():
+    index = ContentIndex(max_size=2)
+    for key in ('a', 'b', 'c'):
+        index.add(key)
+    assert 'a' not in index
+    assert 'b' in index
+    index.add('d')
+    # b was used last
+    assert 'b' in index and 'c' not in index
@@ -0,0 +1,89 @@
+import pytest
+
+from graph_stub import GraphStubServer
+from msg_sender import FacebookMsgSender
+
+
+class FlakyGraphStub(GraphStubServer):
+    """fails the first send of each text in fail_texts"""
+
+    def __init__(self, address, fail_texts=()):
+        GraphStubServer.__init__(self, address)
+        self.fail_texts = set(fail_texts)
+
+    def record(self, data):
+        text = data.get('message', {}).get('text')
+        if text in self.fail_texts:
+            self.fail_texts.discard(text)
+            return 500
+        return GraphStubServer.record(self, data)
+
+
+@pytest.fixture
+def graph():
+    server = FlakyGraphStub(('127.0.0.1', 0)).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def sender(graph, monkeypatch):
+    monkeypatch.setattr(FacebookMsgSender, 'BACKOFF_FACTOR', 0)
+    return FacebookMsgSender(graph_url=graph.url)
+
+
+def texts(graph, recipient_id):
+    return [m['message']['text'] for m in graph.messages
+            if m['recipient']['id'] == recipient_id and 'message' in m]
+
+
+def test_batch_fields_arrive_as_sent(graph, sender):
+    batch = sender.batch()
+    batch.send_action('U', 'typing_on')
+    batch.send_reply('U', {'text': u'caf\xe9', 'quick_replies': [
+        {'content_type': 'text', 'title': 'Skip', 'payload': 'QR_SKIP'}]})
+    assert batch.execute() == [True, True]
+
+    action, reply = graph.messages
+    assert action == {'recipient': {'id': 'U'}, 'sender_action': 'typing_on'}
+    assert reply['message']['text'] == u'caf\xe9'
+    assert reply['message']['quick_replies'][0]['payload'] == 'QR_SKIP'
+    assert graph.http_requests == 1
+
+
+def test_batch_keeps_order_per_recipient(graph, sender):
+    graph.fail_texts = {'a1'}
+    batch = sender.batch()
+    for text in ('a1', 'b1', 'a2', 'b2', 'a3'):
+        batch.send_text(text[0].upper(), text)
+    assert batch.execute() == [True] * 5
+
+    # a2 and a3 depend on a1, they wait for its retry
+    assert texts(graph, 'A') == ['a1', 'a2', 'a3']
+    assert texts(graph, 'B') == ['b1', 'b2']
+    assert graph.http_requests == 2
+
+
+def test_batch_is_chunked(graph, sender, monkeypatch):
+    monkeypatch.setattr(FacebookMsgSender, 'BATCH_SIZE', 2)
+    batch = sender.batch()
+    for i in range(5):
+        batch.send_text('U', str(i))
+    assert batch.execute() == [True] * 5
+    assert texts(graph, 'U') == ['0', '1', '2', '3', '4']
+    assert graph.http_requests == 3
+
+
+def test_batch_gives_up_after_retries(graph, sender, monkeypatch):
+    monkeypatch.setattr(FacebookMsgSender, 'BATCH_RETRIES', 0)
+    graph.fail_texts = {'a1'}
+    results = sender.post_batch([sender.text_data('A', 'a1'),
+                                 sender.text_data('A', 'a2'),
+                                 sender.text_data('B', 'b1')])
+    assert results == [False, False, True]
+    assert texts(graph, 'A') == []
+
+
+def test_empty_batch(sender):
+    assert sender.batch().execute() == []
@@ -0,0 +1,56 @@
+from ddb_models import MsgTable
+
+
+def stored_msg(db, user_id, timestamp):
+    return db.items['MSG_TABLE'].get((user_id, timestamp))
+
+
+def put_msg(db, user_id, timestamp, mid):
+    db.Table('MSG_TABLE').put_item(
+        Item={'user_id': user_id, 'timestamp': timestamp, 'mid': mid})
+    return {'user_id': user_id, 'timestamp': timestamp}
+
+
+def test_mark_processed_by_key(db):
+    key = put_msg(db, 'U', '2017-03-01T00:00:00', 'm1')
+    db.stats.reset()
+    assert MsgTable().mark_processed('m1', ['a.jpg'], key=key)
+
+    item = stored_msg(db, 'U', '2017-03-01T00:00:00')
+    assert item['attachments'] == ['a.jpg']
+    assert 'processed_timestmap' in item
+    assert db.stats.counts == {('ddb', 'update_item'): 1}
+
+
+def test_mark_processed_mid_mismatch_queries_index(db):
+    put_msg(db, 'U', '2017-03-01T00:00:00', 'm1')
+    key = put_msg(db, 'U', '2017-03-01T00:00:01', 'm2')
+    db.stats.reset()
+    # key of another message
+    assert MsgTable().mark_processed('m1', key=key)
+
+    assert 'processed_timestmap' in stored_msg(db, 'U', '2017-03-01T00:00:00')
+    assert 'processed_timestmap' not in stored_msg(db, 'U', '2017-03-01T00:00:01')
+    assert db.stats.counts[('ddb', 'query')] == 1
+
+
+def test_mark_processed_missing_key_creates_nothing(db):
+    put_msg(db, 'U', '2017-03-01T00:00:00', 'm1')
+    key = {'user_id': 'U', 'timestamp': '2017-03-01T00:00:09'}
+    assert MsgTable().mark_processed('m1', key=key)
+
+    assert stored_msg(db, 'U', '2017-03-01T00:00:09') is None
+    assert 'processed_timestmap' in stored_msg(db, 'U', '2017-03-01T00:00:00')
+
+
+def test_mark_processed_unknown_mid(db):
+    key = {'user_id': 'U', 'timestamp': '2017-03-01T00:00:09'}
+    assert not MsgTable().mark_processed('m1', key=key)
+    assert not MsgTable().mark_processed('m1')
+    assert db.items['MSG_TABLE'] == {}
+
+
+def test_mark_processed_without_key(db):
+    put_msg(db, 'U', '2017-03-01T00:00:00', 'm1')
+    assert MsgTable().mark_processed('m1')
+    assert 'processed_timestmap' in stored_msg(db, 'U', '2017-03-01T00:00:00')
@@ -0,0 +1,74 @@
+from decimal import Decimal
+
+import pytest
+
+from ddb_models import ReportTable, TimestampBasedDDBTable
+
+
+def put_reports(db, timestamps, user_id='U'):
+    table = db.Table('REPORT_TABLE')
+    for ts in timestamps:
+        table.put_item(Item={'user_id': user_id, 'timestamp': ts,
+                             'tags': ['t{}'.format(ts)], 'images': ['a', 'b']})
+
+
+@pytest.mark.parametrize('value', [
+    u'2017-03-01T12:30:00.123456', 1488371400123000, Decimal('1488371400123000'),
+])
+def test_cursor_round_trip(value):
+    cursor = TimestampBasedDDBTable.encode_cursor(value)
+    assert '=' not in cursor
+    assert TimestampBasedDDBTable.decode_cursor(cursor) == value
+
+
+@pytest.mark.parametrize('cursor', ['!!bad', 'bm90IGpzb24'])
+def test_invalid_cursor(cursor):
+    assert TimestampBasedDDBTable.decode_cursor(cursor) is None
+
+
+def test_pages_are_newest_first(db):
+    timestamps = ['2017-03-0{}T00:00:00'.format(i) for i in range(1, 6)]
+    put_reports(db, timestamps)
+    table = ReportTable()
+
+    pages = []
+    cursor = None
+    while True:
+        reports, cursor = table.load_page('U', 2, cursor)
+        pages.append([r['timestamp'] for r in reports])
+        if not cursor:
+            break
+    assert [ts for page in pages for ts in page] == timestamps[::-1]
+    assert [len(page) for page in pages[:2]] == [2, 2]
+
+
+def test_page_projection(db):
+    put_reports(db, ['2017-03-01T00:00:00'])
+    reports, cursor = ReportTable().load_page('U', 5)
+    assert cursor is None
+    assert reports[0]['images'] == ['a']
+    assert reports[0]['tags'] == ['t2017-03-01T00:00:00']
+
+
+def test_epoch_ms_pages(db, monkeypatch):
+    monkeypatch.setenv('TIMESTAMP_KEY_FORMAT', 'epoch_ms')
+    put_reports(db, [1000, 2000, 3000])
+    table = ReportTable()
+    reports, cursor = table.load_page('U', 2)
+    assert [r['timestamp'] for r in reports] == [3000, 2000]
+    reports, cursor = table.load_page('U', 2, cursor)
+    assert [r['timestamp'] for r in reports] == [1000]
+
+
+def test_cursor_of_other_key_format_restarts(db, monkeypatch):
+    monkeypatch.setenv('TIMESTAMP_KEY_FORMAT', 'epoch_ms')
+    put_reports(db, [1000, 2000])
+    cursor = TimestampBasedDDBTable.encode_cursor(u'2017-03-01T00:00:00')
+    reports, _ = ReportTable().load_page('U', 5, cursor)
+    assert [r['timestamp'] for r in reports] == [2000, 1000]
+
+
+def test_invalid_cursor_restarts(db):
+    put_reports(db, ['2017-03-01T00:00:00'])
+    reports, _ = ReportTable().load_page('U', 5, '!!bad')
+    assert len(reports) == 1
@@ -0,0 +1,82 @@
+import random
+
+from preference import RankedNames, Preference, top_names
+
+
+def names(ranked):
+    return [e[0] for e in ranked.to_list()]
+
+
+def use_all(ranked, names):
+    for name in names:
+        ranked.tick()
+        ranked.use(name)
+
+
+def test_new_name_evicts_lowest():
+    ranked = RankedNames(max_size=3)
+    use_all(ranked, ['a', 'a', 'b', 'c'])
+    ranked.tick()
+    ranked.use('d')
+    assert names(ranked) == ['a', 'd', 'c']
+
+
+def test_frequent_name_fades():
+    ranked = RankedNames(max_size=5)
+    use_all(ranked, ['old'] * 3 + ['new'])
+    assert names(ranked) == ['old', 'new']
+    use_all(ranked, ['other'] * RankedNames.HALF_LIFE * 2)
+    ranked.use('new')
+    assert names(ranked)[1:] == ['new', 'old']
+
+
+def test_case_insensitive_latest_spelling():
+    ranked = RankedNames()
+    use_all(ranked, ['Dog', 'cat', 'dog'])
+    assert names(ranked) == ['dog', 'cat']
+    assert len(ranked.to_list()) == 2
+
+
+def test_order_matches_full_sort():
+    rnd = random.Random(7)
+    ranked = RankedNames(max_size=30)
+    for _ in range(500):
+        if rnd.random() < 0.3:
+            ranked.tick()
+        ranked.use('t{}'.format(rnd.randint(0, 60)))
+        entries = ranked.to_list()
+        assert len(entries) <= 30
+        assert entries == sorted(entries, key=lambda e: (-e[1], -e[2], e[0]))
+
+
+def test_load_caps_and_keeps_order():
+    ranked = RankedNames(max_size=10)
+    use_all(ranked, ['t{}'.format(i % 7) for i in range(30)])
+    loaded = RankedNames(ranked.to_list(), ranked.clock, max_size=4)
+    assert loaded.to_list() == ranked.to_list()[:4]
+
+
+def test_legacy_entries():
+    # [name, hits, last] of the former ranking
+    ranked = RankedNames([['a', 1, 9], ['b', 8, 5]], clock=9, legacy=True)
+    assert names(ranked) == ['b', 'a']
+    # plain names, most recent first
+    ranked = RankedNames(['x', 'y'], clock=3)
+    assert names(ranked) == ['x', 'y']
+
+
+def test_preference_round_trip():
+    preference = Preference()
+    preference.add_report({'tags': ['Dog', 'cat'], 'target': 'Bob'})
+    preference.add_report({'tags': ['dog']})
+    data = preference.to_dict()
+    assert data['v'] == Preference.VERSION and data['clock'] == 2
+    assert top_names(data, 'tags', 5) == ['dog', 'cat']
+    assert top_names(data, 'targets', 5, excludes=['bob']) == []
+    assert Preference(data).to_dict() == data
+
+
+def test_legacy_preference():
+    data = {'tags': ['dog', 'cat'], 'targets': ['bob']}
+    preference = Preference(data).add_report({'tags': ['cat']})
+    assert top_names(preference.to_dict(), 'tags', 5) == ['cat', 'dog']
@@ -0,0 +1,29 @@
+import pytest
+
+from reply_utils import QuickReplyGenerator, QuickReplyParser
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('#cat', {'kind': 'tag', 'name': 'cat'}),
+    ('@Bob', {'kind': 'target', 'name': 'Bob'}),
+    ('  #big dog ', {'kind': 'tag', 'name': 'big dog'}),
+    ('# cat', {'kind': 'tag', 'name': 'cat'}),
+    (u'#\uace0\uc591\uc774', {'kind': 'tag', 'name': u'\uace0\uc591\uc774'}),
+])
+def test_search_command(text, expected):
+    assert QuickReplyParser.parse_search_command(text) == expected
+
+
+@pytest.mark.parametrize('text', ['#', ' @ ', '', 'cat', 'cat #dog', '!cat'])
+def test_not_search_command(text):
+    assert QuickReplyParser.parse_search_command(text) is None
+
+
+def test_more_payloads_are_told_apart():
+    qr = QuickReplyGenerator({'tags': [], 'targets': []})
+    reports = qr.generate_more_reports_reply('abc')['payload']
+    search = qr.generate_more_search_reply('abc')['payload']
+    assert QuickReplyParser.parse_quick_reply_payload(reports) == \
+        {'signal': 'MORE_REPORTS', 'cursor': 'abc'}
+    assert QuickReplyParser.parse_quick_reply_payload(search) == \
+        {'signal': 'MORE_SEARCH', 'cursor': 'abc'}
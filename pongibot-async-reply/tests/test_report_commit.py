@@ -0,0 +1,79 @@
+import pytest
+
+import lambda_handler
+from ddb_models import User, UserSession, ReportTable
+from insert_states import ReportData
+
+
+def report(tags, target='Bob'):
+    return {'user_id': 'U', 'tags': tags, 'target': target, 'images': []}
+
+
+def add_report(session, reports, data):
+    item = reports.build_item('U', data)
+    session.add_put(reports, item)
+    session.add_counts(reports.stats, 'U', reports.stats.report_counts(item))
+    for index_item in reports.index.build_items(item):
+        session.add_put(reports.index, index_item)
+
+
+def test_counts_of_one_item_are_merged(db):
+    reports = ReportTable()
+    session = UserSession(User('U').get_or_create())
+    session.set({'last_mid': 'm1'})
+    add_report(session, reports, report(['cat']))
+    add_report(session, reports, report(['cat', 'dog']))
+    session.commit()
+
+    stats = reports.stats.get_summary('U')
+    assert stats['total'] == 2
+    assert stats['tag'] == {'cat': 2, 'dog': 1}
+    assert stats['target'] == {'bob': 2}
+    assert db.stats.counts[('ddb', 'transact_write_items')] == 1
+
+
+def test_report_with_most_tags_fits(db):
+    reports = ReportTable()
+    session = UserSession(User('U').get_or_create())
+    tags = ['t{}'.format(i) for i in range(ReportData.MAX_TAGS)]
+    add_report(session, reports, report(tags))
+    session.commit()
+    assert len(db.items['REPORT_INDEX_TABLE']) == ReportData.MAX_TAGS + 1
+
+
+def test_oversized_commit_writes_nothing(db):
+    reports = ReportTable()
+    session = UserSession(User('U').get_or_create())
+    session.set({'last_mid': 'm1'})
+    add_report(session, reports, report(
+        ['t{}'.format(i) for i in range(UserSession.MAX_TRANSACT_ITEMS)]))
+    with pytest.raises(ValueError):
+        session.commit()
+    for name in ('USER_TABLE', 'REPORT_TABLE', 'REPORT_INDEX_TABLE',
+                 'REPORT_STATS_TABLE'):
+        assert not db.items[name]
+
+
+def test_segments_end_at_reports(db, monkeypatch):
+    reports = ReportTable()
+    user = User('U').get_or_create()
+
+    def update_user_state(clients, session, result):
+        session.set({'last_mid': result.mid})
+        if result.mid.startswith('done'):
+            add_report(session, reports, report(['cat']))
+
+    monkeypatch.setattr(lambda_handler, 'update_user_state', update_user_state)
+    messages = [lambda_handler.MessageResult(mid)
+                for mid in ('m1', 'done1', 'm2', 'done2', 'm3')]
+    segments = []
+    pending = messages
+    while pending:
+        segment, error = lambda_handler.commit_segment(None, user, pending)
+        assert error is None
+        segments.append([ret.mid for ret in segment])
+        pending = pending[len(segment):]
+
+    assert segments == [['m1', 'done1'], ['m2', 'done2'], ['m3']]
+    assert reports.stats.get_summary('U')['total'] == 2
+    assert db.items['USER_TABLE'][('U',)]['version'] == 3
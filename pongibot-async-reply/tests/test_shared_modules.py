@@ -0,0 +1,16 @@
+import filecmp
+import os
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_FOLDER = os.path.dirname(HERE)
+WEBHOOK_FOLDER = os.path.join(
+    os.path.dirname(LAMBDA_FOLDER), 'pongibot', 'chalicelib')
+
+
+@pytest.mark.parametrize('module', ['cache.py', 'clients.py', 'metrics.py'])
+def test_shared_module_is_identical(module):
+    # create_lambda.sh refuses to deploy diverged copies
+    assert filecmp.cmp(os.path.join(LAMBDA_FOLDER, module),
+                       os.path.join(WEBHOOK_FOLDER, module), shallow=False)
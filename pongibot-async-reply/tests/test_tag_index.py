@@ -0,0 +1,60 @@
+import ddb_models
+from cache import LRUCache
+from ddb_models import User, UserSession
+from preference import Preference, TagIndex
+
+
+def index_of(*names):
+    return TagIndex([[name, 0, 0] for name in names])
+
+
+def brute_complete(names, prefix, size, excludes=()):
+    excludes = set(e.lower() for e in excludes)
+    return [n for n in names
+            if n.lower().startswith(prefix.lower())
+            and n.lower() not in excludes][:size]
+
+
+def test_lookup_keeps_spelling():
+    index = index_of('Dog', 'cat')
+    assert index.lookup('DOG') == 'Dog'
+    assert index.lookup('do') is None
+    assert len(index) == 2
+
+
+def test_complete_best_first():
+    index = index_of('catnip', 'dog', 'cats', 'Cat', 'c')
+    assert index.complete('ca') == ['catnip', 'cats', 'Cat']
+    assert index.complete('CAT', size=2, excludes=['catnip']) == ['cats', 'Cat']
+    assert index.complete('x') == []
+
+
+def test_both_scans_agree():
+    names = ['t{}'.format(i) for i in range(300)] + ['a', 'b']
+    index = index_of(*names)
+    # 't' matches most names and walks the rank order, 't1' bisects
+    for prefix in ('t', 't1', 't29', 'a', ''):
+        for excludes in ((), ('t0', 't10', 't100')):
+            assert index.complete(prefix, 5, excludes) == \
+                brute_complete(names, prefix, 5, excludes)
+
+
+def test_user_index_follows_preference(db):
+    user = User('U').get_or_create()
+    assert len(user.get_tag_index()) == 0
+
+    preference = Preference(user.get_preference())
+    preference.add_report({'tags': ['Dog']})
+    user.update_preference(preference.to_dict())
+    assert user.get_tag_index().lookup('dog') == 'Dog'
+    # kept until the preference clock moves
+    assert user.get_tag_index() is user.get_tag_index()
+
+
+def test_index_cache_evicts_oldest(db, monkeypatch):
+    monkeypatch.setattr(ddb_models, 'TAG_INDEX_CACHE', LRUCache(max_size=2))
+    users = [User(u).get_or_create() for u in ('A', 'B', 'C')]
+    indexes = [u.get_tag_index() for u in users]
+    assert ddb_models.TAG_INDEX_CACHE.stats()['evictions'] == 1
+    assert users[2].get_tag_index() is indexes[2]
+    assert users[0].get_tag_index() is not indexes[0]
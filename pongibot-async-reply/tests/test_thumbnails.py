@@ -0,0 +1,66 @@
+from io import BytesIO
+
+import pytest
+
+Image = pytest.importorskip('PIL.Image')
+
+import thumbnails
+from thumbnail_bench import synthetic_photo
+
+
+def open_thumbnail(data, **kwargs):
+    out = thumbnails.make_thumbnail(data, **kwargs)
+    assert out is not None
+    img = Image.open(BytesIO(out))
+    assert img.format == 'JPEG'
+    return img
+
+
+def encode(img, image_format, **kwargs):
+    out = BytesIO()
+    img.save(out, image_format, **kwargs)
+    return out.getvalue()
+
+
+def test_jpeg_is_rotated_and_stripped():
+    # the EXIF orientation of the photo turns it to portrait
+    img = open_thumbnail(synthetic_photo(800, 600, 'JPEG'))
+    assert img.size == (240, 320)
+    assert 'exif' not in img.info
+    assert 'icc_profile' not in img.info
+
+
+@pytest.mark.parametrize('width, height', [(1000, 32), (32, 1000), (48, 32)])
+def test_size_is_bound(width, height):
+    img = open_thumbnail(synthetic_photo(width, height, 'PNG'), size=64)
+    assert max(img.size) == min(64, max(width, height))
+
+
+def test_transparent_png_on_white():
+    data = encode(Image.new('RGBA', (500, 100), (0, 0, 0, 0)), 'PNG')
+    img = open_thumbnail(data)
+    assert img.mode == 'RGB'
+    assert img.getpixel((5, 5)) == (255, 255, 255)
+
+
+def test_palette_gif():
+    data = encode(Image.new('P', (64, 64), 3), 'GIF')
+    assert open_thumbnail(data, size=32).size == (32, 32)
+
+
+def test_not_an_image():
+    assert thumbnails.make_thumbnail(b'not an image') is None
+    truncated = synthetic_photo(200, 200, 'PNG')[:200]
+    assert thumbnails.make_thumbnail(truncated) is None
+
+
+def test_too_many_pixels(monkeypatch):
+    monkeypatch.setattr(thumbnails, 'MAX_DECODE_PIXELS', 100 * 100)
+    assert thumbnails.make_thumbnail(synthetic_photo(200, 200, 'PNG')) is None
+    # JPEGs are measured after the draft decode
+    assert thumbnails.make_thumbnail(
+        synthetic_photo(800, 800, 'JPEG'), size=64) is not None
+
+
+def test_thumbnail_key_keeps_extension():
+    assert thumbnails.thumbnail_key('a/b.png') != thumbnails.thumbnail_key('a/b.jpg')
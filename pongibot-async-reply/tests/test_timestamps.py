@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+import timestamps
+from timestamps import (EPOCH_SEQ_SIZE, epoch_key, parse_iso_timestamp,
+                        key_to_epoch, get_timezone, format_local_time)
+from backfill_timestamp_keys import convert_key
+
+EPOCH = 1577934245  # 2020-01-02 03:04:05 UTC
+
+
+@pytest.fixture(autouse=True)
+def timezones(monkeypatch):
+    monkeypatch.setattr(timestamps, '_TIMEZONES', {})
+
+
+def test_epoch_key():
+    dt = datetime(2020, 1, 2, 3, 4, 5, 678901)
+    assert epoch_key(dt) == EPOCH * 1000 * EPOCH_SEQ_SIZE + 678901
+    assert epoch_key(dt.replace(microsecond=0)) == EPOCH * 1000 * EPOCH_SEQ_SIZE
+
+
+def test_epoch_keys_keep_iso_order():
+    dt = datetime(2020, 1, 2, 3, 4, 5, 999999)
+    later = [dt + timedelta(microseconds=i) for i in range(3)]
+    keys = [epoch_key(d) for d in later]
+    assert keys == sorted(keys)
+    assert len(set(keys)) == 3
+
+
+def test_parse_iso_timestamp():
+    assert parse_iso_timestamp('2020-01-02T03:04:05.678901') == \
+        datetime(2020, 1, 2, 3, 4, 5, 678901)
+    assert parse_iso_timestamp('2020-01-02T03:04:05') == \
+        datetime(2020, 1, 2, 3, 4, 5)
+    with pytest.raises(ValueError):
+        parse_iso_timestamp('2020-01-02 03:04:05')
+
+
+def test_key_to_epoch_of_both_formats():
+    iso = '2020-01-02T03:04:05.5'
+    number = epoch_key(parse_iso_timestamp(iso))
+    assert key_to_epoch(iso) == EPOCH + 0.5
+    assert key_to_epoch(number) == EPOCH + 0.5
+    # keys read back from DynamoDB are Decimal
+    assert key_to_epoch(Decimal(number)) == EPOCH + 0.5
+
+
+def test_convert_key():
+    iso = '2020-01-02T03:04:05.678901'
+    assert convert_key(iso) == EPOCH * 1000 * EPOCH_SEQ_SIZE + 678901
+    assert convert_key(u'2020-01-02T03:04:05') == EPOCH * 1000 * EPOCH_SEQ_SIZE
+    # already converted
+    assert convert_key(Decimal(12345)) == Decimal(12345)
+
+
+@pytest.mark.parametrize('name, minutes', [
+    (-7, -420),
+    (5.5, 330),
+    ('-7', -420),
+    ('5.5', 330),
+    (0, 0),
+])
+def test_get_timezone_of_offset(name, minutes):
+    tz = get_timezone(name)
+    assert tz.utcoffset(datetime(2020, 1, 1)) == timedelta(minutes=minutes)
+
+
+def test_get_timezone_of_name():
+    assert get_timezone('Asia/Seoul').zone == 'Asia/Seoul'
+
+
+@pytest.mark.parametrize('name', [None, '', 'Nowhere/Atlantis', 'nan', 1e9])
+def test_get_timezone_falls_back_to_local(name):
+    assert get_timezone(name).zone == timestamps.LOCAL_TIMEZONE
+
+
+def test_get_timezone_is_cached():
+    assert get_timezone(-7) is get_timezone(-7)
+    assert get_timezone() is get_timezone('')
+
+
+def test_format_local_time():
+    assert format_local_time(EPOCH, 'UTC') == '2020-01-02 03:04'
+    assert format_local_time(EPOCH, 9) == '2020-01-02 12:04'
+    assert format_local_time(EPOCH, 'America/New_York') == '2020-01-01 22:04'
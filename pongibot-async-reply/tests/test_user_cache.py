@@ -0,0 +1,97 @@
+import pytest
+
+import cache
+from ddb_models import User, UserSession, USER_CACHE, \
+    ConcurrentUpdateError, cache_from_env
+
+
+class Clock(object):
+    """stands in for the time module of cache.py"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def get_items(db):
+    return db.stats.counts.get(('ddb', 'get_item'), 0)
+
+
+def create_user(db, user_id='U', **attrs):
+    item = dict(attrs, user_id=user_id, version=1)
+    db.Table('USER_TABLE').put_item(Item=item)
+
+
+def test_repeat_reads_hit_cache(db):
+    create_user(db, name='a')
+    assert User('U').get_or_create().current_data['name'] == 'a'
+    assert User('U').get_or_create().current_data['name'] == 'a'
+    assert get_items(db) == 1
+    assert USER_CACHE.stats()['hits'] == 1
+
+
+def test_cached_data_is_a_copy(db):
+    create_user(db, state={'v': 1, 'context': {}})
+    user = User('U').get_or_create()
+    user.get_state_map()['context']['x'] = 1
+    assert User('U').get_or_create().get_state_context() == {}
+
+
+def test_entries_expire(db, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, 'time', clock)
+    create_user(db)
+    User('U').get_or_create()
+    clock.now += USER_CACHE.ttl - 1
+    User('U').get_or_create()
+    assert get_items(db) == 1
+    clock.now += 2
+    User('U').get_or_create()
+    assert get_items(db) == 2
+
+
+def test_commit_writes_through(db):
+    create_user(db)
+    session = UserSession(User('U').get_or_create())
+    session.set({'name': 'b'})
+    session.commit()
+
+    data = User('U').get_or_create().current_data
+    assert (data['name'], data['version']) == ('b', 2)
+    assert get_items(db) == 1
+
+
+def test_update_attributes_writes_through(db):
+    create_user(db, name='a', old=1)
+    user = User('U').get_or_create()
+    user.update_attributes({'name': 'c'}, removes=['old'])
+    data = User('U').get_or_create().current_data
+    assert data['name'] == 'c' and 'old' not in data
+    assert get_items(db) == 1
+
+
+def test_conflict_drops_entry(db):
+    create_user(db)
+    stale = User('U').get_or_create()
+    # written by another container
+    db.Table('USER_TABLE').update_item(
+        Key={'user_id': 'U'}, UpdateExpression='SET version = :v',
+        ExpressionAttributeValues={':v': 5})
+    session = UserSession(stale)
+    session.set({'name': 'd'})
+    with pytest.raises(ConcurrentUpdateError):
+        session.commit()
+    assert USER_CACHE.get('U') is None
+    assert User('U').get_or_create().get_version() == 5
+
+
+def test_caches_are_sized_separately(monkeypatch):
+    monkeypatch.setenv('USER_CACHE_SIZE', '10')
+    monkeypatch.setenv('USER_CACHE_TTL', '20')
+    monkeypatch.setenv('TAG_INDEX_CACHE_SIZE', '30')
+    tags = cache_from_env('TAG_INDEX_CACHE')
+    reports = cache_from_env('RECENT_REPORTS_CACHE')
+    assert (tags.max_size, tags.ttl) == (30, 20)
+    assert (reports.max_size, reports.ttl) == (10, 20)
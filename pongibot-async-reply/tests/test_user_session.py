@@ -0,0 +1,139 @@
+import pytest
+
+import lambda_handler
+from ddb_models import User, UserSession, ReportTable, ConcurrentUpdateError
+
+
+def stored_user(db, user_id='U'):
+    return db.items['USER_TABLE'].get((user_id,))
+
+
+def test_commit_creates_user(db):
+    user = User('U').get_or_create()
+    session = UserSession(user)
+    session.set({'last_mid': 'm1'})
+    session.set_state({'context': {'STATE_CODE': 'INIT'}})
+    assert session.commit()
+
+    item = stored_user(db)
+    assert item['version'] == 1
+    assert item['last_mid'] == 'm1'
+    assert item['state']['context'] == {'STATE_CODE': 'INIT'}
+    assert not session.is_dirty()
+
+
+def test_commit_writes_state_fields(db):
+    session = UserSession(User('U').get_or_create())
+    session.set_state({'context': {'STATE_CODE': 'INIT'}, 'report': {}})
+    session.commit()
+
+    session = UserSession(User('U').get_or_create())
+    session.set_state({'context': {'STATE_CODE': 'TAG_ADDED'}})
+    session.remove_state(['report'])
+    session.commit()
+
+    item = stored_user(db)
+    assert item['version'] == 2
+    assert item['state'] == {'v': User.STATE_SCHEMA_VERSION,
+                             'context': {'STATE_CODE': 'TAG_ADDED'}}
+
+
+def test_commit_migrates_legacy_attributes(db):
+    db.Table('USER_TABLE').put_item(Item={
+        'user_id': 'U', 'context': '{"STATE_CODE": "INIT"}',
+        'preference': '{"tags": ["dog"], "targets": []}'})
+    user = User('U').get_or_create()
+    session = UserSession(user)
+    session.set_state({'report': {'tags': []}})
+    session.commit()
+
+    item = stored_user(db)
+    assert 'context' not in item and 'preference' not in item
+    assert item['state']['context'] == {'STATE_CODE': 'INIT'}
+    assert item['state']['preference']['tags'] == ['dog']
+
+
+def test_concurrent_commit_is_rejected(db):
+    session = UserSession(User('U').get_or_create())
+    session.set({'a': 1})
+    session.commit()
+
+    mine = User('U').get_or_create()
+    theirs = User('U').get_or_create(refresh=True)
+    session = UserSession(theirs)
+    session.set({'b': 2})
+    session.commit()
+
+    session = UserSession(mine)
+    session.set({'c': 3})
+    with pytest.raises(ConcurrentUpdateError):
+        session.commit()
+    item = stored_user(db)
+    assert item['version'] == 2
+    assert 'c' not in item
+
+    # the cached record is dropped, the retry sees the other write
+    mine.get_or_create(refresh=True)
+    session = UserSession(mine)
+    session.set({'c': 3})
+    session.commit()
+    item = stored_user(db)
+    assert (item['version'], item['b'], item['c']) == (3, 2, 3)
+
+
+def test_rejected_transaction_writes_nothing(db):
+    reports = ReportTable()
+    session = UserSession(User('U').get_or_create())
+    session.set({'a': 1})
+    session.add_put(reports, {'user_id': 'U', 'timestamp': '1'})
+    session.commit()
+
+    # the report key is taken by another writer
+    user = User('U').get_or_create()
+    session = UserSession(user)
+    session.set({'a': 2})
+    session.add_put(reports, {'user_id': 'U', 'timestamp': '1'})
+    with pytest.raises(ConcurrentUpdateError):
+        session.commit()
+    assert stored_user(db)['a'] == 1
+    assert len(db.items['REPORT_TABLE']) == 1
+
+
+def test_commit_segment_replays_on_conflict(db, monkeypatch):
+    user = User('U').get_or_create()
+    applied = []
+
+    def update_user_state(clients, session, result):
+        applied.append(result.mid)
+        if len(applied) == 1:
+            # another writer wins the race of the first attempt
+            other = UserSession(User('U').get_or_create(refresh=True))
+            other.set({'other': True})
+            other.commit()
+        session.set({'last_mid': result.mid})
+
+    monkeypatch.setattr(lambda_handler, 'update_user_state', update_user_state)
+    messages = [lambda_handler.MessageResult('m1')]
+    segment, error = lambda_handler.commit_segment(None, user, messages)
+
+    assert (segment, error) == (messages, None)
+    assert applied == ['m1', 'm1']
+    item = stored_user(db)
+    assert (item['other'], item['last_mid']) == (True, 'm1')
+
+
+def test_commit_segment_gives_up_after_retries(db, monkeypatch):
+    user = User('U').get_or_create()
+
+    def update_user_state(clients, session, result):
+        other = UserSession(User('U').get_or_create(refresh=True))
+        other.set({'other': True})
+        other.commit()
+        session.set({'last_mid': result.mid})
+
+    monkeypatch.setattr(lambda_handler, 'update_user_state', update_user_state)
+    messages = [lambda_handler.MessageResult('m1')]
+    segment, error = lambda_handler.commit_segment(None, user, messages)
+
+    assert error == "concurrent update"
+    assert 'last_mid' not in stored_user(db)
@@ -0,0 +1,81 @@
+from __future__ import print_function
+
+import os
+import threading
+from io import BytesIO
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    # thumbnails are skipped, templates show the originals
+    Image = None
+
+# longest side of the thumbnails, in pixels
+THUMBNAIL_SIZE = int(os.environ.get("THUMBNAIL_SIZE", 320))
+THUMBNAIL_QUALITY = int(os.environ.get("THUMBNAIL_QUALITY", 70))
+THUMBNAIL_SUFFIX = '.thumb.jpg'
+
+# decoded images hold width * height * 4 bytes at most, JPEGs are
+# decoded at a reduced scale first, see make_thumbnail
+MAX_DECODE_PIXELS = int(os.environ.get("THUMBNAIL_MAX_DECODE_PIXELS", 8 * 1000 * 1000))
+
+# concurrent decodes, each one can hold MAX_DECODE_PIXELS * 4 bytes
+_DECODE_SLOTS = threading.BoundedSemaphore(
+    int(os.environ.get("THUMBNAIL_WORKERS", 1)))
+
+
+def enabled():
+    return Image is not None and os.environ.get("THUMBNAILS", "1") != "0"
+
+
+def thumbnail_key(s3_key):
+    """key of the thumbnail stored next to s3_key
+
+    The original extension is kept, a.jpg and a.png of one folder get
+    distinct thumbnails.
+    """
+    return s3_key + THUMBNAIL_SUFFIX
+
+
+def make_thumbnail(data, size=None, quality=None):
+    """re-encode image bytes as a small JPEG without metadata
+
+    JPEG sources use draft mode, which decodes them directly at 1/2 to
+    1/8 scale, so a 12 MP photo never exists in memory at full size.
+    EXIF orientation is applied, then EXIF, ICC and comments are dropped
+    by saving the pixels only.
+
+    return: JPEG bytes, None if data is not an image that can be decoded
+            within MAX_DECODE_PIXELS
+    """
+    size = size or THUMBNAIL_SIZE
+    quality = quality or THUMBNAIL_QUALITY
+    with _DECODE_SLOTS:
+        try:
+            img = Image.open(BytesIO(data))
+            if img.format == 'JPEG':
+                img.draft('RGB', (size, size))
+            width, height = img.size
+            if width * height > MAX_DECODE_PIXELS:
+                print("image too large for a thumbnail: {}x{}".format(
+                    width, height))
+                return None
+            img = ImageOps.exif_transpose(img)
+            if img.mode not in ('RGB', 'RGBA'):
+                # palette images are only resized with NEAREST
+                transparent = img.mode == 'LA' or 'transparency' in img.info
+                img = img.convert('RGBA' if transparent else 'RGB')
+            img.thumbnail((size, size), Image.ANTIALIAS)
+            if img.mode == 'RGBA':
+                flat = Image.new('RGB', img.size, (255, 255, 255))
+                flat.paste(img, mask=img.split()[3])
+                img = flat
+
+            out = BytesIO()
+            img.save(out, 'JPEG', quality=quality, optimize=True,
+                     progressive=True)
+            return out.getvalue()
+        except (IOError, ValueError, SyntaxError) as e:
+            # not an image, truncated, or an unsupported format
+            print("cannot make thumbnail: {}".format(e))
+            return None
@@ -0,0 +1,81 @@
+from __future__ import print_function
+
+import os
+import calendar
+from decimal import Decimal
+from datetime import datetime
+
+# default timezone of users without one
+LOCAL_TIMEZONE = os.environ.get("LOCAL_TIMEZONE", "America/New_York")
+
+# epoch_ms range keys are epoch milliseconds * EPOCH_SEQ_SIZE + sequence
+# of the writes within that millisecond
+EPOCH_SEQ_SIZE = 1000
+
+_TIMEZONES = {}
+
+
+def epoch_key(dt):
+    """epoch_ms range key of a naive UTC datetime
+
+    Microseconds fill the sequence part, so distinct iso keys stay
+    distinct.
+    """
+    seconds = calendar.timegm(dt.timetuple())
+    return seconds * 1000 * EPOCH_SEQ_SIZE + dt.microsecond
+
+
+def parse_iso_timestamp(iso_time):
+    """naive datetime of an iso range key (stored as UTC)"""
+    if '.' in iso_time:
+        return datetime.strptime(iso_time, '%Y-%m-%dT%H:%M:%S.%f')
+    return datetime.strptime(iso_time, '%Y-%m-%dT%H:%M:%S')
+
+
+def key_to_epoch(key):
+    """return: epoch seconds (float) of a range key of either format"""
+    if isinstance(key, (int, long, Decimal)):
+        return float(key) / (1000 * EPOCH_SEQ_SIZE)
+    dt = parse_iso_timestamp(key)
+    return calendar.timegm(dt.timetuple()) + dt.microsecond / 1e6
+
+
+def get_timezone(name=None):
+    """cached pytz timezone, LOCAL_TIMEZONE by default
+
+    name: zone name, or UTC offset in hours as in the Graph API user
+          profile (-7, 5.5). Unknown values fall back to LOCAL_TIMEZONE.
+    """
+    if name is None or name == '':
+        name = LOCAL_TIMEZONE
+    tz = _TIMEZONES.get(name)
+    if tz is None:
+        # pytz loads its zone list on import, only pay it when rendering
+        import pytz
+        try:
+            offset = _utc_offset(name)
+            if offset is not None:
+                tz = pytz.FixedOffset(int(round(offset * 60)))
+            else:
+                tz = pytz.timezone(name)
+        except (pytz.UnknownTimeZoneError, AttributeError, ValueError,
+                OverflowError):
+            print("unknown timezone: {}".format(name))
+            tz = pytz.timezone(LOCAL_TIMEZONE)
+        _TIMEZONES[name] = tz
+    return tz
+
+
+def _utc_offset(name):
+    """return: offset in hours of a number or numeric text, None otherwise"""
+    try:
+        return float(name)
+    except (TypeError, ValueError):
+        return None
+
+
+def format_local_time(epoch, timezone=None):
+    """epoch seconds as 'YYYY-mm-dd HH:MM' in the given timezone"""
+    local = datetime.fromtimestamp(epoch, get_timezone(timezone))
+    return '%04d-%02d-%02d %02d:%02d' % (
+        local.year, local.month, local.day, local.hour, local.minute)
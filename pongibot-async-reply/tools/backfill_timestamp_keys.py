@@ -0,0 +1,145 @@
+"""Copy timestamp keyed tables to tables with epoch_ms range keys
+
+DynamoDB cannot change the type of a key attribute, so MsgTable,
+ReplyTable, ReportTable and ReportIndexTable rows are copied from the old
+table (iso string range key) to a new one with a number range key of the
+same name. Index rows are keyed by the timestamp of their report, copy
+them too or tag and target lists would page past the converted reports:
+
+    python tools/backfill_timestamp_keys.py --copy OLD_MSG_TABLE NEW_MSG_TABLE
+    python tools/backfill_timestamp_keys.py --copy OLD_REPLY_TABLE NEW_REPLY_TABLE
+    python tools/backfill_timestamp_keys.py --copy OLD_REPORT_TABLE NEW_REPORT_TABLE
+    python tools/backfill_timestamp_keys.py --copy OLD_REPORT_INDEX_TABLE NEW_REPORT_INDEX_TABLE
+    python tools/backfill_timestamp_keys.py --users USER_TABLE
+
+--users converts the last_report attribute of the user records. Rows and
+users already using number keys are left as they are, so every step can
+be re-run. Switch TIMESTAMP_KEY_FORMAT=epoch_ms on both lambdas after the
+copy, pointing them to the new tables.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import threading
+from functools import partial
+
+import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from timestamps import epoch_key, parse_iso_timestamp
+
+RANGE_KEY = 'timestamp'
+
+
+def convert_key(value):
+    """return: epoch_ms key of an iso key, value itself if already a number"""
+    if isinstance(value, basestring):
+        return epoch_key(parse_iso_timestamp(value))
+    return value
+
+
+class Counter(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+
+def scan_segment(table, segment, total_segments, **kwargs):
+    """yield items of one parallel scan segment"""
+    kwargs.update(Segment=segment, TotalSegments=total_segments)
+    while True:
+        resp = table.scan(**kwargs)
+        for item in resp['Items']:
+            yield item
+        if 'LastEvaluatedKey' not in resp:
+            break
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+
+def copy_segment(src, dest, dry_run, segment, total_segments, counter):
+    items = scan_segment(src, segment, total_segments)
+    if dry_run:
+        for item in items:
+            convert_key(item[RANGE_KEY])
+            counter.add('copied')
+        return
+    with dest.batch_writer() as writer:
+        for item in items:
+            item[RANGE_KEY] = convert_key(item[RANGE_KEY])
+            writer.put_item(Item=item)
+            counter.add('copied')
+
+
+def convert_users_segment(table, dry_run, segment, total_segments, counter):
+    for user in scan_segment(table, segment, total_segments,
+                             ProjectionExpression='user_id, last_report'):
+        old = user.get('last_report')
+        if not isinstance(old, basestring):
+            counter.add('skipped')
+            continue
+        counter.add('converted')
+        if dry_run:
+            continue
+        try:
+            # a concurrent commit may have stored a new report meanwhile
+            table.update_item(
+                Key={'user_id': user['user_id']},
+                UpdateExpression='SET last_report = :new',
+                ConditionExpression='last_report = :old',
+                ExpressionAttributeValues={
+                    ':old': old,
+                    ':new': convert_key(old),
+                })
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            counter.add('changed meanwhile')
+
+
+def run_segments(fn, segments):
+    """run fn(segment, total_segments, counter) for every scan segment
+
+    return: dict of counts
+    """
+    counter = Counter()
+    with ThreadPoolExecutor(max_workers=segments) as executor:
+        futures = [executor.submit(fn, i, segments, counter)
+                   for i in range(segments)]
+        for f in futures:
+            f.result()
+    return counter.counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--copy', nargs=2, metavar=('SOURCE', 'DEST'))
+    group.add_argument('--users', metavar='USER_TABLE')
+    parser.add_argument('--segments', type=int, default=4,
+                        help='parallel scan segments')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--region', default='us-east-1')
+    args = parser.parse_args()
+
+    dynamodb = boto3.resource('dynamodb', region_name=args.region)
+    if args.copy:
+        src, dest = [dynamodb.Table(name) for name in args.copy]
+        fn = partial(copy_segment, src, dest, args.dry_run)
+    else:
+        table = dynamodb.Table(args.users)
+        fn = partial(convert_users_segment, table, args.dry_run)
+    print(run_segments(fn, args.segments))
+
+
+if __name__ == '__main__':
+    main()
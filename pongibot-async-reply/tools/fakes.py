@@ -0,0 +1,600 @@
+"""In-memory fakes of the reply lambda backends, for local runs
+
+- FakeDynamoDB: boto3 DynamoDB resource with Table() and meta.client,
+  understands the expressions used by ddb_models
+- FakeGraphSession: requests session answering Graph API sends and
+  batch requests
+- FakeS3Client: boto3 S3 client with the calls used by FileSaver
+- FakeFileSaver: FileSaver that neither downloads nor uploads
+
+The real model classes run on top of them, so their round trips can be
+counted. Every call sleeps the configured latency and is recorded in a
+CallStats.
+"""
+from __future__ import print_function
+
+import os
+import re
+import sys
+import copy
+import json
+import time
+import threading
+
+from botocore.exceptions import ClientError
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graph_stub import decode_form_body
+from file_utils import FileSaver
+from msg_sender import FacebookMsgSender
+
+
+class CallStats(object):
+    """thread safe counter of backend calls"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, backend, op):
+        with self.lock:
+            key = (backend, op)
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.counts = {}
+
+    def total(self, backend=None):
+        return sum(n for (b, _), n in self.counts.items()
+                   if backend is None or b == backend)
+
+
+def _ok(**kwargs):
+    kwargs['ResponseMetadata'] = {'HTTPStatusCode': 200}
+    return kwargs
+
+
+def _error(code, operation):
+    return ClientError({'Error': {'Code': code, 'Message': code}}, operation)
+
+
+class _Expression(object):
+    """evaluates the expression subset used by ddb_models"""
+
+    def __init__(self, names, values):
+        self.names = names or {}
+        self.values = values or {}
+
+    def path(self, text):
+        """return: list of map keys and list indexes"""
+        ret = []
+        for part in text.strip().split('.'):
+            m = re.match(r'^([^\[]+)((?:\[\d+\])*)$', part)
+            name = m.group(1)
+            ret.append(self.names.get(name, name))
+            ret += [int(i) for i in re.findall(r'\[(\d+)\]', m.group(2))]
+        return ret
+
+    @staticmethod
+    def get(item, path):
+        for p in path:
+            if isinstance(p, int):
+                if not isinstance(item, list) or p >= len(item):
+                    return None
+            elif not isinstance(item, dict) or p not in item:
+                return None
+            item = item[p]
+        return item
+
+    @staticmethod
+    def set(item, path, value):
+        for p in path[:-1]:
+            if isinstance(p, int) or p not in item:
+                raise _error('ValidationException', 'UpdateItem')
+            item = item[p]
+        item[path[-1]] = value
+
+    @staticmethod
+    def remove(item, path):
+        parent = _Expression.get(item, path[:-1]) if len(path) > 1 else item
+        if isinstance(parent, dict):
+            parent.pop(path[-1], None)
+
+    def operand(self, item, text):
+        text = text.strip()
+        m = re.match(r'^if_not_exists\((.+?),\s*(:\w+)\)$', text)
+        if m:
+            value = self.get(item, self.path(m.group(1)))
+            return value if value is not None else self.values[m.group(2)]
+        if text.startswith(':'):
+            return self.values[text]
+        return self.get(item, self.path(text))
+
+    def value(self, item, text):
+        m = re.match(r'^(.+?)\s*([+-])\s*(:\w+)$', text.strip())
+        if m:
+            left = self.operand(item, m.group(1))
+            right = self.values[m.group(3)]
+            return left + right if m.group(2) == '+' else left - right
+        return copy.deepcopy(self.operand(item, text))
+
+    def check(self, item, condition):
+        if not condition:
+            return True
+        for part in re.split(r'\s+AND\s+', condition.strip()):
+            part = part.strip()
+            if part.startswith('(') and part.endswith(')'):
+                part = part[1:-1]
+            m = re.match(r'^attribute_(not_)?exists\((.+)\)$', part)
+            if m:
+                exists = self.get(item, self.path(m.group(2))) is not None
+                if exists == bool(m.group(1)):
+                    return False
+                continue
+            m = re.match(r'^(.+?)\s*(=|<>)\s*(.+)$', part)
+            left = self.operand(item, m.group(1))
+            right = self.operand(item, m.group(3))
+            if (left == right) != (m.group(2) == '='):
+                return False
+        return True
+
+    def update(self, item, expression):
+        clauses = re.split(r'\s+(?=(?:SET|REMOVE|ADD)\s)', expression.strip())
+        for clause in clauses:
+            action, rest = clause.strip().split(None, 1)
+            for part in [p for p in re.split(r',(?![^(]*\))', rest) if p.strip()]:
+                if action == 'SET':
+                    target, value = part.split('=', 1)
+                    self.set(item, self.path(target), self.value(item, value))
+                elif action == 'REMOVE':
+                    self.remove(item, self.path(part))
+                elif action == 'ADD':
+                    target, value = part.split()
+                    path = self.path(target)
+                    current = self.get(item, path)
+                    added = self.values[value]
+                    if isinstance(added, set):
+                        self.set(item, path, (current or set()) | added)
+                    else:
+                        self.set(item, path, (current or 0) + added)
+
+
+class FakeTable(object):
+
+    def __init__(self, db, name):
+        self.db = db
+        self.name = name
+
+    @property
+    def schema(self):
+        return self.db.schemas[self.name]
+
+    def _key(self, item):
+        return tuple(item.get(k) for k in self.schema['key'] if k)
+
+    def _call(self, op):
+        self.db.stats.add('ddb', op)
+        if self.db.latency:
+            time.sleep(self.db.latency)
+
+    def get_item(self, Key, ConsistentRead=False, **kwargs):
+        self._call('get_item')
+        with self.db.lock:
+            item = self.db.items[self.name].get(self._key(Key))
+            ret = _ok()
+            if item is not None:
+                ret['Item'] = copy.deepcopy(item)
+            return ret
+
+    def put_item(self, Item, ConditionExpression=None,
+                 ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        self._call('put_item')
+        with self.db.lock:
+            self._put(Item, ConditionExpression, ExpressionAttributeNames,
+                      ExpressionAttributeValues)
+        return _ok()
+
+    def _put(self, item, condition=None, names=None, values=None):
+        items = self.db.items[self.name]
+        key = self._key(item)
+        expr = _Expression(names, values)
+        if not expr.check(items.get(key, {}), condition):
+            raise _error('ConditionalCheckFailedException', 'PutItem')
+        items[key] = copy.deepcopy(item)
+
+    def delete_item(self, Key, ConditionExpression=None,
+                    ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        self._call('delete_item')
+        with self.db.lock:
+            items = self.db.items[self.name]
+            key = self._key(Key)
+            expr = _Expression(ExpressionAttributeNames, ExpressionAttributeValues)
+            if not expr.check(items.get(key, {}), ConditionExpression):
+                raise _error('ConditionalCheckFailedException', 'DeleteItem')
+            items.pop(key, None)
+        return _ok()
+
+    def update_item(self, Key, UpdateExpression=None, ConditionExpression=None,
+                    ExpressionAttributeNames=None, ExpressionAttributeValues=None,
+                    AttributeUpdates=None, Expected=None, ReturnValues=None):
+        self._call('update_item')
+        with self.db.lock:
+            item = self._update(Key, UpdateExpression, ConditionExpression,
+                                ExpressionAttributeNames,
+                                ExpressionAttributeValues,
+                                AttributeUpdates, Expected)
+            ret = _ok()
+            if ReturnValues and ReturnValues != 'NONE':
+                ret['Attributes'] = copy.deepcopy(item)
+            return ret
+
+    def _update(self, key, expression=None, condition=None, names=None,
+                values=None, attribute_updates=None, expected=None):
+        items = self.db.items[self.name]
+        current = items.get(self._key(key))
+        for name, e in (expected or {}).items():
+            if current is None or current.get(name) != e['Value']:
+                raise _error('ConditionalCheckFailedException', 'UpdateItem')
+        expr = _Expression(names, values)
+        if not expr.check(current or {}, condition):
+            raise _error('ConditionalCheckFailedException', 'UpdateItem')
+
+        item = copy.deepcopy(current) if current else dict(key)
+        for name, u in (attribute_updates or {}).items():
+            if u['Action'] == 'DELETE':
+                item.pop(name, None)
+            else:
+                item[name] = copy.deepcopy(u['Value'])
+        if expression:
+            expr.update(item, expression)
+        items[self._key(item)] = item
+        return item
+
+    def _key_condition(self, condition):
+        """return: list of (attribute, operator, value)"""
+        expr = condition.get_expression()
+        if expr['operator'] == 'AND':
+            return sum([self._key_condition(c) for c in expr['values']], [])
+        attr, value = expr['values']
+        return [(attr.name, expr['operator'], value)]
+
+    def query(self, KeyConditionExpression, IndexName=None, Limit=None,
+              ScanIndexForward=True, ExclusiveStartKey=None,
+              ProjectionExpression=None, ExpressionAttributeNames=None,
+              ConsistentRead=False, Select=None):
+        self._call('query')
+        if IndexName:
+            hash_key, range_key = self.schema['indexes'][IndexName]
+        else:
+            hash_key, range_key = self.schema['key']
+
+        with self.db.lock:
+            items = list(self.db.items[self.name].values())
+        for attr, op, value in self._key_condition(KeyConditionExpression):
+            if op == '=':
+                items = [i for i in items if i.get(attr) == value]
+            elif op == 'begins_with':
+                items = [i for i in items
+                         if unicode(i.get(attr, '')).startswith(value)]
+        if range_key:
+            items.sort(key=lambda i: i.get(range_key),
+                       reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            keys = [self._key(i) for i in items]
+            start = self._key(ExclusiveStartKey)
+            items = items[keys.index(start) + 1:] if start in keys else []
+
+        ret = _ok()
+        if Limit and len(items) > Limit:
+            items = items[:Limit]
+            last = items[-1]
+            ret['LastEvaluatedKey'] = dict(
+                (k, last[k]) for k in set(self.schema['key'] + (hash_key, range_key))
+                if k)
+        ret['Items'] = [self._project(i, ProjectionExpression,
+                                      ExpressionAttributeNames)
+                        for i in items]
+        ret['Count'] = len(items)
+        return ret
+
+    def scan(self, Segment=0, TotalSegments=1, ExclusiveStartKey=None,
+             Limit=None, ProjectionExpression=None,
+             ExpressionAttributeNames=None):
+        self._call('scan')
+        with self.db.lock:
+            items = sorted(self.db.items[self.name].items())
+        items = [i for k, i in items if hash(k) % TotalSegments == Segment]
+        if ExclusiveStartKey:
+            keys = [self._key(i) for i in items]
+            items = items[keys.index(self._key(ExclusiveStartKey)) + 1:]
+        ret = _ok()
+        if Limit and len(items) > Limit:
+            items = items[:Limit]
+            ret['LastEvaluatedKey'] = dict(
+                (k, items[-1][k]) for k in self.schema['key'] if k)
+        ret['Items'] = [self._project(i, ProjectionExpression,
+                                      ExpressionAttributeNames)
+                        for i in items]
+        return ret
+
+    def batch_writer(self):
+        return _BatchWriter(self)
+
+    def _project(self, item, projection, names):
+        item = copy.deepcopy(item)
+        if not projection:
+            return item
+        expr = _Expression(names, None)
+        ret = {}
+        for part in projection.split(','):
+            path = expr.path(part)
+            value = expr.get(item, path)
+            if value is None:
+                continue
+            if isinstance(path[-1], int):
+                # list element, stored as a one element list
+                path = path[:-1]
+                value = [value]
+            target = ret
+            for p in path[:-1]:
+                target = target.setdefault(p, {})
+            target[path[-1]] = value
+        return ret
+
+
+class _BatchWriter(object):
+
+    def __init__(self, table):
+        self.table = table
+
+    def put_item(self, Item):
+        self.table.put_item(Item=Item)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+class FakeDynamoDBClient(object):
+    """low level client, items in DynamoDB JSON"""
+
+    def __init__(self, db):
+        self.db = db
+        self.serializer = TypeSerializer()
+        self.deserializer = TypeDeserializer()
+
+    def _load(self, data):
+        return dict((k, self.deserializer.deserialize(v))
+                    for k, v in (data or {}).items())
+
+    def put_item(self, TableName, Item, **kwargs):
+        table = self.db.Table(TableName)
+        return table.put_item(Item=self._load(Item))
+
+    def transact_write_items(self, TransactItems):
+        self.db.stats.add('ddb', 'transact_write_items')
+        if self.db.latency:
+            time.sleep(self.db.latency)
+        keys = set()
+        for op in TransactItems:
+            (kind, body), = op.items()
+            table = self.db.Table(body['TableName'])
+            key = table._key(self._load(body.get('Key') or body.get('Item')))
+            if (table.name, key) in keys:
+                raise _error('ValidationException', 'TransactWriteItems')
+            keys.add((table.name, key))
+        with self.db.lock:
+            snapshot = copy.deepcopy(self.db.items)
+            reasons = []
+            failed = False
+            for op in TransactItems:
+                (kind, body), = op.items()
+                table = self.db.Table(body['TableName'])
+                names = body.get('ExpressionAttributeNames')
+                values = self._load(body.get('ExpressionAttributeValues'))
+                try:
+                    if kind == 'Put':
+                        table._put(self._load(body['Item']),
+                                   body.get('ConditionExpression'), names, values)
+                    elif kind == 'Update':
+                        table._update(self._load(body['Key']),
+                                      body.get('UpdateExpression'),
+                                      body.get('ConditionExpression'),
+                                      names, values)
+                    elif kind == 'ConditionCheck':
+                        key = self._load(body['Key'])
+                        current = self.db.items[table.name].get(table._key(key))
+                        if not _Expression(names, values).check(
+                                current or {}, body['ConditionExpression']):
+                            raise _error('ConditionalCheckFailedException',
+                                         'TransactWriteItems')
+                    reasons.append({'Code': 'None'})
+                except ClientError:
+                    reasons.append({'Code': 'ConditionalCheckFailed'})
+                    failed = True
+            if failed:
+                self.db.items = snapshot
+                e = _error('TransactionCanceledException', 'TransactWriteItems')
+                e.response['CancellationReasons'] = reasons
+                raise e
+        return _ok()
+
+
+class _Meta(object):
+
+    def __init__(self, client):
+        self.client = client
+
+
+class FakeDynamoDB(object):
+    """boto3 DynamoDB resource backed by dicts
+
+    Tables must be created with create_table first.
+    """
+
+    def __init__(self, stats=None, latency=0.0):
+        self.stats = stats or CallStats()
+        self.latency = latency
+        self.lock = threading.RLock()
+        self.items = {}
+        self.schemas = {}
+        self.meta = _Meta(FakeDynamoDBClient(self))
+
+    def create_table(self, name, hash_key, range_key=None, indexes=None):
+        """indexes: {index name: (hash key, range key or None)}"""
+        self.schemas[name] = {
+            'key': (hash_key, range_key),
+            'indexes': indexes or {},
+        }
+        self.items.setdefault(name, {})
+
+    def Table(self, name):
+        return FakeTable(self, name)
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, data):
+        self.status_code = status_code
+        self._data = data
+        self.content = json.dumps(data)
+
+    def json(self):
+        return self._data
+
+
+class FakeGraphSession(object):
+    """requests session answering Graph API send and batch requests"""
+
+    def __init__(self, stats=None, latency=0.0):
+        self.stats = stats or CallStats()
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.messages = []
+
+    def post(self, url, params=None, headers=None, data=None, timeout=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if isinstance(data, dict) and 'batch' in data:
+            self.stats.add('graph', 'batch')
+            results = []
+            for request in json.loads(data['batch']):
+                self._record(decode_form_body(request['body']))
+                results.append({'code': 200, 'body': '{}'})
+            return FakeResponse(200, results)
+
+        self.stats.add('graph', 'send')
+        message = json.loads(data)
+        self._record(message)
+        return FakeResponse(200, {'recipient_id': message['recipient']['id']})
+
+    def _record(self, message):
+        with self.lock:
+            self.messages.append(message)
+
+
+def fake_sender_class(session):
+    """FacebookMsgSender subclass posting to session"""
+
+    class FakeGraphSender(FacebookMsgSender):
+
+        def __init__(self, *args, **kwargs):
+            super(FakeGraphSender, self).__init__(*args, **kwargs)
+            self.session = session
+
+    return FakeGraphSender
+
+
+class FakeS3Client(object):
+    """boto3 S3 client keeping objects and multipart uploads in dicts"""
+
+    def __init__(self, stats=None, latency=0.0):
+        self.stats = stats or CallStats()
+        self.latency = latency
+        self.lock = threading.Lock()
+        # {key: (body, extra arguments)}
+        self.objects = {}
+        # {upload id: (key, {part number: body}, extra arguments)}
+        self.uploads = {}
+        self.upload_count = 0
+        self.aborted = []
+
+    def _call(self, op):
+        self.stats.add('s3', op)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._call('put_object')
+        with self.lock:
+            self.objects[Key] = (Body, kwargs)
+        return _ok(ETag='"{}"'.format(len(Body)))
+
+    def head_object(self, Bucket, Key):
+        self._call('head_object')
+        if Key not in self.objects:
+            raise _error('404', 'HeadObject')
+        return _ok(ContentLength=len(self.objects[Key][0]))
+
+    def copy_object(self, Bucket, Key, CopySource):
+        self._call('copy_object')
+        with self.lock:
+            self.objects[Key] = self.objects[CopySource['Key']]
+        return _ok()
+
+    def delete_object(self, Bucket, Key):
+        self._call('delete_object')
+        with self.lock:
+            self.objects.pop(Key, None)
+        return _ok()
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._call('create_multipart_upload')
+        with self.lock:
+            self.upload_count += 1
+            upload_id = 'upload{}'.format(self.upload_count)
+            self.uploads[upload_id] = (Key, {}, kwargs)
+        return _ok(UploadId=upload_id)
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body, **kwargs):
+        self._call('upload_part')
+        with self.lock:
+            self.uploads[UploadId][1][PartNumber] = Body
+        return _ok(ETag='"{}"'.format(PartNumber))
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._call('complete_multipart_upload')
+        with self.lock:
+            key, parts, kwargs = self.uploads.pop(UploadId)
+            numbers = [p['PartNumber'] for p in MultipartUpload['Parts']]
+            body = b''.join(parts[n] for n in numbers)
+            self.objects[key] = (body, kwargs)
+        return _ok()
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._call('abort_multipart_upload')
+        with self.lock:
+            self.uploads.pop(UploadId, None)
+            self.aborted.append(UploadId)
+        return _ok()
+
+
+class FakeFileSaver(FileSaver):
+    """FileSaver storing nothing, save_s3 only waits the latency"""
+
+    def __init__(self, stats=None, latency=0.0):
+        self.bucket_name = 'fake-bucket'
+        self.storage_mode = 'path'
+        self.stats = stats or CallStats()
+        self.latency = latency
+
+    def save_s3(self, url, file_name, deadline=None):
+        self.stats.add('s3', 'save')
+        if self.latency:
+            time.sleep(self.latency)
+        return os.path.join(self.S3_FOLDER, file_name), None
@@ -0,0 +1,127 @@
+"""Local stub of the Graph API send endpoints
+
+Accepts single sends (POST /<version>/me/messages) and batch requests
+(POST / with a `batch` form field) and records every message it gets.
+
+Run it and point the sender to it:
+
+    python tools/graph_stub.py --port 8089
+    FB_GRAPH_URL=http://127.0.0.1:8089 python ...
+"""
+from __future__ import print_function
+
+import json
+import random
+import argparse
+import threading
+import urlparse
+import BaseHTTPServer
+from SocketServer import ThreadingMixIn
+
+
+def decode_form_body(body):
+    """fields of a batch sub request body, as Graph reads them
+
+    Values holding a JSON object or array are decoded, others are kept
+    as strings.
+
+    return: dict
+    """
+    data = {}
+    for k, v in urlparse.parse_qs(body).items():
+        value = v[0]
+        if value[:1] in ('{', '['):
+            value = json.loads(value)
+        data[k] = value
+    return data
+
+
+class GraphStubServer(ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, fail_rate=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, address, GraphStubHandler)
+        self.fail_rate = fail_rate
+        self.lock = threading.Lock()
+        self.messages = []
+        self.http_requests = 0
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.server_address)
+
+    def record(self, data):
+        """record one message, return response code"""
+        if self.fail_rate and random.random() < self.fail_rate:
+            return 500
+        with self.lock:
+            self.messages.append(data)
+        return 200
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class GraphStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        with self.server.lock:
+            self.server.http_requests += 1
+        length = int(self.headers.get('Content-Length', 0))
+        raw = self.rfile.read(length)
+        path = urlparse.urlparse(self.path).path.strip('/')
+
+        if path.endswith('me/messages'):
+            code = self.server.record(json.loads(raw))
+            self._respond(code, {'recipient_id': 'stub'})
+        elif path == '':
+            form = urlparse.parse_qs(raw)
+            batch = json.loads(form['batch'][0])
+            self._respond(200, self._handle_batch(batch))
+        else:
+            self._respond(404, {'error': 'unknown path'})
+
+    def _handle_batch(self, batch):
+        results = []
+        failed = set()
+        for request in batch:
+            parent = request.get('depends_on')
+            if parent in failed:
+                failed.add(request.get('name'))
+                results.append(None)
+                continue
+            code = self.server.record(decode_form_body(request['body']))
+            if code != 200:
+                failed.add(request.get('name'))
+            results.append({'code': code, 'body': '{}'})
+        return results
+
+    def _respond(self, code, data):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--fail-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = GraphStubServer(('127.0.0.1', args.port), args.fail_rate)
+    print("graph stub listening on {}".format(server.url))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""Report the startup cost of the reply lambda, module by module
+
+Times every import made while loading the entry module (inclusive and
+self time), then the setup of the first and of a warm invocation:
+
+    python tools/import_profile.py
+    python tools/import_profile.py --top 40 --module lambda_handler
+
+The webhook can be profiled the same way from its directory:
+
+    python tools/import_profile.py --path ../pongibot --module app --no-setup
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import argparse
+import __builtin__
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for name in ('USER_TABLE', 'MSG_TABLE', 'REPORT_TABLE', 'REPLY_TABLE',
+             'S3_BUCKET', 'PAGE_ACCESS_TOKEN'):
+    os.environ.setdefault(name, 'profile-' + name.lower())
+
+
+class ImportTimer(object):
+    """wrap __import__, time the first load of every module"""
+
+    def __init__(self):
+        self.loads = []
+        self._stack = []
+        self._import = None
+
+    def __enter__(self):
+        self._import = __builtin__.__import__
+        __builtin__.__import__ = self._timed_import
+        return self
+
+    def __exit__(self, *exc):
+        __builtin__.__import__ = self._import
+
+    def _timed_import(self, name, globals=None, locals=None, fromlist=(),
+                      level=-1):
+        before = set(sys.modules)
+        self._stack.append(0.0)
+        start = time.time()
+        try:
+            return self._import(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - start
+            children = self._stack.pop()
+            if self._stack:
+                self._stack[-1] += elapsed
+            loaded = [m for m in set(sys.modules) - before
+                      if sys.modules[m] is not None]
+            if loaded:
+                self.loads.append((name, len(self._stack), elapsed,
+                                   elapsed - children, len(loaded)))
+
+    def report(self, top):
+        total = sum(e for _, depth, e, _, _ in self.loads if depth == 0)
+        print("imports: {} loads, {:.1f} ms at top level".format(
+            len(self.loads), total * 1000))
+        print("\n{:<40} {:>6} {:>10} {:>9} {:>8}".format(
+            'module', 'depth', 'total ms', 'self ms', 'modules'))
+        ranked = sorted(self.loads, key=lambda l: l[3], reverse=True)
+        for name, depth, elapsed, own, n in ranked[:top]:
+            print("{:<40} {:>6} {:>10.1f} {:>9.1f} {:>8}".format(
+                name, depth, elapsed * 1000, own * 1000, n))
+
+
+def time_setup(module):
+    """time ReplyClients() and one DynamoDB Table handle, cold then warm"""
+    import clients
+    for label in ('first invocation', 'warm invocation'):
+        start = time.time()
+        module.ReplyClients()
+        clients.get_table(os.environ['USER_TABLE'])
+        print("{:<20} setup {:>8.1f} ms".format(
+            label, (time.time() - start) * 1000))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--module', default='lambda_handler')
+    parser.add_argument('--path', help='directory to import the module from')
+    parser.add_argument('--top', type=int, default=25)
+    parser.add_argument('--no-setup', action='store_true',
+                        help='only time the imports')
+    args = parser.parse_args()
+    if args.path:
+        sys.path.insert(0, os.path.abspath(args.path))
+
+    start = time.time()
+    with ImportTimer() as timer:
+        module = __import__(args.module)
+    elapsed = time.time() - start
+    timer.report(args.top)
+    print("\nimport {}: {:.1f} ms".format(args.module, elapsed * 1000))
+
+    if not args.no_setup:
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        time_setup(module)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Write ReportIndexTable items of the reports stored before the index
+
+New reports are indexed by the reply lambda when REPORT_INDEX_TABLE is
+set. Reports stored before are indexed with a parallel scan of the
+report table, which can be re-run safely (items are overwritten):
+
+    REPORT_TABLE=... REPORT_INDEX_TABLE=... \\
+        python tools/rebuild_report_index.py --segments 8
+"""
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+from functools import partial
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ddb_models import ReportTable
+from backfill_timestamp_keys import scan_segment, run_segments
+
+
+def index_segment(report_table, dry_run, segment, total_segments, counter):
+    index = report_table.index
+    reports = scan_segment(report_table.table, segment, total_segments)
+    if dry_run:
+        for report in reports:
+            counter.add('reports')
+            counter.add('index items', len(index.build_items(report)))
+        return
+    with index.table.batch_writer() as writer:
+        for report in reports:
+            counter.add('reports')
+            for item in index.build_items(report):
+                writer.put_item(Item=item)
+                counter.add('index items')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--segments', type=int, default=4,
+                        help='parallel scan segments')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    if not os.environ.get("REPORT_INDEX_TABLE"):
+        parser.error('REPORT_INDEX_TABLE is not set')
+
+    report_table = ReportTable()
+    fn = partial(index_segment, report_table, args.dry_run)
+    print(run_segments(fn, args.segments))
+
+
+if __name__ == '__main__':
+    main()
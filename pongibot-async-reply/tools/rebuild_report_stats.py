@@ -0,0 +1,89 @@
+"""Recompute ReportStatsTable from scratch with a parallel scan
+
+The reply lambda adds every new report to the counters when
+REPORT_STATS_TABLE is set. This recounts all reports of ReportTable, then
+replaces the counter item of every user found:
+
+    REPORT_TABLE=... REPORT_STATS_TABLE=... USER_TABLE=... \\
+        python tools/rebuild_report_stats.py --segments 8
+
+Days are counted in the timezone of each user. Reports stored while the
+tool runs can be missed, run it again or at a quiet time.
+"""
+from __future__ import print_function
+
+import os
+import sys
+import argparse
+import threading
+from functools import partial
+from collections import Counter as Counts
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ddb_models import ReportTable, User
+from backfill_timestamp_keys import scan_segment, run_segments
+
+
+class UserCounts(object):
+    """counts per user, merged from the scan segments"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}
+        self.timezones = {}
+
+    def timezone(self, user_id):
+        with self.lock:
+            if user_id in self.timezones:
+                return self.timezones[user_id]
+        timezone = User(user_id).get_or_create().get_timezone()
+        with self.lock:
+            self.timezones[user_id] = timezone
+        return timezone
+
+    def merge(self, user_id, counts):
+        with self.lock:
+            self.users.setdefault(user_id, Counts()).update(counts)
+
+
+def count_segment(report_table, user_counts, segment, total_segments, counter):
+    stats = report_table.stats
+    for report in scan_segment(report_table.table, segment, total_segments,
+                               ProjectionExpression='user_id, #ts, tags, target',
+                               ExpressionAttributeNames={'#ts': 'timestamp'}):
+        user_id = report['user_id']
+        names = stats.counter_names(report, user_counts.timezone(user_id))
+        user_counts.merge(user_id, dict((name, 1) for name in names))
+        counter.add('reports')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--segments', type=int, default=4,
+                        help='parallel scan segments')
+    parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+    if not os.environ.get("REPORT_STATS_TABLE"):
+        parser.error('REPORT_STATS_TABLE is not set')
+
+    report_table = ReportTable()
+    user_counts = UserCounts()
+    counts = run_segments(
+        partial(count_segment, report_table, user_counts), args.segments)
+    counts['users'] = len(user_counts.users)
+    print(counts)
+    if args.dry_run:
+        return
+
+    stats = report_table.stats
+    with stats.table.batch_writer() as writer:
+        for user_id, user in user_counts.users.iteritems():
+            item = dict(user)
+            item[stats.primary_key] = user_id
+            writer.put_item(Item=item)
+    print("wrote {} users".format(len(user_counts.users)))
+
+
+if __name__ == '__main__':
+    main()
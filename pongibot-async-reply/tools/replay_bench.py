@@ -0,0 +1,279 @@
+"""Replay conversations through the reply lambda handler offline
+
+The real handler and state machine run against the in-memory backends of
+tools/fakes.py, with injected latencies. Reports turns/sec, time spent in
+each processing stage and backend calls per turn.
+
+Recorded events (single events or {"senders": [...]} batches):
+
+    python tools/replay_bench.py lambda_test_case/*.json --repeat 50
+
+Synthetic conversations (insert a report, list reports, find a tag, back to
+the menu), optionally grouped into batches of the same sender:
+
+    python tools/replay_bench.py --synthetic 200 --users 20 --batch 3 \\
+        --ddb-ms 5 --s3-ms 40 --graph-ms 30
+"""
+from __future__ import print_function
+
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for name in ('USER_TABLE', 'MSG_TABLE', 'REPORT_TABLE', 'REPLY_TABLE',
+             'REPORT_INDEX_TABLE', 'REPORT_STATS_TABLE', 'S3_BUCKET',
+             'PAGE_ACCESS_TOKEN'):
+    os.environ.setdefault(name, 'bench-' + name.lower())
+
+import fakes
+import clients
+import ddb_models
+import lambda_handler
+
+
+class StageTimer(object):
+    """wall time per stage, from any thread"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                calls, total = self.stages.get(name, (0, 0.0))
+                self.stages[name] = (calls + 1, total + elapsed)
+
+    def wrap(self, owner, attr, name):
+        """time every call of owner.attr as stage name"""
+        func = getattr(owner, attr)
+        timer = self
+
+        def timed(*args, **kwargs):
+            with timer.stage(name):
+                return func(*args, **kwargs)
+        setattr(owner, attr, timed)
+
+    def reset(self):
+        with self.lock:
+            self.stages = OrderedDict()
+
+
+STAGES = [
+    (lambda_handler, 'handler', 'handler'),
+    (lambda_handler, 'prepare_message', 'prepare message'),
+    (lambda_handler, 'save_attachments', 'save attachments'),
+    (lambda_handler, 'update_user_state', 'update user state'),
+    (ddb_models.User, 'get_or_create', 'load user'),
+    (ddb_models.UserSession, 'commit', 'commit user'),
+    (ddb_models.MsgTable, 'mark_processed', 'mark processed'),
+    (lambda_handler.OrderedSends, 'wait', 'wait sends'),
+]
+
+
+def install_fakes(args, stats, timer):
+    """point the handler to in-memory backends
+
+    return: FakeDynamoDB
+    """
+    db = fakes.FakeDynamoDB(stats, args.ddb_ms / 1000.0)
+    db.create_table(os.environ['USER_TABLE'], 'user_id')
+    db.create_table(os.environ['MSG_TABLE'], 'user_id', 'timestamp',
+                    indexes={'mid-index': ('mid', None)})
+    db.create_table(os.environ['REPORT_TABLE'], 'user_id', 'timestamp')
+    db.create_table(os.environ['REPLY_TABLE'], 'user_id', 'timestamp')
+    db.create_table(os.environ['REPORT_INDEX_TABLE'], 'key', 'timestamp')
+    db.create_table(os.environ['REPORT_STATS_TABLE'], 'user_id')
+    clients.set_resource('dynamodb', db)
+
+    graph = fakes.FakeGraphSession(stats, args.graph_ms / 1000.0)
+    lambda_handler.FacebookMsgSender = fakes.fake_sender_class(graph)
+    file_saver = fakes.FakeFileSaver(stats, args.s3_ms / 1000.0)
+    lambda_handler.FileSaver = lambda: file_saver
+
+    for owner, attr, name in STAGES:
+        timer.wrap(owner, attr, name)
+    return db
+
+
+def message_event(sender_id, mid, **message):
+    message['mid'] = mid
+    return {
+        'sender': {'id': sender_id},
+        'recipient': {'id': 'PAGE_ID'},
+        'timestamp': int(time.time() * 1000),
+        'message': message,
+    }
+
+
+def synthetic_conversation(sender_id, n):
+    """one report insert, report list, tag search and return to the menu
+
+    return: list of events
+    """
+    def quick_reply(payload):
+        return {'text': payload, 'quick_reply': {'payload': payload}}
+
+    image = {'type': 'image',
+             'payload': {'url': 'https://example.com/{}/{}.jpg'.format(sender_id, n)}}
+    turns = [
+        quick_reply('QR_INSERT_NEW'),
+        {'attachments': [image]},
+        {'text': 'tag{}'.format(n % 7)},
+        quick_reply('QR_SKIP'),
+        {'text': 'target{}'.format(n % 5)},
+        quick_reply('QR_RECENT_REPORT'),
+        {'text': 'hi'},
+        {'text': '#tag{}'.format(n % 7)},
+        {'text': 'hi'},
+    ]
+    return [message_event(sender_id, 'mid.{}.{}.{}'.format(sender_id, n, i), **t)
+            for i, t in enumerate(turns)]
+
+
+def synthetic_payloads(conversations, users, batch):
+    """return: list of handler payloads"""
+    per_user = OrderedDict()
+    for n in range(conversations):
+        sender_id = 'user{}'.format(n % users)
+        per_user.setdefault(sender_id, []).extend(
+            synthetic_conversation(sender_id, n))
+
+    # interleave users, keep the order of each one
+    payloads = []
+    queues = [(s, events) for s, events in per_user.items()]
+    while queues:
+        left = []
+        for sender_id, events in queues:
+            chunk, rest = events[:batch], events[batch:]
+            payloads.append({'senders': [{'sender_id': sender_id,
+                                          'messages': chunk}]})
+            if rest:
+                left.append((sender_id, rest))
+        queues = left
+    return payloads
+
+
+def recorded_payloads(paths, repeat):
+    """return: list of handler payloads, mids made unique per repeat"""
+    loaded = []
+    for path in paths:
+        with open(path) as f:
+            loaded.append(json.load(f))
+
+    payloads = []
+    for r in range(repeat):
+        for data in loaded:
+            data = copy.deepcopy(data)
+            if 'senders' not in data:
+                data = {'senders': [{'sender_id': data['sender']['id'],
+                                     'messages': [data]}]}
+            for group in data['senders']:
+                for event in group['messages']:
+                    event['message']['mid'] += '.{}'.format(r)
+            payloads.append(data)
+    return payloads
+
+
+def store_messages(payloads):
+    """store events like the webhook does, with their msg key"""
+    msg_table = ddb_models.MsgTable()
+    for payload in payloads:
+        for group in payload['senders']:
+            for event in group['messages']:
+                item = {'mid': event['message']['mid']}
+                msg_table.put(group['sender_id'], item)
+                event[lambda_handler.MSG_KEY_FIELD] = {
+                    msg_table.primary_key: item[msg_table.primary_key],
+                    msg_table.range_key: item[msg_table.range_key],
+                }
+
+
+@contextmanager
+def quiet(enabled):
+    if not enabled:
+        yield
+        return
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def report(turns, elapsed, failed, stats, timer):
+    print("turns: {} in {:.2f}s, {:.1f} turns/sec, {} failed".format(
+        turns, elapsed, turns / elapsed if elapsed else 0.0, failed))
+
+    print("\n{:<20} {:>8} {:>11} {:>9}".format(
+        'stage', 'calls', 'total ms', 'mean ms'))
+    for name, (calls, total) in timer.stages.items():
+        print("{:<20} {:>8} {:>11.1f} {:>9.2f}".format(
+            name, calls, total * 1000, total * 1000 / calls))
+
+    print("\n{:<30} {:>8} {:>9}".format('backend call', 'calls', 'per turn'))
+    for (backend, op), n in sorted(stats.counts.items()):
+        print("{:<30} {:>8} {:>9.2f}".format(
+            '{} {}'.format(backend, op), n, float(n) / turns))
+    print("{:<30} {:>8} {:>9.2f}".format(
+        'total', stats.total(), float(stats.total()) / turns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('events', nargs='*', help='recorded event json files')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='number of synthetic conversations')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--batch', type=int, default=1,
+                        help='synthetic messages per handler call')
+    parser.add_argument('--ddb-ms', type=float, default=0.0)
+    parser.add_argument('--s3-ms', type=float, default=0.0)
+    parser.add_argument('--graph-ms', type=float, default=0.0)
+    parser.add_argument('--verbose', action='store_true',
+                        help='keep handler output')
+    args = parser.parse_args()
+    if not args.events and not args.synthetic:
+        parser.error('give event files or --synthetic')
+
+    stats = fakes.CallStats()
+    timer = StageTimer()
+    install_fakes(args, stats, timer)
+
+    if args.synthetic:
+        payloads = synthetic_payloads(args.synthetic, args.users, args.batch)
+    else:
+        payloads = recorded_payloads(args.events, args.repeat)
+    store_messages(payloads)
+    stats.reset()
+    timer.reset()
+
+    turns = sum(len(g['messages']) for p in payloads for g in p['senders'])
+    failed = 0
+    start = time.time()
+    with quiet(not args.verbose):
+        for payload in payloads:
+            results = lambda_handler.handler(payload, None)
+            failed += len([r for r in results if not r['success']])
+    elapsed = time.time() - start
+    report(turns, elapsed, failed, stats, timer)
+
+
+if __name__ == '__main__':
+    main()
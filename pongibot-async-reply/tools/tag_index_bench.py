@@ -0,0 +1,109 @@
+"""Time tag completions of preference.TagIndex on large tag histories
+
+Builds a ranked history of synthetic tags, then completes random
+prefixes of existing tags, against a linear scan of the same history:
+
+    python tools/tag_index_bench.py --tags 10000 --queries 20000
+    python tools/tag_index_bench.py --tags 50000 --prefix-len 1
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import string
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from metrics import Histogram
+from preference import Preference, TagIndex
+
+
+def synthetic_history(size, seed):
+    """return: stored preference of size distinct tags, zipf-like uses"""
+    rand = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        length = rand.randint(3, 10)
+        word = ''.join(rand.choice(string.ascii_lowercase) for _ in range(length))
+        # some users type their tags capitalized
+        words.add(word.capitalize() if rand.random() < 0.1 else word)
+    words = list(words)
+
+    os.environ["PREFERENCE_MAX_TAGS"] = str(size)
+    preference = Preference()
+    for n in range(size * 2):
+        rank = min(int(rand.paretovariate(1.2)) - 1, size - 1)
+        preference.add_report({'tags': [words[rank if n % 2 else n // 2]]})
+    return preference.to_dict()
+
+
+def linear_complete(entries, prefix, size):
+    """baseline, scan the ranked history for the first matches"""
+    prefix = prefix.lower()
+    names = []
+    for entry in entries:
+        if entry[0].lower().startswith(prefix):
+            names.append(entry[0])
+            if len(names) >= size:
+                break
+    return names
+
+
+def run(func, queries):
+    """return: Histogram of the call times in microseconds"""
+    histogram = Histogram()
+    for prefix in queries:
+        start = time.time()
+        func(prefix)
+        histogram.add((time.time() - start) * 1e6)
+    return histogram
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--tags', type=int, default=10000)
+    parser.add_argument('--queries', type=int, default=10000)
+    parser.add_argument('--prefix-len', type=int, default=0,
+                        help='fixed prefix length, random 1-4 by default')
+    parser.add_argument('--size', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    preference = synthetic_history(args.tags, args.seed)
+    entries = preference['tags']
+
+    start = time.time()
+    index = TagIndex.from_preference(preference)
+    build_ms = (time.time() - start) * 1000
+    print("history: {} tags, index built in {:.1f} ms".format(
+        len(index), build_ms))
+
+    rand = random.Random(args.seed)
+    queries = []
+    for _ in range(args.queries):
+        name = rand.choice(entries)[0]
+        length = args.prefix_len or rand.randint(1, 4)
+        queries.append(name[:length].upper() if rand.random() < 0.2
+                       else name[:length])
+
+    mismatches = len([q for q in queries[:200] if index.complete(q, args.size)
+                      != linear_complete(entries, q, args.size)])
+    print("checked 200 queries against the scan, {} mismatches".format(
+        mismatches))
+
+    print("\n{:<12} {:>8} {:>9} {:>9} {:>9} {:>9}".format(
+        'method', 'calls', 'mean us', 'p50 us', 'p99 us', 'max us'))
+    for label, func in (
+            ('lookup', index.lookup),
+            ('complete', lambda q: index.complete(q, args.size)),
+            ('scan', lambda q: linear_complete(entries, q, args.size))):
+        s = run(func, queries).summary()
+        print("{:<12} {:>8} {:>9.1f} {:>9.1f} {:>9.1f} {:>9.1f}".format(
+            label, s['count'], s['mean'], s['p50'], s['p99'], s['max']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""Time thumbnails.make_thumbnail and measure its peak memory
+
+Synthetic photos of common phone sizes are encoded in a helper process,
+then turned into thumbnails in a child process per size, so each peak
+RSS is its own. The reply lambda runs in 128 MB:
+
+    python tools/thumbnail_bench.py
+    python tools/thumbnail_bench.py --sizes 4032x3024 --count 20 --format PNG
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import random
+import argparse
+import resource
+import multiprocessing
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import thumbnails
+
+LAMBDA_MEMORY_MB = 128
+
+
+def synthetic_photo(width, height, image_format, seed=1):
+    """return: encoded image with EXIF and some texture"""
+    from PIL import Image
+    rand = random.Random(seed)
+    # noise upscaled, compresses like a photo rather than a flat color
+    small = Image.frombytes(
+        'RGB', (width // 16, height // 16),
+        bytes(bytearray(rand.randint(0, 255)
+                        for _ in range(width // 16 * height // 16 * 3))))
+    img = small.resize((width, height), Image.BILINEAR)
+    out = BytesIO()
+    if image_format == 'JPEG':
+        # orientation tag and a comment, both must not reach the thumbnail
+        exif = b'Exif\x00\x00II*\x00\x08\x00\x00\x00\x01\x00\x12\x01\x03\x00' \
+            b'\x01\x00\x00\x00\x06\x00\x00\x00\x00\x00\x00\x00'
+        img.save(out, 'JPEG', quality=92, exif=exif)
+    else:
+        img.save(out, image_format)
+    return out.getvalue()
+
+
+def peak_rss_mb():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def run_size(args, size, data, queue):
+    width, height = size
+    base_mb = peak_rss_mb()
+
+    start = time.time()
+    thumb = None
+    for _ in range(args.count):
+        thumb = thumbnails.make_thumbnail(data, args.thumb_size, args.quality)
+    elapsed = time.time() - start
+    queue.put({
+        'size': '{}x{}'.format(width, height),
+        'source_kb': len(data) / 1024.0,
+        'thumb_kb': len(thumb) / 1024.0 if thumb else 0.0,
+        'per_sec': args.count / elapsed if elapsed else 0.0,
+        'ms': elapsed * 1000 / args.count,
+        'base_mb': base_mb,
+        'peak_mb': peak_rss_mb(),
+        'exif': thumb is not None and b'Exif' in thumb[:1024],
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', nargs='+',
+                        default=['1280x720', '2048x1536', '4032x3024'],
+                        help='source sizes, WIDTHxHEIGHT')
+    parser.add_argument('--count', type=int, default=10)
+    parser.add_argument('--format', default='JPEG', help='source format')
+    parser.add_argument('--thumb-size', type=int, default=thumbnails.THUMBNAIL_SIZE)
+    parser.add_argument('--quality', type=int, default=thumbnails.THUMBNAIL_QUALITY)
+    args = parser.parse_args()
+    if not thumbnails.enabled():
+        parser.error('Pillow is not installed or THUMBNAILS=0')
+
+    print("{:<11} {:>10} {:>9} {:>9} {:>8} {:>9} {:>9} {:>5}".format(
+        'source', 'source kb', 'thumb kb', 'per sec', 'ms', 'base mb',
+        'peak mb', 'exif'))
+    sizes = [tuple(int(v) for v in text.lower().split('x'))
+             for text in args.sizes]
+    # full size images are built away from the measured processes
+    pool = multiprocessing.Pool(1)
+    sources = [pool.apply(synthetic_photo, (w, h, args.format))
+               for w, h in sizes]
+    pool.close()
+
+    for size, data in zip(sizes, sources):
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(
+            target=run_size, args=(args, size, data, queue))
+        child.start()
+        r = queue.get()
+        child.join()
+        print("{:<11} {:>10.0f} {:>9.1f} {:>9.1f} {:>8.1f} {:>9.1f} {:>9.1f} {:>5}".format(
+            r['size'], r['source_kb'], r['thumb_kb'], r['per_sec'], r['ms'],
+            r['base_mb'], r['peak_mb'], 'yes' if r['exif'] else 'no'))
+        if r['peak_mb'] > LAMBDA_MEMORY_MB:
+            print("  over the {} MB lambda memory".format(LAMBDA_MEMORY_MB))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,8 @@ import os
 import json
 
 from chalice import Chalice, Response
-from chalicelib import FacebookMsgParser, MsgTable, AsyncReplyTrigger
+from chalicelib import FacebookMsgParser, MsgTable, AsyncReplyTrigger, \
+    DispatchError, get_dispatcher, get_deduplicator, metrics
 
 
 app = Chalice(app_name='pongibot')
@@ -48,32 +49,78 @@ def webhook_get(request):
                     headers={'Content-Type': 'text/plain'})
 
 
+@metrics.entrypoint('webhook_post')
 def webhook_post(request):
     body = request.json_body
-    print(body)
+    metrics.log_payload('webhook body', body)
     if not body:
         return {"success": False}
 
     msgt = MsgTable()
-    reply_trigger = AsyncReplyTrigger()
+    messages = []
     if body['object'] == 'page':
         for entry in body['entry']:
             for msg in entry.get('messaging', []):
                 msg_type = FacebookMsgParser.parse_message_type(msg)
 
                 if msg_type == 'message':
-                    try:
-                        sender_id = msg['sender']['id']
-                        msg_data = {
-                            'mid': msg['message']['mid'],
-                            'raw': json.dumps(msg)
-                        }
-                        msgt.put(sender_id, msg_data)
-                        reply_trigger.invoke(msg)
-                    except Exception as e:
-                        print(e)
+                    messages.append(msg)
                 elif msg_type == 'message_deliveries':
                     continue
                 else:
                     print("cannot handle webhook: {}".format(msg_type))
-    return {"success": True}
+
+    records = []
+    for msg in messages:
+        msg_data = {
+            'mid': msg['message']['mid'],
+            'raw': json.dumps(msg)
+        }
+        records.append((msg['sender']['id'], msg_data, msg.get('timestamp')))
+
+    # redeliveries are acknowledged without triggering the reply again
+    dedup = get_deduplicator()
+    statuses = dedup.store(msgt, records) if records else []
+    results = []
+    to_reply = []
+    for msg, (_, msg_data, _), status in zip(messages, records, statuses):
+        mid = msg['message']['mid']
+        if status == 'stored':
+            msg[AsyncReplyTrigger.MSG_KEY_FIELD] = msgt.item_key(msg_data)
+            to_reply.append(msg)
+            results.append({'mid': mid, 'success': True})
+        elif status == 'duplicate':
+            results.append({'mid': mid, 'success': True, 'duplicate': True})
+        else:
+            print("cannot store mid {}".format(mid))
+            results.append({'mid': mid, 'success': False})
+
+    undispatched = []
+    if to_reply:
+        try:
+            get_dispatcher().dispatch(to_reply)
+        except DispatchError as e:
+            print(e)
+            undispatched = e.messages
+        except Exception as e:
+            print(e)
+            undispatched = to_reply
+
+    if undispatched:
+        # not replied, let a redelivery store and trigger them again.
+        # Dispatched ones stay stored, their redelivery is a duplicate.
+        mids = set()
+        for msg in undispatched:
+            msgt.delete(msg[AsyncReplyTrigger.MSG_KEY_FIELD])
+            mids.add(msg['message']['mid'])
+        dedup.forget(mids)
+        for ret in results:
+            if ret['mid'] in mids:
+                ret['success'] = False
+
+    if not all(ret['success'] for ret in results):
+        # Facebook redelivers on a non-2xx response only
+        return Response(body=json.dumps({"success": False, "results": results}),
+                        status_code=500,
+                        headers={'Content-Type': 'application/json'})
+    return {"success": True, "results": results}
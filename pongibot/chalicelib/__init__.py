@@ -1,3 +1,7 @@
 from .msg_parser import FacebookMsgParser
 from .ddb_models import MsgTable
 from .async_reply_trigger import AsyncReplyTrigger
+from .dispatch import get_dispatcher, set_dispatcher, LambdaDispatcher, \
+    SqsFifoDispatcher, InProcessDispatcher, DispatchError
+from .dedup import get_deduplicator, MsgDeduplicator
+from . import metrics
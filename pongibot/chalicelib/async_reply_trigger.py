@@ -2,20 +2,106 @@ from __future__ import print_function
 
 import os
 import json
-import boto3
+from collections import OrderedDict
 
-boto3.setup_default_session(region_name='us-east-1')
+from . import clients
+from . import metrics
 
 
 class AsyncReplyTrigger(object):
 
+    # async (Event) invocation payload limit is 128 KB
+    MAX_PAYLOAD_SIZE = 128 * 1024
+    # '{"senders": []}' around the sender groups
+    PAYLOAD_OVERHEAD = 15
+
+    # MsgTable primary key of the stored message, lets the reply lambda
+    # update it without the mid-index lookup
+    MSG_KEY_FIELD = '_msg_key'
+
     def __init__(self):
-        self.client = boto3.client('lambda')
+        self.client = clients.get_client('lambda')
         self.function_name = os.environ["REPLY_LAMBDA_NAME"]
 
-    def invoke(self, message):
-        resp = self.client.invoke(
-            FunctionName=self.function_name,
-            InvocationType='Event',
-            Payload=json.dumps(message))
+    @classmethod
+    def group_by_sender(cls, messages):
+        groups = OrderedDict()
+        for msg in messages:
+            sender_id = msg['sender']['id']
+            groups.setdefault(sender_id, []).append(msg)
+
+        ret = []
+        for sender_id, msgs in groups.items():
+            msgs.sort(key=lambda m: m.get('timestamp', 0))
+            ret.append({
+                'sender_id': sender_id,
+                'messages': msgs,
+            })
+        return ret
+
+    def build_payloads(self, messages):
+        """json payloads under MAX_PAYLOAD_SIZE for a list of messages
+
+        Messages are grouped by sender and keep their order within each
+        group. Payload format:
+
+            {"senders": [{"sender_id": ..., "messages": [...]}, ...]}
+
+        A sender group too large for one payload is split into chunks of
+        consecutive messages, in order over the following payloads.
+        Lambdas of separate payloads can run at the same time, so the
+        chunks are ordered by their invocations only.
+
+        return: list of (payload, messages of the payload)
+        """
+        payloads = []
+        batch = []
+        size = self.PAYLOAD_OVERHEAD
+        for group in self.group_by_sender(messages):
+            for chunk in self._split_group(group):
+                chunk_size = len(json.dumps(chunk)) + 2
+                if batch and size + chunk_size > self.MAX_PAYLOAD_SIZE:
+                    payloads.append(self._payload(batch))
+                    batch = []
+                    size = self.PAYLOAD_OVERHEAD
+                batch.append(chunk)
+                size += chunk_size
+        if batch:
+            payloads.append(self._payload(batch))
+        return payloads
+
+    def _split_group(self, group):
+        """return: sender groups of consecutive messages under the limit
+
+        A single message over the limit is left alone in its group, the
+        invoke then fails with the payload size error of Lambda.
+        """
+        empty_size = self.PAYLOAD_OVERHEAD + \
+            len(json.dumps(dict(group, messages=[]))) + 2
+        chunks = []
+        msgs = []
+        size = empty_size
+        for msg in group['messages']:
+            msg_size = len(json.dumps(msg)) + 2
+            if msgs and size + msg_size > self.MAX_PAYLOAD_SIZE:
+                chunks.append(dict(group, messages=msgs))
+                msgs = []
+                size = empty_size
+            msgs.append(msg)
+            size += msg_size
+        chunks.append(dict(group, messages=msgs))
+        return chunks
+
+    @staticmethod
+    def _payload(groups):
+        messages = [msg for group in groups for msg in group['messages']]
+        return json.dumps({'senders': groups}), messages
+
+    def invoke_payload(self, payload):
+        """async invoke of the reply lambda with one of build_payloads"""
+        with metrics.timer('lambda.invoke'):
+            resp = self.client.invoke(
+                FunctionName=self.function_name,
+                InvocationType='Event',
+                Payload=payload)
         print("triggered lambda with response code: {}".format(resp['StatusCode']))
@@ -1,8 +1,16 @@
 from __future__ import print_function
 
 import os
-import boto3
-from datetime import datetime
+import time
+import random
+from datetime import datetime, timedelta
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+from . import clients
+
+# conditional puts of one webhook payload run in parallel
+PUT_EXECUTOR = ThreadPoolExecutor(max_workers=int(os.environ.get("PUT_WORKERS", 4)))
 
 
 class BaseDDBTable(object):
@@ -10,7 +18,7 @@ class BaseDDBTable(object):
     """
 
     def __init__(self):
-        self.dynamodb = boto3.resource('dynamodb')
+        self.dynamodb = clients.get_resource('dynamodb')
 
     def _get_item(self, p_val, consistent=True):
         """Wrapper for get_item function
@@ -42,10 +50,55 @@ class BaseDDBTable(object):
 
 
 class TimestampBasedDDBTable(BaseDDBTable):
+    """Table with a timestamp range key
+
+    TIMESTAMP_KEY_FORMAT selects the range key encoding, and must match
+    the one of the reply lambda:
+
+    - "iso": datetime.now().isoformat() string
+    - "epoch_ms": number, epoch milliseconds * EPOCH_SEQ_SIZE + sequence
+      of the events within that millisecond
+    """
+
+    KEY_FORMATS = ('iso', 'epoch_ms')
+    EPOCH_SEQ_SIZE = 1000
+
+    def __init__(self):
+        super(TimestampBasedDDBTable, self).__init__()
+        self.key_format = os.environ.get("TIMESTAMP_KEY_FORMAT", "iso")
+        if self.key_format not in self.KEY_FORMATS:
+            raise ValueError("Invalid timestamp key format: ", self.key_format)
+
+    def _new_timestamp(self):
+        """current time
+
+        return: datetime for "iso", number for "epoch_ms"
+        """
+        if self.key_format == 'epoch_ms':
+            return int(time.time() * 1000) * self.EPOCH_SEQ_SIZE
+        return datetime.now()
+
+    def _event_timestamp(self, event_time, seq=0):
+        """range key of a webhook event time, the same for redeliveries
+
+        event_time: epoch milliseconds
+        seq: tells apart events of the same millisecond
+
+        return: datetime for "iso", number for "epoch_ms"
+        """
+        if self.key_format == 'epoch_ms':
+            return int(event_time) * self.EPOCH_SEQ_SIZE + seq
+        return datetime(1970, 1, 1) + timedelta(
+            milliseconds=int(event_time), microseconds=seq)
+
+    def _range_value(self, ts):
+        if self.key_format == 'epoch_ms':
+            return ts
+        return ts.isoformat()
 
     def _put_item_with_timestamp(self, p_val, data):
         data[self.primary_key] = p_val
-        data[self.range_key] = datetime.now().isoformat()
+        data[self.range_key] = self._range_value(self._new_timestamp())
         ret = self._put_item(data)
         return ret != None
 
@@ -61,7 +114,132 @@ class MsgTable(TimestampBasedDDBTable):
         self.primary_key = 'user_id'
         self.range_key = 'timestamp'
         self.table_name = os.environ["MSG_TABLE"]
-        self.table = self.dynamodb.Table(self.table_name)
+        self.table = clients.get_table(self.table_name)
 
     def put(self, user_id, msg):
         return self._put_item_with_timestamp(user_id, msg)
+
+    def item_key(self, item):
+        """primary key of a stored message
+
+        return: dict
+        """
+        return {
+            self.primary_key: item[self.primary_key],
+            self.range_key: item[self.range_key],
+        }
+
+    # other messages of the sender with the same event time
+    MAX_KEY_COLLISIONS = 10
+
+    # throttled and 5xx calls are retried, with jittered exponential
+    # backoff, before a message fails and the payload is redelivered
+    RETRIES = 5
+    RETRY_BACKOFF = 0.05
+    RETRY_ERRORS = ('ProvisionedThroughputExceededException',
+                    'ThrottlingException', 'RequestLimitExceeded',
+                    'InternalServerError')
+
+    def _is_retryable(self, error):
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+        return error.response['Error']['Code'] in self.RETRY_ERRORS or \
+            (status is not None and status >= 500)
+
+    def _backoff(self, attempt):
+        """sleep before retry attempt, 1 for the first retry"""
+        time.sleep(random.uniform(0, self.RETRY_BACKOFF * (2 ** attempt)))
+
+    def _put_new(self, item):
+        """conditional put of an item with a new key
+
+        A retry can find the item written by the attempt that failed, it
+        counts as stored then.
+
+        return: True if stored, False if the key is taken
+        raise: ClientError if not retryable, or when retries run out
+        """
+        for attempt in range(self.RETRIES + 1):
+            if attempt > 0:
+                self._backoff(attempt)
+            try:
+                self.table.put_item(
+                    Item=item,
+                    ConditionExpression='attribute_not_exists(#pk)',
+                    ExpressionAttributeNames={'#pk': self.primary_key})
+                return True
+            except ClientError as e:
+                code = e.response['Error']['Code']
+                if code == 'ConditionalCheckFailedException':
+                    if attempt == 0:
+                        return False
+                    stored = self._get_stored(item)
+                    return stored is not None and stored.get('mid') == item['mid']
+                if attempt == self.RETRIES or not self._is_retryable(e):
+                    raise
+                print("put of mid {} failed, retry: {}".format(item['mid'], code))
+
+    def _get_stored(self, item):
+        """return: stored item with the key of item, None if missing"""
+        for attempt in range(self.RETRIES + 1):
+            if attempt > 0:
+                self._backoff(attempt)
+            try:
+                return self.table.get_item(
+                    Key=self.item_key(item), ConsistentRead=True).get('Item')
+            except ClientError as e:
+                if attempt == self.RETRIES or not self._is_retryable(e):
+                    raise
+                print("get of mid {} failed, retry: {}".format(
+                    item['mid'], e.response['Error']['Code']))
+
+    def put_once(self, user_id, msg, event_time):
+        """store a message unless it is stored already
+
+        The range key comes from the webhook event time, so a redelivery
+        of the message gets the same key and is rejected by a conditional
+        put. A key taken by another mid is skipped. Throttled and 5xx
+        errors are retried, see RETRIES.
+
+        event_time: epoch milliseconds of the webhook event
+
+        return: 'stored', 'duplicate' or 'failed'
+        """
+        if event_time is None:
+            event_time = int(time.time() * 1000)
+        msg[self.primary_key] = user_id
+        for seq in range(self.MAX_KEY_COLLISIONS):
+            msg[self.range_key] = self._range_value(
+                self._event_timestamp(event_time, seq))
+            try:
+                if self._put_new(msg):
+                    return 'stored'
+                stored = self._get_stored(msg)
+            except ClientError as e:
+                print(e)
+                return 'failed'
+            if stored is not None and stored.get('mid') == msg['mid']:
+                return 'duplicate'
+        print("no free key for mid {}".format(msg['mid']))
+        return 'failed'
+
+    def batch_put_once(self, records):
+        """put_once for several messages, in parallel
+
+        records: list of (user_id, msg, event_time) tuple
+
+        return: list of put_once results, one per record
+        """
+        futures = [PUT_EXECUTOR.submit(self.put_once, *record)
+                   for record in records]
+        results = []
+        for f in futures:
+            try:
+                results.append(f.result())
+            except Exception as e:
+                print(e)
+                results.append('failed')
+        return results
+
+    def delete(self, key):
+        """delete a stored message, so a redelivery is stored again"""
+        self.table.delete_item(Key=key)
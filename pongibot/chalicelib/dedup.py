@@ -0,0 +1,92 @@
+from __future__ import print_function
+
+import os
+import threading
+
+from . import metrics
+from .cache import LRUCache
+
+
+class MsgDeduplicator(object):
+    """Suppress Facebook webhook redeliveries by message mid
+
+    Mids handled by this warm container are dropped from memory. The
+    others are stored with MsgTable.put_once, whose conditional put
+    rejects mids already stored by any container. The counters are
+    emitted as dedup.<counter> metrics too.
+    """
+
+    COUNTERS = ('stored', 'memory_duplicates', 'table_duplicates', 'failed')
+
+    def __init__(self, max_size=4096, ttl=3600):
+        self.seen = LRUCache(max_size=max_size, ttl=ttl)
+        self._lock = threading.Lock()
+        self.counts = dict((k, 0) for k in self.COUNTERS)
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+        metrics.count('dedup.{}'.format(name), n)
+
+    def store(self, msg_table, records):
+        """store new messages, skip redelivered ones
+
+        records: list of (user_id, msg_data, event_time) tuple, msg_data
+                 with the message mid
+
+        return: list of 'stored', 'duplicate' or 'failed', one per record
+        """
+        statuses = [None] * len(records)
+        to_put = []
+        indexes = []
+        for i, record in enumerate(records):
+            mid = record[1]['mid']
+            if self.seen.get(mid) is not None:
+                statuses[i] = 'duplicate'
+                self._count('memory_duplicates')
+                continue
+            # also catches the same mid twice in one payload
+            self.seen.set(mid, True)
+            to_put.append(record)
+            indexes.append(i)
+
+        for i, status in zip(indexes, msg_table.batch_put_once(to_put)):
+            statuses[i] = status
+            if status == 'stored':
+                self._count('stored')
+            elif status == 'duplicate':
+                self._count('table_duplicates')
+            else:
+                self._count('failed')
+                self.seen.pop(records[i][1]['mid'])
+
+        duplicates = statuses.count('duplicate')
+        metrics.count('dedup.suppressed', duplicates)
+        if duplicates:
+            print("suppressed {} duplicate messages, {}".format(
+                duplicates, self.stats()))
+        return statuses
+
+    def forget(self, mids):
+        """let later deliveries of mids through the memory check"""
+        for mid in mids:
+            self.seen.pop(mid)
+
+    def stats(self):
+        with self._lock:
+            ret = dict(self.counts)
+        ret['suppressed'] = ret['memory_duplicates'] + ret['table_duplicates']
+        return ret
+
+
+_DEDUPLICATOR = None
+
+
+def get_deduplicator():
+    """process wide deduplicator, kept by the warm container"""
+    global _DEDUPLICATOR
+    if _DEDUPLICATOR is None:
+        _DEDUPLICATOR = MsgDeduplicator(
+            max_size=int(os.environ.get("DEDUP_CACHE_SIZE", 4096)),
+            ttl=int(os.environ.get("DEDUP_CACHE_TTL", 3600)))
+    return _DEDUPLICATOR
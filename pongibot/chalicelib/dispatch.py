@@ -0,0 +1,244 @@
+from __future__ import print_function
+
+import os
+import json
+import time
+import threading
+from abc import ABCMeta, abstractmethod
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import clients
+from . import metrics
+from .async_reply_trigger import AsyncReplyTrigger
+
+
+class DispatchError(Exception):
+    """Some messages were not handed to the reply worker
+
+    messages: the messages not dispatched, the others were
+    """
+
+    def __init__(self, messages, cause=None):
+        super(DispatchError, self).__init__(
+            "{} messages not dispatched: {}".format(len(messages), cause))
+        self.messages = messages
+
+
+class BaseDispatcher(object):
+    """Dispatch messages to the reply worker, partitioned by sender id
+
+    Messages of one sender are processed in order, different senders
+    can be processed in parallel.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def dispatch(self, messages):
+        """hand messages to the reply worker
+
+        raise: DispatchError with the messages not dispatched
+        """
+        pass
+
+
+class LambdaDispatcher(BaseDispatcher):
+    """Invoke the reply lambda once per webhook payload
+
+    Order is kept within one payload only, two payloads of the same
+    sender still run in separate lambdas, which can overlap. Use
+    SqsFifoDispatcher to keep the order across payloads.
+    """
+
+    def __init__(self, trigger=None):
+        self.trigger = trigger or AsyncReplyTrigger()
+
+    def dispatch(self, messages):
+        """raise: DispatchError with the messages of the payloads from
+                  the first failed invoke on
+        """
+        payloads = self.trigger.build_payloads(messages)
+        for i, (payload, _) in enumerate(payloads):
+            try:
+                self.trigger.invoke_payload(payload)
+            except Exception as e:
+                left = [msg for _, msgs in payloads[i:] for msg in msgs]
+                raise DispatchError(left, e)
+        return len(payloads)
+
+
+class SqsFifoDispatcher(BaseDispatcher):
+    """Send messages to a FIFO queue, one message group per sender
+
+    The reply lambda is subscribed to the queue. Lambda hands it the
+    messages of a group in order, and the next ones of that group only
+    after the previous batch is done, so a sender is never processed by
+    two lambdas at once, whatever the webhook payload they came in.
+    Different groups are processed in parallel. The mid is the
+    deduplication id, a message sent twice within 5 minutes is dropped
+    by the queue.
+    """
+
+    # send_message_batch accepts 10 entries, 256 KB in total
+    MAX_BATCH_COUNT = 10
+    MAX_BATCH_SIZE = 256 * 1024
+
+    def __init__(self, queue_url=None):
+        self.client = clients.get_client('sqs')
+        self.queue_url = queue_url or os.environ["REPLY_QUEUE_URL"]
+
+    def dispatch(self, messages):
+        """raise: DispatchError with the failed entries and the messages
+                  of the later batches, which are not sent
+        """
+        # sorted by sender and time, as in the lambda payloads
+        ordered = [msg for group in AsyncReplyTrigger.group_by_sender(messages)
+                   for msg in group['messages']]
+        batches = self._split_batches(ordered)
+        for i, batch in enumerate(batches):
+            try:
+                failed = self._send_batch(batch)
+            except Exception as e:
+                failed = batch
+                cause = e
+            else:
+                cause = "{} entries failed".format(len(failed))
+            if failed:
+                left = failed + [msg for b in batches[i + 1:] for msg in b]
+                raise DispatchError(left, cause)
+        return len(batches)
+
+    def _split_batches(self, messages):
+        batches = []
+        batch = []
+        size = 0
+        for msg in messages:
+            msg_size = len(json.dumps(msg))
+            if batch and (len(batch) >= self.MAX_BATCH_COUNT or
+                          size + msg_size > self.MAX_BATCH_SIZE):
+                batches.append(batch)
+                batch = []
+                size = 0
+            batch.append(msg)
+            size += msg_size
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def _send_batch(self, batch):
+        """return: messages of the failed entries"""
+        entries = []
+        for i, msg in enumerate(batch):
+            entries.append({
+                'Id': str(i),
+                'MessageBody': json.dumps(msg),
+                'MessageGroupId': msg['sender']['id'],
+                'MessageDeduplicationId': msg['message']['mid'][:128],
+            })
+        with metrics.timer('sqs.send_message_batch'):
+            resp = self.client.send_message_batch(
+                QueueUrl=self.queue_url, Entries=entries)
+        for failure in resp.get('Failed', []):
+            print("cannot queue message: {}".format(failure))
+        return [batch[int(failure['Id'])] for failure in resp.get('Failed', [])]
+
+
+class InProcessDispatcher(BaseDispatcher):
+    """Thread pool with one queue per sender, for local runs and tests
+
+    A sender queue is drained by at most one worker at a time, in
+    batches of up to batch_size messages. Each batch is passed to
+    process with the reply lambda payload format:
+
+        {"senders": [{"sender_id": ..., "messages": [...]}]}
+
+    so process can be the reply lambda handler itself.
+    """
+
+    def __init__(self, process, max_workers=4, batch_size=10):
+        self.process = process
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._queues = OrderedDict()
+        self._active = set()
+
+    def dispatch(self, messages):
+        with self._lock:
+            for msg in messages:
+                sender_id = msg['sender']['id']
+                self._queues.setdefault(sender_id, deque()).append(msg)
+                if sender_id not in self._active:
+                    self._active.add(sender_id)
+                    self.executor.submit(self._drain, sender_id)
+        return len(messages)
+
+    def _next_batch(self, sender_id):
+        with self._lock:
+            queue = self._queues.get(sender_id)
+            batch = []
+            while queue and len(batch) < self.batch_size:
+                batch.append(queue.popleft())
+            if not batch:
+                self._queues.pop(sender_id, None)
+                self._active.discard(sender_id)
+                self._idle.notify_all()
+            return batch
+
+    def _drain(self, sender_id):
+        batch = self._next_batch(sender_id)
+        while batch:
+            payload = {
+                'senders': [{
+                    'sender_id': sender_id,
+                    'messages': batch,
+                }]
+            }
+            try:
+                self.process(payload, None)
+            except Exception as e:
+                print("failed to process messages of {}: {}".format(sender_id, e))
+            batch = self._next_batch(sender_id)
+
+    def join(self, timeout=None):
+        """wait until all queued messages are processed
+
+        return: boolean (all processed or not)
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._lock:
+            while self._active:
+                left = None if deadline is None else deadline - time.time()
+                if left is not None and left <= 0:
+                    break
+                self._idle.wait(left)
+            return not self._active
+
+
+_DISPATCHER = None
+
+
+def set_dispatcher(dispatcher):
+    """use dispatcher for all webhook calls of this process"""
+    global _DISPATCHER
+    _DISPATCHER = dispatcher
+
+
+def get_dispatcher():
+    """configured dispatcher, the lambda one by default
+
+    REPLY_DISPATCHER=sqs sends to the FIFO queue REPLY_QUEUE_URL.
+    REPLY_DISPATCHER=inprocess requires set_dispatcher to be called with
+    an InProcessDispatcher first.
+    """
+    global _DISPATCHER
+    if _DISPATCHER is None:
+        backend = os.environ.get("REPLY_DISPATCHER", "lambda")
+        if backend == "lambda":
+            _DISPATCHER = LambdaDispatcher()
+        elif backend == "sqs":
+            _DISPATCHER = SqsFifoDispatcher()
+        else:
+            raise ValueError("Dispatcher not configured: ", backend)
+    return _DISPATCHER
@@ -0,0 +1,218 @@
+# Shared by pongibot/chalicelib and pongibot-async-reply. Both copies
+# must stay identical, create_lambda.sh refuses to deploy otherwise.
+from __future__ import print_function
+
+import os
+import json
+import math
+import time
+import random
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+NAMESPACE = os.environ.get("METRICS_NAMESPACE", "Pongibot")
+
+# CloudWatch accepts at most 100 values per metric in one record
+MAX_VALUES = 100
+
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+
+class Histogram(object):
+    """Latency histogram with logarithmic buckets
+
+    Bucket bounds grow by GROWTH, so percentiles are off by at most
+    about 5% whatever the range of values, in constant memory.
+    """
+
+    GROWTH = 1.1
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = int(math.ceil(math.log(max(value, 0.001), self.GROWTH)))
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        """return: upper bound of the bucket holding the p-th percentile"""
+        if not self.count:
+            return 0.0
+        rank = p / 100.0 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.GROWTH ** index, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': round(self.total / self.count, 3) if self.count else 0.0,
+            'p50': round(self.percentile(50), 3),
+            'p90': round(self.percentile(90), 3),
+            'p99': round(self.percentile(99), 3),
+            'max': round(self.max, 3),
+        }
+
+
+class MetricsRecorder(object):
+    """Collect timings and counts, emit them as CloudWatch embedded metrics
+
+    Values recorded since the last flush are printed as one embedded
+    metric format (EMF) log record, which CloudWatch turns into metrics
+    without API calls. Histograms keep running for the warm container
+    and are added to the record as properties.
+    """
+
+    def __init__(self, namespace=NAMESPACE):
+        self.namespace = namespace
+        self.enabled = os.environ.get("METRICS_ENABLED", "1") != "0"
+        self._lock = threading.Lock()
+        self._timings = {}
+        self._counts = {}
+        self.histograms = {}
+
+    def record(self, name, ms):
+        with self._lock:
+            self._timings.setdefault(name, []).append(ms)
+            if name not in self.histograms:
+                self.histograms[name] = Histogram()
+            self.histograms[name].add(ms)
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    @contextmanager
+    def timer(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, (time.time() - start) * 1000)
+
+    def timed(self, name):
+        """decorator, time every call as name"""
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def flush(self, function):
+        """print pending values as one EMF record
+
+        return: the record, None if there was nothing to emit
+        """
+        with self._lock:
+            timings, self._timings = self._timings, {}
+            counts, self._counts = self._counts, {}
+            histograms = dict((name, self.histograms[name].summary())
+                              for name in timings)
+        if not self.enabled or not (timings or counts):
+            return None
+
+        definitions = []
+        record = {'Function': function}
+        for name, values in sorted(timings.items()):
+            definitions.append({'Name': name, 'Unit': 'Milliseconds'})
+            record[name] = [round(v, 3) for v in values[-MAX_VALUES:]]
+        for name, n in sorted(counts.items()):
+            definitions.append({'Name': name, 'Unit': 'Count'})
+            record[name] = n
+        record['histograms'] = histograms
+        record['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': self.namespace,
+                'Dimensions': [['Function']],
+                'Metrics': definitions,
+            }],
+        }
+        print(json.dumps(record, sort_keys=True))
+        return record
+
+
+class TimedCalls(object):
+    """Proxy timing every method call of a client as <prefix>.<method>"""
+
+    def __init__(self, client, prefix):
+        self._client = client
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if not callable(attr):
+            return attr
+        metric = '{}.{}'.format(self._prefix, name)
+
+        def timed_call(*args, **kwargs):
+            with timer(metric):
+                return attr(*args, **kwargs)
+        return timed_call
+
+
+RECORDER = MetricsRecorder()
+
+
+def timer(name):
+    return RECORDER.timer(name)
+
+
+def timed(name):
+    return RECORDER.timed(name)
+
+
+def count(name, n=1):
+    RECORDER.count(name, n)
+
+
+def timed_calls(client, prefix):
+    return TimedCalls(client, prefix)
+
+
+def entrypoint(function):
+    """decorator of a lambda entry point
+
+    Times the whole call and flushes the metrics of the invocation.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                with RECORDER.timer(function):
+                    return func(*args, **kwargs)
+            finally:
+                RECORDER.flush(function)
+        return wrapper
+    return decorator
+
+
+def log_payload(name, payload, level='DEBUG'):
+    """print a payload if LOG_LEVEL allows level, else a sample of them
+
+    PAYLOAD_LOG_SAMPLE is the fraction of payloads printed below
+    LOG_LEVEL, and PAYLOAD_LOG_MAX_CHARS truncates them.
+    """
+    threshold = LOG_LEVELS.get(os.environ.get("LOG_LEVEL", "INFO").upper(), 20)
+    if LOG_LEVELS.get(level, 10) < threshold:
+        sample = float(os.environ.get("PAYLOAD_LOG_SAMPLE", 0.01))
+        if random.random() >= sample:
+            return False
+    text = json.dumps(payload, default=str)
+    max_chars = int(os.environ.get("PAYLOAD_LOG_MAX_CHARS", 2000))
+    if len(text) > max_chars:
+        text = text[:max_chars] + '...({} chars)'.format(len(text))
+    print("{}: {}".format(name, text))
+    return True
@@ -0,0 +1,30 @@
+"""Fixtures of the webhook tests
+
+chalicelib runs on the in-memory DynamoDB of the reply lambda tools.
+"""
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(HERE)), 'pongibot-async-reply', 'tools'))
+
+os.environ.setdefault('MSG_TABLE', 'MSG_TABLE')
+os.environ.setdefault('REPLY_LAMBDA_NAME', 'REPLY_LAMBDA_NAME')
+os.environ['METRICS_ENABLED'] = '0'
+
+import fakes
+from chalicelib import clients
+
+
+@pytest.fixture
+def db(monkeypatch):
+    monkeypatch.setenv('TIMESTAMP_KEY_FORMAT', 'iso')
+    db = fakes.FakeDynamoDB(fakes.CallStats())
+    db.create_table('MSG_TABLE', 'user_id', 'timestamp',
+                    indexes={'mid-index': ('mid', None)})
+    clients.set_resource('dynamodb', db)
+    return db
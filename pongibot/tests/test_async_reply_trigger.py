@@ -0,0 +1,91 @@
+import json
+
+import pytest
+
+from chalicelib import clients
+from chalicelib.async_reply_trigger import AsyncReplyTrigger
+
+
+class FakeLambda(object):
+
+    def __init__(self):
+        self.payloads = []
+
+    def invoke(self, FunctionName, InvocationType, Payload):
+        self.payloads.append(Payload)
+        return {'StatusCode': 202}
+
+
+@pytest.fixture
+def trigger(monkeypatch):
+    monkeypatch.setattr(AsyncReplyTrigger, 'MAX_PAYLOAD_SIZE', 2000)
+    clients.set_client('lambda', FakeLambda())
+    return AsyncReplyTrigger()
+
+
+def message(sender_id, n, size=200):
+    return {'sender': {'id': sender_id}, 'timestamp': n,
+            'message': {'mid': '{}{}'.format(sender_id, n), 'text': 'x' * size}}
+
+
+def mids(messages):
+    return [m['message']['mid'] for m in messages]
+
+
+def sender_mids(payloads, sender_id):
+    """mids of sender_id in payload order, read from the payloads"""
+    ret = []
+    for payload, _ in payloads:
+        for group in json.loads(payload)['senders']:
+            if group['sender_id'] == sender_id:
+                ret += mids(group['messages'])
+    return ret
+
+
+def test_one_payload(trigger):
+    messages = [message('A', 1, 10), message('B', 1, 10)]
+    payloads = trigger.build_payloads(messages)
+    assert len(payloads) == 1
+    payload, sent = payloads[0]
+    assert [g['sender_id'] for g in json.loads(payload)['senders']] == ['A', 'B']
+    assert mids(sent) == ['A1', 'B1']
+
+
+def test_sender_group_is_split(trigger):
+    messages = [message('A', n) for n in range(20)]
+    payloads = trigger.build_payloads(messages)
+    assert len(payloads) > 1
+    for payload, sent in payloads:
+        assert len(payload) <= AsyncReplyTrigger.MAX_PAYLOAD_SIZE
+        assert mids(sent) == mids(m for g in json.loads(payload)['senders']
+                                  for m in g['messages'])
+    assert sender_mids(payloads, 'A') == mids(messages)
+
+
+def test_order_per_sender_across_payloads(trigger):
+    messages = []
+    for n in range(15):
+        for sender_id in ('A', 'B', 'C'):
+            messages.append(message(sender_id, n))
+    # delivered out of order
+    messages.reverse()
+    payloads = trigger.build_payloads(messages)
+    assert len(payloads) > 3
+    for sender_id in ('A', 'B', 'C'):
+        assert sender_mids(payloads, sender_id) == \
+            ['{}{}'.format(sender_id, n) for n in range(15)]
+    assert sorted(mids(m for _, sent in payloads for m in sent)) == \
+        sorted(mids(messages))
+
+
+def test_message_over_limit_is_alone(trigger):
+    messages = [message('A', 1), message('A', 2, 3000), message('A', 3)]
+    payloads = trigger.build_payloads(messages)
+    assert [mids(sent) for _, sent in payloads] == [['A1'], ['A2'], ['A3']]
+    assert len(payloads[1][0]) > AsyncReplyTrigger.MAX_PAYLOAD_SIZE
+
+
+def test_invoke_payload(trigger):
+    payload, _ = trigger.build_payloads([message('A', 1)])[0]
+    trigger.invoke_payload(payload)
+    assert trigger.client.payloads == [payload]
@@ -0,0 +1,138 @@
+import pytest
+from botocore.exceptions import ClientError
+
+from chalicelib import metrics
+from chalicelib.ddb_models import MsgTable
+from chalicelib.dedup import MsgDeduplicator
+
+EVENT_TIME = 1488371400123
+
+
+def stored_mids(db):
+    return [item['mid'] for _, item in sorted(db.items['MSG_TABLE'].items())]
+
+
+def test_put_once_stores_new_message(db):
+    assert MsgTable().put_once('U', {'mid': 'a'}, EVENT_TIME) == 'stored'
+    assert stored_mids(db) == ['a']
+
+
+def test_put_once_rejects_redelivery(db):
+    table = MsgTable()
+    assert table.put_once('U', {'mid': 'a'}, EVENT_TIME) == 'stored'
+    assert table.put_once('U', {'mid': 'a'}, EVENT_TIME) == 'duplicate'
+    assert stored_mids(db) == ['a']
+
+
+def test_put_once_skips_key_of_other_mid(db):
+    table = MsgTable()
+    assert table.put_once('U', {'mid': 'a'}, EVENT_TIME) == 'stored'
+    assert table.put_once('U', {'mid': 'b'}, EVENT_TIME) == 'stored'
+    assert table.put_once('U', {'mid': 'b'}, EVENT_TIME) == 'duplicate'
+    assert stored_mids(db) == ['a', 'b']
+
+
+def test_put_once_same_key_epoch_ms(db, monkeypatch):
+    monkeypatch.setenv('TIMESTAMP_KEY_FORMAT', 'epoch_ms')
+    table = MsgTable()
+    assert table.put_once('U', {'mid': 'a'}, EVENT_TIME) == 'stored'
+    assert table.put_once('U', {'mid': 'a'}, EVENT_TIME) == 'duplicate'
+    assert sorted(db.items['MSG_TABLE']) == [('U', EVENT_TIME * 1000)]
+
+
+def test_put_once_fails_without_free_key(db):
+    table = MsgTable()
+    for i in range(table.MAX_KEY_COLLISIONS):
+        assert table.put_once('U', {'mid': str(i)}, EVENT_TIME) == 'stored'
+    assert table.put_once('U', {'mid': 'x'}, EVENT_TIME) == 'failed'
+
+
+def failing_put(table, codes, write=False):
+    """put_item raising ClientErrors of codes first, then putting
+
+    write: the failed attempts still write the item
+    """
+    put_item = table.table.put_item
+    calls = []
+
+    def put(**kwargs):
+        calls.append(kwargs['Item']['mid'])
+        if len(calls) <= len(codes):
+            if write:
+                put_item(**kwargs)
+            error = {'Code': codes[len(calls) - 1]}
+            raise ClientError({'Error': error, 'ResponseMetadata': {
+                'HTTPStatusCode': 500 if write else 400}}, 'PutItem')
+        return put_item(**kwargs)
+    table.table.put_item = put
+    return calls
+
+
+@pytest.fixture
+def msg_table(db, monkeypatch):
+    monkeypatch.setattr(MsgTable, 'RETRY_BACKOFF', 0)
+    return MsgTable()
+
+
+def test_put_once_retries_throttling(db, msg_table):
+    calls = failing_put(msg_table, ['ProvisionedThroughputExceededException',
+                                    'ThrottlingException'])
+    assert msg_table.put_once('U', {'mid': 'a'}, EVENT_TIME) == 'stored'
+    assert len(calls) == 3
+    assert stored_mids(db) == ['a']
+
+
+def test_put_once_fails_when_retries_run_out(db, msg_table):
+    calls = failing_put(
+        msg_table, ['ThrottlingException'] * (MsgTable.RETRIES + 1))
+    assert msg_table.put_once('U', {'mid': 'a'}, EVENT_TIME) == 'failed'
+    assert len(calls) == MsgTable.RETRIES + 1
+    assert stored_mids(db) == []
+
+
+def test_put_once_fails_on_other_error(db, msg_table):
+    calls = failing_put(msg_table, ['ValidationException'])
+    assert msg_table.put_once('U', {'mid': 'a'}, EVENT_TIME) == 'failed'
+    assert len(calls) == 1
+
+
+def test_put_once_retry_finds_own_write(db, msg_table):
+    # the put was applied, its response was lost
+    failing_put(msg_table, ['InternalServerError'], write=True)
+    assert msg_table.put_once('U', {'mid': 'a'}, EVENT_TIME) == 'stored'
+    assert stored_mids(db) == ['a']
+
+
+def test_deduplicator_counts_duplicates(db):
+    table = MsgTable()
+    records = [('U', {'mid': 'a'}, EVENT_TIME),
+               ('U', {'mid': 'b'}, EVENT_TIME),
+               ('U', {'mid': 'a'}, EVENT_TIME)]
+    dedup = MsgDeduplicator()
+    assert dedup.store(table, records) == ['stored', 'stored', 'duplicate']
+
+    # another container only sees the table
+    other = MsgDeduplicator()
+    assert other.store(table, records[:1]) == ['duplicate']
+    assert other.stats()['table_duplicates'] == 1
+
+
+def test_deduplicator_forget_lets_redelivery_in(db):
+    table = MsgTable()
+    dedup = MsgDeduplicator()
+    dedup.store(table, [('U', {'mid': 'a'}, EVENT_TIME)])
+    key = table.item_key(db.items['MSG_TABLE'].values()[0])
+    table.delete(key)
+    dedup.forget(['a'])
+    assert dedup.store(table, [('U', {'mid': 'a'}, EVENT_TIME)]) == ['stored']
+
+
+def test_deduplicator_emits_metrics(db, monkeypatch):
+    recorder = metrics.MetricsRecorder()
+    monkeypatch.setattr(metrics, 'RECORDER', recorder)
+    records = [('U', {'mid': 'a'}, EVENT_TIME), ('U', {'mid': 'a'}, EVENT_TIME)]
+    MsgDeduplicator().store(MsgTable(), records)
+    counts = recorder._counts
+    assert counts['dedup.stored'] == 1
+    assert counts['dedup.memory_duplicates'] == 1
+    assert counts['dedup.suppressed'] == 1
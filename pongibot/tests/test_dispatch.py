@@ -0,0 +1,157 @@
+import json
+import threading
+import time
+
+import pytest
+
+from chalicelib import clients
+from chalicelib.async_reply_trigger import AsyncReplyTrigger
+from chalicelib.dispatch import BaseDispatcher, DispatchError, \
+    InProcessDispatcher, LambdaDispatcher, SqsFifoDispatcher
+
+
+def message(sender_id, n, mid=None):
+    return {'sender': {'id': sender_id}, 'timestamp': n,
+            'message': {'mid': mid or '{}{}'.format(sender_id, n), 'text': 'x'}}
+
+
+def mids(messages):
+    return [m['message']['mid'] for m in messages]
+
+
+class FakeSqs(object):
+    """send_message_batch failing the entries of fail_mids"""
+
+    def __init__(self, fail_mids=(), error_on_call=None):
+        self.fail_mids = set(fail_mids)
+        self.error_on_call = error_on_call
+        self.batches = []
+
+    def send_message_batch(self, QueueUrl, Entries):
+        if len(self.batches) == self.error_on_call:
+            self.batches.append(None)
+            raise RuntimeError('unavailable')
+        self.batches.append(Entries)
+        failed = [{'Id': e['Id'], 'Code': 'InternalError', 'SenderFault': False}
+                  for e in Entries
+                  if json.loads(e['MessageBody'])['message']['mid'] in self.fail_mids]
+        return {'Successful': [], 'Failed': failed}
+
+
+def sqs_dispatcher(sqs):
+    clients.set_client('sqs', sqs)
+    return SqsFifoDispatcher(queue_url='https://sqs/queue.fifo')
+
+
+def test_base_dispatcher_is_abstract():
+    with pytest.raises(TypeError):
+        BaseDispatcher()
+
+
+def test_sqs_group_and_dedup_ids():
+    sqs = FakeSqs()
+    messages = [message('B', 2), message('A', 1), message('B', 1),
+                message('A', 2, mid='m' * 200)]
+    assert sqs_dispatcher(sqs).dispatch(messages) == 1
+
+    entries = sqs.batches[0]
+    assert [e['MessageGroupId'] for e in entries] == ['B', 'B', 'A', 'A']
+    assert [e['MessageDeduplicationId'] for e in entries] == \
+        ['B1', 'B2', 'A1', 'm' * 128]
+    assert [json.loads(e['MessageBody']) for e in entries] == \
+        [messages[2], messages[0], messages[1], messages[3]]
+
+
+def test_sqs_batches_keep_order():
+    sqs = FakeSqs()
+    messages = [message('A', n) for n in range(25)]
+    assert sqs_dispatcher(sqs).dispatch(messages) == 3
+    assert [len(b) for b in sqs.batches] == [10, 10, 5]
+    assert [e['MessageDeduplicationId'] for b in sqs.batches for e in b] == \
+        mids(messages)
+
+
+def test_sqs_failed_entries_and_later_batches_are_left():
+    sqs = FakeSqs(fail_mids=['A12'])
+    messages = [message('A', n) for n in range(25)]
+    with pytest.raises(DispatchError) as e:
+        sqs_dispatcher(sqs).dispatch(messages)
+    assert mids(e.value.messages) == \
+        ['A12'] + ['A{}'.format(n) for n in range(20, 25)]
+    assert len(sqs.batches) == 2
+
+
+def test_sqs_send_error_leaves_whole_batch():
+    sqs = FakeSqs(error_on_call=1)
+    messages = [message('A', n) for n in range(15)]
+    with pytest.raises(DispatchError) as e:
+        sqs_dispatcher(sqs).dispatch(messages)
+    assert mids(e.value.messages) == ['A{}'.format(n) for n in range(10, 15)]
+
+
+class FailingTrigger(AsyncReplyTrigger):
+    """invoke failing from the fail_at-th payload on"""
+
+    MAX_PAYLOAD_SIZE = 1000
+
+    def __init__(self, fail_at):
+        self.fail_at = fail_at
+        self.invoked = []
+
+    def invoke_payload(self, payload):
+        if len(self.invoked) >= self.fail_at:
+            raise RuntimeError('throttled')
+        self.invoked.append(payload)
+
+
+def test_lambda_dispatch_error_has_uninvoked_messages():
+    trigger = FailingTrigger(fail_at=1)
+    messages = [message(s, n) for s in 'AB' for n in range(10)]
+    with pytest.raises(DispatchError) as e:
+        LambdaDispatcher(trigger).dispatch(messages)
+    invoked = [m for g in json.loads(trigger.invoked[0])['senders']
+               for m in g['messages']]
+    assert mids(invoked) + mids(e.value.messages) == mids(messages)
+    assert e.value.messages
+
+
+def test_in_process_keeps_order_per_sender():
+    lock = threading.Lock()
+    processed = {}
+    running = set()
+    overlaps = []
+
+    def process(event, context):
+        group, = event['senders']
+        sender_id = group['sender_id']
+        with lock:
+            if sender_id in running:
+                overlaps.append(sender_id)
+            running.add(sender_id)
+        time.sleep(0.001)
+        with lock:
+            processed.setdefault(sender_id, []).extend(mids(group['messages']))
+            running.discard(sender_id)
+
+    dispatcher = InProcessDispatcher(process, max_workers=4, batch_size=3)
+    for n in range(20):
+        dispatcher.dispatch([message(s, n) for s in 'ABCDE'])
+    assert dispatcher.join(timeout=10)
+
+    assert overlaps == []
+    for s in 'ABCDE':
+        assert processed[s] == ['{}{}'.format(s, n) for n in range(20)]
+
+
+def test_in_process_continues_after_error():
+    processed = []
+
+    def process(event, context):
+        group, = event['senders']
+        processed.extend(mids(group['messages']))
+        raise RuntimeError('reply failed')
+
+    dispatcher = InProcessDispatcher(process, batch_size=1)
+    dispatcher.dispatch([message('A', 1), message('A', 2)])
+    assert dispatcher.join(timeout=10)
+    assert processed == ['A1', 'A2']